@@ -12,14 +12,19 @@ from __future__ import division, print_function
 
 # For reporting progress time
 import time
+# For batching match queries
+import itertools
+# For bench results
+import json
 # For command line interface
 import docopt
 import os
 # For __main__
 import sys
-# For multiprocessing options
-import multiprocessing
-import joblib
+# For stopping the daemon
+import signal
+# Compact hash arrays passed back by multiprocess add
+import numpy as np
 
 # The actual analyzer class/code
 import utility.audfprint_analyze as audfprint_analyze
@@ -27,6 +32,12 @@ import utility.audfprint_analyze as audfprint_analyze
 import utility.audfprint_match as audfprint_match
 # My hash_table implementation
 import utility.hash_table as hash_table
+# Querying several tables at once
+import utility.audfprint_fanout as audfprint_fanout
+# Per-stage timings and counts for --profile
+import utility.profiling as profiling
+# Serving commands from a resident process
+import utility.audfprint_daemon as audfprint_daemon
 
 
 if sys.version_info[0] >= 3:
@@ -127,43 +138,105 @@ def file_precompute(analyzer, filename, precompdir, type='peaks', skip_existing=
                                            strip_prefix=strip_prefix)
 
 
-def make_ht_from_list(analyzer, filelist, hashbits, depth, maxtime, pipe=None):
-    """ Populate a hash table from a list, used as target for
-        multiprocess division.  pipe is a pipe over which to push back
-        the result, else return it """
-    # Create new ht instance
-    ht = hash_table.HashTable(hashbits=hashbits, depth=depth, maxtime=maxtime)
-    # Add in the files
-    for filename in filelist:
-        hashes = analyzer.wavfile2hashes(filename)
-        ht.store(filename, hashes)
-    # Pass back to caller
-    if pipe:
-        pipe.send(ht)
-    else:
-        return ht
+def file_hashes(analyzer, filename):
+    """ Analyze one file for a packed precompute, return (hashes, duration) """
+    print(time.ctime(), "precomputing hashes for", filename, "...")
+    hashes = analyzer.wavfile2hashes(filename)
+    return hashes, analyzer.soundfiledur
+
+
+def precompute_pack(hashes_durs, filenames, packfile, report):
+    """ Write the (hashes, duration) results for filenames into one pack """
+    with audfprint_analyze.HashPackWriter(packfile) as pack:
+        for filename, (hashes, dur) in zip(filenames, hashes_durs):
+            pack.add(filename, hashes)
+            report(["packed " + filename + " ( %d hashes, %.3f sec)"
+                    % (len(hashes), dur)])
+    report(["wrote " + packfile + " (" + str(len(filenames)) + " files)"])
+
+
+# Jobs for audfprint_schedule.WorkQueue: each returns (result, duration).
+
+def file_tracks_job(filename, analyzer):
+    """ Job for multiproc_add: the (name, hashes, duration) of each of the
+        file's tracks, with the hashes as a compact int32 array """
+    tracks = [(name, np.asarray(hashes, np.int32).reshape((-1, 2)), dur)
+              for name, hashes, dur in analyzer.file_tracks(filename)]
+    return tracks, sum(dur for _, _, dur in tracks)
+
 
+def file_hashes_job(filename, analyzer):
+    """ Job for a packed precompute: (hashes, duration) as file_hashes """
+    hashes_dur = file_hashes(analyzer, filename)
+    return hashes_dur, hashes_dur[1]
 
-def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report, skip_existing=False, strip_prefix=None):
+
+def file_precompute_job(filename, analyzer, precompdir, type, skip_existing,
+                        strip_prefix):
+    """ Job for precompute: the messages of file_precompute """
+    analyzer.soundfiledur = 0.0
+    msgs = file_precompute(analyzer, filename, precompdir, type,
+                           skip_existing=skip_existing,
+                           strip_prefix=strip_prefix)
+    return msgs, analyzer.soundfiledur
+
+
+def job_result(analyzer, filename, result, error, report, default=None):
+    """ The result of a WorkQueue job, or default if it failed every time
+        and we are continuing on errors """
+    if error is None:
+        return result
+    if analyzer.fail_on_error:
+        raise IOError(filename + ": " + error)
+    report([filename + ": " + error + ", skipping"])
+    return default
+
+
+def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report, skip_existing=False, strip_prefix=None,
+           packfile=None):
     """ Breaks out the core part of running the command.
         This is just the single-core versions.
     """
     if cmd == 'merge' or cmd == 'newmerge':
+        import utility.audfprint_merge as audfprint_merge
         # files are other hash tables, merge them in
         for filename in filename_iter:
             hash_tab2 = hash_table.HashTable(filename)
-            if "samplerate" in hash_tab.params:
-                assert hash_tab.params["samplerate"] == hash_tab2.params["samplerate"]
-            else:
-                # "newmerge" fails to setup the samplerate param
-                hash_tab.params["samplerate"] = hash_tab2.params["samplerate"]
+            audfprint_merge.merge_params(hash_tab, hash_tab2)
             hash_tab.merge(hash_tab2)
 
+    elif cmd == 'precompute' and packfile:
+        # precompute fingerprints into a single pack, single core
+        filenames = list(filename_iter)
+        precompute_pack((file_hashes(analyzer, filename)
+                         for filename in filenames),
+                        filenames, packfile, report)
+
     elif cmd == 'precompute':
         # just precompute fingerprints, single core
         for filename in filename_iter:
             report(file_precompute(analyzer, filename, outdir, type, skip_existing=skip_existing, strip_prefix=strip_prefix))
 
+    elif cmd == 'match' and matcher.scan:
+        # Scanning long queries for every occurrence, single-core mode
+        for num, filename in enumerate(filename_iter):
+            report(matcher.file_scan_to_msgs(analyzer, hash_tab, filename,
+                                             num))
+
+    elif cmd == 'match' and matcher.match_batch > 1:
+        # Running query, single-core mode, several files per table lookup
+        filename_iter = iter(filename_iter)
+        num = 0
+        while True:
+            filenames = list(itertools.islice(filename_iter,
+                                              matcher.match_batch))
+            if not filenames:
+                break
+            for msgs in matcher.files_match_to_msgs(analyzer, hash_tab,
+                                                    filenames, num):
+                report(msgs)
+            num += len(filenames)
+
     elif cmd == 'match':
         # Running query, single-core mode
         for num, filename in enumerate(filename_iter):
@@ -197,74 +270,121 @@ def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report
 
 
 def multiproc_add(analyzer, hash_tab, filename_iter, report, ncores):
-    """Run multiple threads adding new files to hash table"""
-    # run ncores in parallel to add new files to existing HASH_TABLE
-    # lists store per-process parameters
-    # Pipes to transfer results
-    rx = [[] for _ in range(ncores)]
-    tx = [[] for _ in range(ncores)]
-    # Process objects
-    pr = [[] for _ in range(ncores)]
-    # Lists of the distinct files
-    filelists = [[] for _ in range(ncores)]
-    # unpack all the files into ncores lists
-    ix = 0
-    for filename in filename_iter:
-        filelists[ix % ncores].append(filename)
-        ix += 1
-    # Launch each of the individual processes
-    for ix in range(ncores):
-        rx[ix], tx[ix] = multiprocessing.Pipe(False)
-        pr[ix] = multiprocessing.Process(target=make_ht_from_list,
-                                         args=(analyzer, filelists[ix],
-                                               hash_tab.hashbits,
-                                               hash_tab.depth,
-                                               (1 << hash_tab.maxtimebits),
-                                               tx[ix]))
-        pr[ix].start()
-    # gather results when they all finish
-    for core in range(ncores):
-        # thread passes back serialized hash table structure
-        hash_tabx = rx[core].recv()
-        report(["hash_table " + str(core) + " has "
-                + str(len(hash_tabx.names))
-                + " files " + str(sum(hash_tabx.counts)) + " hashes"])
-        # merge in all the new items, hash entries
-        hash_tab.merge(hash_tabx)
-        # finish that thread...
-        pr[core].join()
+    """Run multiple processes analyzing new files to add to hash table"""
+    import utility.audfprint_schedule as audfprint_schedule
+    # The workers take the files one at a time, biggest first, and send
+    # back just their hashes, which we store here in the original order.
+    filenames = list(filename_iter)
+    queue = audfprint_schedule.WorkQueue(
+            file_tracks_job, (analyzer,), ncores, report=report)
+    results = queue.run(filenames)
+    tothashes = 0
+    try:
+        for ix, tracks, error in audfprint_schedule.in_order(results):
+            for name, hashes, dur in job_result(analyzer, filenames[ix],
+                                                tracks, error, report, []):
+                hash_tab.store(name, hashes)
+                analyzer._count_soundfile(dur)
+                tothashes += len(hashes)
+    finally:
+        results.close()
+    report(queue.stats_msgs())
+    report(["Added " + str(tothashes) + " hashes "
+            + "(%.1f" % (tothashes / max(analyzer.soundfiletotaldur, 1e-9))
+            + " hashes/sec)"])
 
 
 def matcher_file_match_to_msgs(matcher, analyzer, hash_tab, filename):
-    """Cover for matcher.file_match_to_msgs so it can be passed to joblib"""
+    """Cover for matcher.file_match_to_msgs, dispatching to scan mode"""
+    if matcher.scan:
+        return matcher.file_scan_to_msgs(analyzer, hash_tab, filename)
     return matcher.file_match_to_msgs(analyzer, hash_tab, filename)
 
 
+# The matcher, analyzer and shared hash table of a match worker process
+_match_worker_state = None
+
+
+def init_match_worker(matcher, analyzer, shared):
+    """Pool initializer: attach to the shared hash table once per worker"""
+    global _match_worker_state
+    _match_worker_state = (matcher, analyzer, shared.hash_table())
+
+
+def match_worker(filename):
+    """Match one query file in a worker set up by init_match_worker"""
+    matcher, analyzer, hash_tab = _match_worker_state
+    return matcher_file_match_to_msgs(matcher, analyzer, hash_tab, filename)
+
+
 def do_cmd_multiproc(cmd, analyzer, hash_tab, filename_iter, matcher,
                      outdir, type, report, skip_existing=False,
-                     strip_prefix=None, ncores=1):
+                     strip_prefix=None, ncores=1, packfile=None,
+                     dbasename=None):
     """ Run the actual command, using multiple processors """
-    if cmd == 'precompute':
-        # precompute fingerprints with joblib
-        msgslist = joblib.Parallel(n_jobs=ncores)(
-                joblib.delayed(file_precompute)(analyzer, file, outdir, type, skip_existing, strip_prefix=strip_prefix)
-                for file in filename_iter
-        )
-        # Collapse into a single list of messages
-        for msgs in msgslist:
-            report(msgs)
+    # Only loaded for --ncores > 1, to keep startup fast.
+    import multiprocessing
+    import utility.audfprint_schedule as audfprint_schedule
+    if cmd == 'merge' or cmd == 'newmerge':
+        # merge the tables pairwise, then the pairs, etc., in worker
+        # processes, the last of which writes the merged table to dbasename
+        # (starting from its existing contents, for "merge")
+        import utility.audfprint_merge as audfprint_merge
+        merged = audfprint_merge.TreeMerge(
+                hash_tab.hashbits, hash_tab.depth, 1 << hash_tab.maxtimebits,
+                ncores, report=report, stop_factor=hash_tab.stop_factor).run(
+                filename_iter, dbasename,
+                base=dbasename if cmd == 'merge' else None)
+        if merged is not None:
+            # Already saved.
+            hash_tab.dirty = False
+
+    elif cmd == 'precompute' and packfile:
+        # precompute hashes in worker processes (biggest files first),
+        # then pack them in this process, in order
+        filenames = list(filename_iter)
+        queue = audfprint_schedule.WorkQueue(
+                file_hashes_job, (analyzer,), ncores, report=report)
+        results = queue.run(filenames)
+        try:
+            precompute_pack((job_result(analyzer, filenames[ix], hashes_dur,
+                                        error, report,
+                                        (np.zeros((0, 2), np.int32), 0.0))
+                             for ix, hashes_dur, error
+                             in audfprint_schedule.in_order(results)),
+                            filenames, packfile, report)
+        finally:
+            results.close()
+        report(queue.stats_msgs())
+
+    elif cmd == 'precompute':
+        # precompute fingerprints in worker processes, biggest files first
+        filenames = list(filename_iter)
+        queue = audfprint_schedule.WorkQueue(
+                file_precompute_job,
+                (analyzer, outdir, type, skip_existing, strip_prefix), ncores,
+                report=report)
+        results = queue.run(filenames)
+        try:
+            for ix, msgs, error in results:
+                report(job_result(analyzer, filenames[ix], msgs, error,
+                                  report, []))
+        finally:
+            results.close()
+        report(queue.stats_msgs())
 
     elif cmd == 'match':
-        # Running queries in parallel
-        msgslist = joblib.Parallel(n_jobs=ncores)(
-                # Would use matcher.file_match_to_msgs(), but you
-                # can't use joblib on an instance method
-                joblib.delayed(matcher_file_match_to_msgs)(matcher, analyzer,
-                                                           hash_tab, filename)
-                for filename in filename_iter
-        )
-        for msgs in msgslist:
-            report(msgs)
+        # Running queries in parallel, with the workers sharing a single
+        # copy of the hash table rather than each being sent its own
+        with hash_table.SharedTable(hash_tab) as shared:
+            pool = multiprocessing.Pool(ncores, initializer=init_match_worker,
+                                        initargs=(matcher, analyzer, shared))
+            try:
+                for msgs in pool.imap(match_worker, filename_iter):
+                    report(msgs)
+            finally:
+                pool.close()
+                pool.join()
 
     elif cmd == 'new' or cmd == 'add':
         # We add by forking multiple parallel threads each running
@@ -276,6 +396,30 @@ def do_cmd_multiproc(cmd, analyzer, hash_tab, filename_iter, matcher,
         raise ValueError("unrecognized multiproc command: " + cmd)
 
 
+def do_match_fanout(fanout, analyzer, filename_iter, report):
+    """ Match each query file against all of the fanout's tables, then
+        report the per-table latencies """
+    with fanout:
+        for num, filename in enumerate(filename_iter):
+            report(fanout.file_match_to_msgs(analyzer, filename, num))
+    report(fanout.stats_msgs())
+
+
+def profile_files(filename_iter, cmd, f):
+    """ Pass on the filenames, profiling the work done on each one (until
+        the next is asked for) and writing it to f as a line of JSON """
+    for filename in filename_iter:
+        profiling.start()
+        tick = time.time()
+        try:
+            yield filename
+        finally:
+            record = {'command': cmd, 'file': filename,
+                      'seconds': time.time() - tick}
+            record.update(profiling.stop().as_dict())
+            f.write(json.dumps(record) + '\n')
+
+
 # Command to separate out setting of analyzer parameters
 def setup_analyzer(args):
     """Create a new analyzer object, taking values from docopts args"""
@@ -296,6 +440,13 @@ def setup_analyzer(args):
         # Default shift is 4 for match, otherwise 1
         analyzer.shifts = 4 if args['match'] else 1
     analyzer.fail_on_error = not args['--continue-on-error']
+    # Multithreaded FFTs only when we're not already using several processes
+    if int(args['--ncores']) > 1:
+        analyzer.fft_workers = None
+    if args['--silence-gate']:
+        analyzer.gate_db = float(args['--silence-gate'])
+    if args['--peak-cache']:
+        analyzer.peak_cache = audfprint_analyze.PeakCache(args['--peak-cache'])
     return analyzer
 
 
@@ -314,9 +465,192 @@ def setup_matcher(args):
     matcher.verbose = args['--verbose']
     matcher.find_time_range = args['--find-time-range']
     matcher.time_quantile = float(args['--time-quantile'])
+    matcher.match_batch = int(args['--match-batch'])
+    matcher.scan = args['--scan']
+    matcher.scan_window = float(args['--scan-window'])
+    matcher.scan_hop = float(args['--scan-hop'])
+    if args['--result-cache']:
+        matcher.result_cache = audfprint_match.ResultCache(
+            args['--result-cache'])
     return matcher
 
 
+# Analyzer options that "sweep" accepts as comma-separated lists
+SWEEP_OPTIONS = ['--density', '--fanout', '--pks-per-frame', '--freq-sd']
+
+
+def do_sweep(args, report):
+    """ Run the "sweep" command: index the <file>s and run the ground-truth
+        queries once for every combination of the swept settings """
+    import utility.audfprint_sweep as audfprint_sweep
+    if not args['--ground-truth']:
+        raise ValueError("sweep needs a --ground-truth list of queries")
+    values = dict((opt, audfprint_sweep.sweep_values(args[opt]))
+                  for opt in SWEEP_OPTIONS)
+    # The base analyzer takes the first value of each swept setting.
+    base_args = dict(args)
+    for opt in SWEEP_OPTIONS:
+        base_args[opt] = values[opt][0]
+    analyzer = setup_analyzer(base_args)
+    query_shifts = int(args['--shifts']) or 4
+    sweeper = audfprint_sweep.Sweeper(
+            analyzer, setup_matcher(args),
+            hashbits=int(args['--hashbits']),
+            depth=int(args['--bucketsize']),
+            maxtime=(1 << int(args['--maxtimebits'])),
+            query_shifts=query_shifts, ncores=int(args['--ncores']))
+    filename_iter = filename_list_iterator(
+            args['<file>'], args['--wavdir'], args['--wavext'], args['--list'])
+    rows = sweeper.run(filename_iter,
+                       audfprint_sweep.read_ground_truth(args['--ground-truth']),
+                       values['--density'],
+                       [int(val) for val in values['--fanout']],
+                       [int(val) for val in values['--pks-per-frame']],
+                       values['--freq-sd'],
+                       stop_factors=audfprint_sweep.sweep_values(
+                           args['--stop-factor'] or '0'),
+                       report=report)
+    report(audfprint_sweep.format_sweep_rows(rows))
+
+
+def do_bench(args, report):
+    """ Run the "bench" command: time indexing and matching a synthetic
+        corpus with the current settings, optionally writing JSON """
+    import utility.audfprint_bench as audfprint_bench
+    bench = audfprint_bench.Bench(
+            setup_analyzer(args), setup_matcher(args),
+            hashbits=int(args['--hashbits']),
+            depth=int(args['--bucketsize']),
+            maxtime=(1 << int(args['--maxtimebits'])))
+    results = bench.run(nrefs=int(args['--bench-refs']),
+                        nqueries=int(args['--bench-queries']),
+                        dur=float(args['--bench-dur']),
+                        query_shifts=int(args['--shifts']) or 4,
+                        report=report)
+    report(audfprint_bench.format_bench(results))
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        report(["wrote " + args['--json']])
+
+
+# The commands a daemon serves, and which of them modify the table
+DAEMON_COMMANDS = ['add', 'match', 'list', 'remove']
+DAEMON_WRITE_COMMANDS = ['add', 'remove']
+
+
+def daemon_command(tables, argv, cwd=None):
+    """ Run one audfprint command line sent to a daemon, against its
+        resident tables.  Relative paths are taken relative to cwd.
+        Returns the list of output lines (unless --opfile is given). """
+    args = docopt.docopt(USAGE, version=__version__, argv=argv)
+    cmdlist = [cmdname for cmdname in DAEMON_COMMANDS if args[cmdname]]
+    if len(cmdlist) != 1:
+        raise ValueError("a daemon serves only "
+                         + ", ".join(DAEMON_COMMANDS))
+    cmd = cmdlist[0]
+    relative = cwd and os.path.realpath(cwd) != os.path.realpath(os.getcwd())
+    if relative:
+        for opt in ['--dbase', '--opfile', '--wavdir', '--precompdir',
+                    '--peak-cache', '--result-cache']:
+            if args[opt]:
+                args[opt] = os.path.join(cwd, args[opt])
+        if not args['--wavdir']:
+            args['<file>'] = [os.path.join(cwd, filename)
+                              for filename in args['<file>']]
+    dbasename = args['--dbase']
+    if not dbasename:
+        raise ValueError("dbase name must be provided")
+    hash_tab, lock = tables.get(dbasename)
+    if args['--stop-factor'] is not None and \
+            float(args['--stop-factor']) != hash_tab.stop_factor:
+        raise ValueError("a daemon can't change the stop factor of "
+                         + dbasename)
+    analyzer = setup_analyzer(args) if cmd in ['add', 'match'] else None
+    matcher = setup_matcher(args) if cmd == 'match' else None
+    output = []
+    opfile = open(args['--opfile'], 'w') if args['--opfile'] else None
+
+    def report(msglist):
+        """Collect the messages for the reply, or write them to opfile"""
+        if opfile:
+            for msg in msglist:
+                opfile.write(msg + "\n")
+        else:
+            output.extend(msglist)
+    filename_iter = filename_list_iterator(
+            args['<file>'], args['--wavdir'], args['--wavext'], args['--list'])
+    if relative and not args['--wavdir']:
+        # The names in --list files are relative to cwd too.
+        filename_iter = (os.path.join(cwd, filename)
+                         for filename in filename_iter)
+    try:
+        # What the command prints goes back to the client too.
+        with (lock.write() if cmd in DAEMON_WRITE_COMMANDS else lock.read()), \
+                audfprint_daemon.captured_output(output.extend):
+            # Changes are saved by the daemon's AutoSave, not here.
+            do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher,
+                   args['--precompdir'], 'hashes', report,
+                   skip_existing=args['--skip-existing'],
+                   strip_prefix=args['--wavdir'])
+    finally:
+        if opfile:
+            opfile.close()
+    return output
+
+
+def do_daemon(args, report):
+    """ Run the "daemon" command: load the --dbase tables (if any), then
+        serve commands sent to the --socket until interrupted, saving the
+        changed tables now and then and when it stops """
+    if not args['--socket']:
+        raise ValueError("daemon needs a --socket to listen on")
+    tables = audfprint_daemon.TableCache(hash_table.HashTable)
+    if args['--dbase']:
+        for name in args['--dbase'].split(','):
+            tables.get(name)
+    server = audfprint_daemon.DaemonServer(
+            args['--socket'], lambda argv, cwd: daemon_command(tables, argv,
+                                                               cwd))
+    # Send what each request prints back to its client.
+    stdout = sys.stdout
+    sys.stdout = audfprint_daemon.ThreadOutput(stdout)
+    autosave = audfprint_daemon.AutoSave(tables)
+    autosave.start()
+    report([time.ctime() + " serving on " + args['--socket']])
+
+    def terminate(signum, frame):
+        """Stop serving on SIGTERM as on ^C"""
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        autosave.stop()
+        tables.save_dirty()
+        sys.stdout = stdout
+    report([time.ctime() + " daemon stopped"])
+
+
+def forward_command(argv):
+    """ Send a command line to the daemon on its --socket, and print its
+        output (the daemon itself writes any --opfile) """
+    path, args = audfprint_daemon.split_socket_arg(argv)
+    try:
+        output, error = audfprint_daemon.request(path, args)
+    except EnvironmentError as e:
+        output, error = [], "can't reach a daemon on %s: %s" % (path, e)
+    for msg in output:
+        print(msg)
+    if error:
+        # Exit with the message on stderr, as docopt does for bad usage.
+        sys.exit(error)
+
+
 # Command to construct the reporter object
 def setup_reporter(args):
     """ Creates a logging function, either to stderr or file"""
@@ -342,16 +676,30 @@ Landmark-based audio fingerprinting.
 Create a new fingerprint dbase with "new",
 append new files to an existing database with "add",
 or identify noisy query excerpts with "match".
-"precompute" writes a *.fpt file under precompdir
-with precomputed fingerprint for each input wav file.
+"match --scan" instead finds every occurrence of the
+dbase items within long query recordings.
+"precompute" writes a *.afpt file under precompdir
+with precomputed fingerprint for each input wav file,
+or a single *.afpp pack of all of them with --pack.
+Packs can be passed to "new" and "add" directly.
 "merge" combines previously-created databases into
 an existing database; "newmerge" combines existing
 databases to create a new one.
-
-Usage: audfprint (new | add | match | precompute | merge | newmerge | list | remove) [options] [<file>]...
+"sweep" indexes the files once for every combination of the
+comma-separated values of --density, --fanout, --pks-per-frame
+and --freq-sd, runs the queries listed by --ground-truth
+against each (with each value of --stop-factor), and
+reports index size, speed and recall.
+"bench" times each stage of indexing and matching a
+synthetic corpus with the current settings.
+"daemon" keeps its databases loaded and serves the add,
+match, list and remove commands sent to its socket,
+saving changed databases every minute and on exit.
+
+Usage: audfprint (new | add | match | precompute | merge | newmerge | list | remove | sweep | bench | daemon) [options] [<file>]...
 
 Options:
-  -d <dbase>, --dbase <dbase>     Fingerprint database file
+  -d <dbase>, --dbase <dbase>     Fingerprint database file (for match, may be a comma-separated list)
   -n <dens>, --density <dens>     Target hashes per second [default: 20.0]
   -h <bits>, --hashbits <bits>    How many bits in each hash [default: 20]
   -b <val>, --bucketsize <val>    Number of entries per bucket [default: 100]
@@ -365,6 +713,11 @@ Options:
   -x <val>, --max-matches <val>   Maximum number of matches to report for each query [default: 1]
   -X, --exact-count               Flag to use more precise (but slower) match counting
   -R, --find-time-range           Report the time support of each match
+  -B <val>, --match-batch <val>   Look up this many query files in the table at once [default: 1]
+  -Z <k>, --stop-factor <k>       Skip hashes whose buckets were offered over k * bucketsize entries (0 for none)
+  -s, --scan                      Report every occurrence of the dbase items in long queries
+  --scan-window <sec>             Length of each window of a scanned query [default: 60.0]
+  --scan-hop <sec>                Spacing of the windows of a scanned query [default: 30.0]
   -Q, --time-quantile <val>       Quantile at extremes of time support [default: 0.05]
   -S <val>, --freq-sd <val>       Frequency peak spreading SD in bins [default: 30.0]
   -F <val>, --fanout <val>        Max number of hash pairs per peak [default: 3]
@@ -373,13 +726,24 @@ Options:
   -H <val>, --ncores <val>        Number of processes to use [default: 1]
   -o <name>, --opfile <name>      Write output (matches) to this file, not stdout [default: ]
   -K, --precompute-peaks          Precompute just landmarks (else full hashes)
+  -A <file>, --pack <file>        Precompute hashes into this single .afpp pack
   -k, --skip-existing             On precompute, skip items if output file already exists
   -C, --continue-on-error         Keep processing despite errors reading input
+  -c <dir>, --peak-cache <dir>    Reuse spectral peaks cached under this dir
+  --result-cache <dir>            Reuse match results cached under this dir
+  -g <dB>, --silence-gate <dB>    Skip analysis of stretches this far below peak level
   -l, --list                      Input files are lists, not audio
   -T, --sortbytime                Sort multiple hits per file by time (instead of score)
   -v <val>, --verbose <val>       Verbosity level [default: 1]
   -I, --illustrate                Make a plot showing the match
   -J, --illustrate-hpf            Plot the match, using onset enhancement
+  -G <file>, --ground-truth <file>  Lines of "query<TAB>reference" for sweep
+  --bench-refs <n>                Number of synthetic reference items for bench [default: 20]
+  --bench-queries <n>             Number of synthetic queries for bench [default: 20]
+  --bench-dur <sec>               Duration of each bench reference item [default: 60.0]
+  --json <file>                   Write bench results to this file as JSON
+  --socket <path>                 Unix socket the daemon listens on (for other commands, send them to the daemon)
+  --profile <file>                Write each file's stage times and counts to this file as JSON lines (runs one file at a time, in one process)
   -W <dir>, --wavdir <dir>        Find sound files under this dir [default: ]
   -V <ext>, --wavext <ext>        Extension to add to wav file names [default: ]
   --version                       Report version number
@@ -396,7 +760,7 @@ def main(argv):
 
     # Figure which command was chosen
     poss_cmds = ['new', 'add', 'precompute', 'merge', 'newmerge', 'match',
-                 'list', 'remove']
+                 'list', 'remove', 'sweep', 'bench', 'daemon']
     cmdlist = [cmdname
                for cmdname in poss_cmds
                if args[cmdname]]
@@ -405,6 +769,13 @@ def main(argv):
     # The actual command as a str
     cmd = cmdlist[0]
 
+    if args['--socket'] and cmd != "daemon":
+        # A resident daemon does the work.
+        if cmd not in DAEMON_COMMANDS:
+            sys.exit("a daemon serves only " + ", ".join(DAEMON_COMMANDS))
+        forward_command(argv[1:])
+        return
+
     # Setup output function
     report = setup_reporter(args)
 
@@ -417,6 +788,19 @@ def main(argv):
     else:
         args["--maxtimebits"] = hash_table._bitsfor(int(args["--maxtime"]))
 
+    if cmd == "sweep":
+        # Sweep builds its own analyzers, indexes and matcher.
+        do_sweep(args, report)
+        return
+
+    if cmd == "bench":
+        do_bench(args, report)
+        return
+
+    if cmd == "daemon":
+        do_daemon(args, report)
+        return
+
     # Setup the analyzer if we're using one (i.e., unless "merge")
     analyzer = setup_analyzer(args) if not (
             cmd == "merge" or cmd == "newmerge"
@@ -442,7 +826,23 @@ def main(argv):
             # Set its samplerate param
             if analyzer:
                 hash_tab.params['samplerate'] = analyzer.target_sr
-
+            if args['--stop-factor']:
+                hash_tab.stop_factor = float(args['--stop-factor'])
+
+        elif cmd == "match" and ',' in dbasename:
+            # Several tables to fan each query out to
+            hash_tab = None
+            tables = []
+            for name in dbasename.split(','):
+                if args['--verbose']:
+                    report([time.ctime() + " Reading hash table " + name])
+                tables.append(hash_table.HashTable(name))
+                if args['--stop-factor'] is not None:
+                    # Applies to this match against each table
+                    tables[-1].set_stop_hashes(float(args['--stop-factor']))
+                    nstop, stopfrac = tables[-1].stop_hash_stats()
+                    report(["%s: %d stop hashes (%.2f%% of entries) skipped"
+                            % (name, nstop, 100.0 * stopfrac)])
         else:
             # Load existing hash table file (add, match, merge)
             if args['--verbose']:
@@ -452,12 +852,24 @@ def main(argv):
                     and hash_tab.params['samplerate'] != analyzer.target_sr:
                 # analyzer.target_sr = hash_tab.params['samplerate']
                 print("db samplerate overridden to ", analyzer.target_sr)
+            if args['--stop-factor'] is not None:
+                # Applies to this match, or is saved with the table
+                stop_factor = float(args['--stop-factor'])
+                if stop_factor != hash_tab.stop_factor:
+                    hash_tab.set_stop_hashes(stop_factor)
+                    hash_tab.dirty = hash_tab.dirty or cmd != 'match'
+                if cmd == 'match':
+                    nstop, stopfrac = hash_tab.stop_hash_stats()
+                    report(["%d stop hashes (%.2f%% of entries) skipped"
+                            % (nstop, 100.0 * stopfrac)])
     else:
         # The command IS precompute
         # dummy empty hash table
         hash_tab = None
         if args['--precompute-peaks']:
             precomp_type = 'peaks'
+            if args['--pack']:
+                raise ValueError("--pack holds hashes, not peaks")
 
     # Create a matcher
     matcher = setup_matcher(args) if cmd == 'match' else None
@@ -471,20 +883,35 @@ def main(argv):
 
     # How many processors to use (multiprocessing)
     ncores = int(args['--ncores'])
-    if ncores > 1 and not (cmd == "merge" or cmd == "newmerge" or
-                           cmd == "list" or cmd == "remove"):
-        # merge/newmerge/list/remove are always single-thread processes
+    profile_file = None
+    if args['--profile']:
+        profile_file = open(args['--profile'], 'w')
+        filename_iter = profile_files(filename_iter, cmd, profile_file)
+        # Profiles are recorded in this process, one file at a time.
+        ncores = 1
+        if matcher:
+            matcher.match_batch = 1
+    if cmd == "match" and hash_tab is None:
+        # Each query goes to all the tables, searched by ncores threads
+        do_match_fanout(audfprint_fanout.TableFanout(
+                matcher, tables, names=dbasename.split(','),
+                max_workers=ncores), analyzer, filename_iter, report)
+    elif ncores > 1 and not (cmd == "list" or cmd == "remove"):
+        # list/remove are always single-thread processes
         do_cmd_multiproc(cmd, analyzer, hash_tab, filename_iter,
                          matcher, args['--precompdir'],
                          precomp_type, report,
                          skip_existing=args['--skip-existing'],
                          strip_prefix=args['--wavdir'],
-                         ncores=ncores)
+                         ncores=ncores, packfile=args['--pack'],
+                         dbasename=dbasename)
     else:
         do_cmd(cmd, analyzer, hash_tab, filename_iter,
                matcher, args['--precompdir'], precomp_type, report,
                skip_existing=args['--skip-existing'],
-               strip_prefix=args['--wavdir'])
+               strip_prefix=args['--wavdir'], packfile=args['--pack'])
+    if profile_file:
+        profile_file.close()
 
     elapsedtime = time_clock() - initticks
     if analyzer and analyzer.soundfiletotaldur > 0.:
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""
+test_analyze.py
+
+Analyzer.wavfiles2hashes must give the same hashes as wavfile2hashes on
+each input, whatever mix of soundfiles and precomputed files it is given.
+Gating out silence must not change the peaks of the rest.
+"""
+from __future__ import division, print_function
+
+import shutil
+
+import numpy as np
+import pytest
+
+import utility.audfprint_analyze as audfprint_analyze
+import utility.audfprint_bench as audfprint_bench
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None,
+    reason="soundfiles are read with ffmpeg")
+
+
+@needs_ffmpeg
+def test_wavfiles2hashes_matches_wavfile2hashes(tmp_path):
+    analyzer = audfprint_analyze.Analyzer()
+    analyzer.density = 20.0
+    refs, _ = audfprint_bench.make_corpus(str(tmp_path), 3, 5.0, 0, 0.0,
+                                          analyzer.target_sr)
+    hashfile = str(tmp_path / 'ref0001.afpt')
+    audfprint_analyze.hashes_save(hashfile, analyzer.wavfile2hashes(refs[1]))
+    peakfile = str(tmp_path / 'ref0002.afpk')
+    audfprint_analyze.peaks_save(peakfile, analyzer.wavfile2peaks(refs[2]))
+    filenames = [refs[0], hashfile, peakfile, refs[2], refs[1]]
+    expected = [analyzer.wavfile2hashes(filename) for filename in filenames]
+    for nthreads in [1, 2]:
+        hashlist = analyzer.wavfiles2hashes(filenames, nthreads=nthreads)
+        assert len(hashlist) == len(filenames)
+        for hashes, want in zip(hashlist, expected):
+            assert len(want)
+            assert np.array_equal(np.asarray(hashes).reshape((-1, 2)),
+                                  np.asarray(want).reshape((-1, 2)))
+
+
+def test_wavfiles2hashes_mixed_inputs_without_ffmpeg(tmp_path, monkeypatch):
+    # Stand-in soundfiles, so this runs without a decoder.
+    rng = np.random.RandomState(1)
+    signals = dict((name, (rng.randn(3 * 11025) * 0.1).astype(np.float32))
+                   for name in ['a.mp3', 'b.mp3'])
+    monkeypatch.setattr(audfprint_analyze.audio_read, 'audio_read',
+                        lambda filename, sr=None, channels=None:
+                        (signals[filename], sr))
+    analyzer = audfprint_analyze.Analyzer()
+    analyzer.density = 20.0
+    hashfile = str(tmp_path / 'a.afpt')
+    audfprint_analyze.hashes_save(hashfile, analyzer.wavfile2hashes('a.mp3'))
+    peakfile = str(tmp_path / 'b.afpk')
+    audfprint_analyze.peaks_save(peakfile, analyzer.wavfile2peaks('b.mp3'))
+    packfile = str(tmp_path / 'ab.afpp')
+    with audfprint_analyze.HashPackWriter(packfile) as writer:
+        writer.add('b', analyzer.wavfile2hashes('b.mp3'))
+    member = packfile + audfprint_analyze.PACK_SEP + 'b'
+    filenames = ['a.mp3', peakfile, hashfile, member, 'b.mp3', hashfile]
+    expected = [analyzer.wavfile2hashes(filename) for filename in filenames]
+    for nthreads in [1, 2]:
+        hashlist = analyzer.wavfiles2hashes(filenames, nthreads=nthreads)
+        assert len(hashlist) == len(filenames)
+        for hashes, want in zip(hashlist, expected):
+            assert len(want)
+            assert np.array_equal(np.asarray(hashes).reshape((-1, 2)),
+                                  np.asarray(want).reshape((-1, 2)))
+
+def test_gating_keeps_the_peaks_of_the_content():
+    sr = 11025
+    rng = np.random.RandomState(0)
+
+    def content(seconds):
+        t = np.arange(int(seconds * sr)) / sr
+        return (0.3 * np.sin(2 * np.pi * (440 + 200 * np.sin(t)) * t)
+                + 0.1 * rng.randn(len(t))).astype(np.float32)
+
+    def silence(seconds):
+        return np.zeros(int(seconds * sr), np.float32)
+
+    d = np.r_[content(3), silence(4), content(3), silence(2), content(2)]
+    analyzer = audfprint_analyze.Analyzer()
+    baseline = analyzer.find_peaks(d, sr)
+    analyzer.gate_db = 60.0
+    # Both silences are gated ...
+    assert len(analyzer._content_segments(d)) == 3
+    # ... but the content gets the same peaks as without gating.
+    np.testing.assert_array_equal(analyzer.find_peaks(d, sr), baseline)
+
+
+def test_rewritten_pack_is_reopened(tmp_path):
+    analyzer = audfprint_analyze.Analyzer()
+    packname = str(tmp_path / 'tracks.afpp')
+    member = packname + audfprint_analyze.PACK_SEP + 'a'
+    packs = []
+    for hashes in [[[1, 2], [3, 4]], [[5, 6]]]:
+        with audfprint_analyze.HashPackWriter(packname) as writer:
+            writer.add('a', hashes)
+        np.testing.assert_array_equal(analyzer.wavfile2hashes(member), hashes)
+        packs.append(audfprint_analyze.open_pack(packname))
+    # The stale pack was closed when the new one was opened.
+    assert packs[0] is not packs[1]
+    with pytest.raises(IOError):
+        packs[0]['a']
+    assert len(packs[1]['a']) == 1
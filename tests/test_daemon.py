@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+test_daemon.py
+
+Commands run by the daemon against its resident tables.
+"""
+from __future__ import division, print_function
+
+import sys
+import threading
+
+import pytest
+
+import audfprint
+import utility.audfprint_analyze as audfprint_analyze
+import utility.audfprint_daemon as audfprint_daemon
+import utility.hash_table as hash_table
+
+
+def names(dbase):
+    return [name for name in hash_table.HashTable(dbase).names if name]
+
+
+def test_changes_are_saved_by_save_dirty(tmp_path, monkeypatch):
+    dbase = str(tmp_path / 'x.pklz')
+    ht = hash_table.HashTable(hashbits=8, depth=4)
+    ht.store(str(tmp_path / 'a.wav'), [[1, 2], [3, 4]])
+    ht.store(str(tmp_path / 'b.wav'), [[5, 6]])
+    ht.save(dbase)
+    monkeypatch.setattr(sys, 'stdout', audfprint_daemon.ThreadOutput(
+        sys.stdout))
+    tables = audfprint_daemon.TableCache(hash_table.HashTable)
+    # Relative to the client's directory, not the daemon's.
+    output = audfprint.daemon_command(
+        tables, ['remove', '--dbase', 'x.pklz', 'a.wav'], str(tmp_path))
+    # What the table printed comes back to the client.
+    assert output == ["Removed %s ( 2 hashes)." % (tmp_path / 'a.wav')]
+    assert len(names(dbase)) == 2
+    assert tables.save_dirty() == [dbase]
+    assert names(dbase) == [str(tmp_path / 'b.wav')]
+    assert tables.save_dirty() == []
+
+
+def test_list_file_names_are_relative_to_cwd(tmp_path):
+    dbase = str(tmp_path / 'x.pklz')
+    hash_table.HashTable(hashbits=8, depth=4).save(dbase)
+    audfprint_analyze.hashes_save(str(tmp_path / 'q.afpt'),
+                                  [[1, 2], [3, 4]])
+    with open(str(tmp_path / 'files.txt'), 'w') as f:
+        f.write('q.afpt\n')
+    tables = audfprint_daemon.TableCache(hash_table.HashTable)
+    audfprint.daemon_command(
+        tables, ['add', '--dbase', 'x.pklz', '--list', 'files.txt'],
+        str(tmp_path))
+    ht, _ = tables.get(dbase)
+    assert [name for name in ht.names if name] == [str(tmp_path / 'q.afpt')]
+
+
+def test_thread_output_captures_only_its_thread():
+    written = []
+
+    class Stream(object):
+        def write(self, text):
+            written.append(text)
+
+    output = audfprint_daemon.ThreadOutput(Stream())
+    captured = []
+    with output.capture(captured.extend):
+        print("one", file=output)
+        thread = threading.Thread(
+            target=lambda: print("elsewhere", file=output))
+        thread.start()
+        thread.join()
+        output.write("two, ")
+        output.write("unfinished")
+    assert captured == ["one", "two, unfinished"]
+    assert "".join(written) == "elsewhere\n"
+
+
+def test_unsupported_command_is_a_cli_error(tmp_path):
+    with pytest.raises(SystemExit) as excinfo:
+        audfprint.main(['audfprint', 'new', '--socket', str(tmp_path / 's'),
+                        '--dbase', 'x.pklz'])
+    assert 'daemon serves only' in str(excinfo.value.code)
+
+
+def test_missing_daemon_is_a_cli_error(tmp_path):
+    with pytest.raises(SystemExit) as excinfo:
+        audfprint.main(['audfprint', 'list', '--socket', str(tmp_path / 's'),
+                        '--dbase', 'x.pklz'])
+    assert "can't reach a daemon" in str(excinfo.value.code)
@@ -0,0 +1,62 @@
+# coding=utf-8
+"""
+test_fanout.py
+
+Matching queries against several tables with TableFanout.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+import utility.audfprint_analyze as audfprint_analyze
+import utility.audfprint_fanout as audfprint_fanout
+import utility.audfprint_match as audfprint_match
+import utility.hash_table as hash_table
+
+
+def tables_and_query(ntables=2):
+    rng = np.random.RandomState(0)
+    tables = []
+    for ix in range(ntables):
+        ht = hash_table.HashTable(hashbits=10, depth=8, maxtime=1 << 10)
+        for name in ['a%d.wav' % ix, 'b%d.wav' % ix]:
+            ht.store(name, np.c_[rng.randint(0, 500, 100),
+                                 rng.randint(0, 1 << 10, 100)])
+        tables.append(ht)
+    # The query is part of the first table's first item.
+    query = tables[0].retrieve('a0.wav')[:60]
+    return tables, query
+
+
+def test_cancel_between_queries_stops_the_next():
+    tables, query = tables_and_query()
+    with audfprint_fanout.TableFanout(audfprint_match.Matcher(), tables,
+                                      max_workers=1) as fanout:
+        results = fanout.match_hashes(query)
+        assert results[0, 0] == 0 and results[0, 2] >= 50
+        fanout.cancel()
+        assert len(fanout.match_hashes(query)) == 0
+        assert fanout.nskipped == [1, 1]
+        # The cancel applied to that query only.
+        np.testing.assert_array_equal(fanout.match_hashes(query), results)
+
+
+def test_match_file_uses_the_result_cache(tmp_path):
+    tables, query = tables_and_query()
+    qryname = str(tmp_path / 'q.afpt')
+    audfprint_analyze.hashes_save(qryname, query)
+    matcher = audfprint_match.Matcher()
+    matcher.result_cache = audfprint_match.ResultCache(str(tmp_path / 'rc'))
+    analyzer = audfprint_analyze.Analyzer()
+    with audfprint_fanout.TableFanout(matcher, tables) as fanout:
+        first = fanout.match_file(analyzer, qryname)
+    # The second match comes from the cache, without analysis.
+
+    def no_analysis(*args):
+        raise AssertionError("query analyzed again")
+    matcher._query_hashes = no_analysis
+    with audfprint_fanout.TableFanout(matcher, tables) as fanout:
+        second = fanout.match_file(analyzer, qryname)
+    np.testing.assert_array_equal(first[0], second[0])
+    assert first[1:] == second[1:]
+    assert first[0][0, 0] == 0
@@ -0,0 +1,78 @@
+# coding=utf-8
+"""
+test_hash_table.py
+
+Identity and merge behaviour of HashTable.
+"""
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+import utility.hash_table as hash_table
+
+
+def small_table(names, seed=0, depth=4):
+    rng = np.random.RandomState(seed)
+    ht = hash_table.HashTable(hashbits=6, depth=depth, maxtime=1 << 10)
+    ht.params['samplerate'] = 11025
+    for name in names:
+        ht.store(name, np.c_[rng.randint(0, 1000, 50), rng.randint(0, 64, 50)])
+    return ht
+
+
+def test_loaded_tables_changed_apart_get_new_identities(tmp_path):
+    dbase = str(tmp_path / 'x.pklz')
+    small_table(['a.wav']).save(dbase)
+    first = hash_table.HashTable(dbase)
+    second = hash_table.HashTable(dbase)
+    # Unchanged, they have the same contents and identity.
+    assert (first.uuid, first.generation) == (second.uuid, second.generation)
+    first.store('b.wav', [[1, 2]])
+    second.store('c.wav', [[3, 4]])
+    assert first.generation == second.generation
+    assert first.uuid != second.uuid
+    # Only the first change after loading takes a new uuid.
+    uuid = first.uuid
+    first.remove('b.wav')
+    assert first.uuid == uuid
+
+
+def test_merge_keeps_the_count_of_a_bin_it_fills_exactly():
+    # An overfull bin merged into an empty one fills it exactly, and keeps
+    # its count of all the hashes seen, so merges in any order agree.
+    full = hash_table.HashTable(hashbits=6, depth=4, maxtime=1 << 10)
+    full.store('a.wav', [[t, 5] for t in range(7)])
+    assert full.counts[5] == 7
+    empty = hash_table.HashTable(hashbits=6, depth=4, maxtime=1 << 10)
+    empty.merge(full)
+    assert empty.counts[5] == 7
+    assert np.count_nonzero(empty.table[5]) == 4
+
+
+def test_tree_merge_matches_sequential_merge(tmp_path):
+    import utility.audfprint_merge as audfprint_merge
+    filenames = []
+    for ix in range(5):
+        filenames.append(str(tmp_path / ('part%d.pklz' % ix)))
+        small_table(['%d-%d.wav' % (ix, n) for n in range(3)],
+                    seed=ix).save(filenames[-1])
+    sequential = hash_table.HashTable(hashbits=6, depth=4, maxtime=1 << 10)
+    for filename in filenames:
+        sequential.merge(hash_table.HashTable(filename))
+    outname = str(tmp_path / 'merged.pklz')
+    assert audfprint_merge.TreeMerge(
+        hashbits=6, depth=4, maxtime=1 << 10, tmpdir=str(tmp_path),
+        stop_factor=2.0).run(filenames, outname) == outname
+    merged = hash_table.HashTable(outname)
+    assert merged.names == sequential.names
+    assert merged.stop_factor == 2.0
+    np.testing.assert_array_equal(merged.counts, sequential.counts)
+    # Full bins are subselected at random; the others are the same.
+    notfull = sequential.counts < 4
+    np.testing.assert_array_equal(merged.table[notfull],
+                                  sequential.table[notfull])
+    # The temporary tables are gone.
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        [os.path.basename(name) for name in filenames] + ['merged.pklz'])
@@ -0,0 +1,21 @@
+# coding=utf-8
+"""
+test_schedule.py
+
+WorkQueue hands out the biggest files first, judged by size alone.
+"""
+from __future__ import division, print_function
+
+import utility.audfprint_schedule as audfprint_schedule
+
+
+def test_longest_first_orders_by_size(tmp_path):
+    filenames = []
+    for name, size in [('a.mp3', 10), ('b.wav', 300), ('c.mp3', 10),
+                       ('d.flac', 50)]:
+        filenames.append(str(tmp_path / name))
+        with open(filenames[-1], 'wb') as f:
+            f.write(b'\0' * size)
+    # Pack members (and missing files) count as empty.
+    filenames.append(str(tmp_path / 'x.afpp#track'))
+    assert audfprint_schedule.longest_first(filenames) == [1, 3, 0, 2, 4]
@@ -0,0 +1,71 @@
+# coding=utf-8
+"""
+test_usage.py
+
+The docopt USAGE of audfprint.py must define each option only once:
+docopt 0.6.2 reads any line starting with "-" as an option definition,
+even in the descriptive text, and a long option defined twice can no
+longer be given by its long name.
+"""
+from __future__ import division, print_function
+
+import docopt
+
+import audfprint
+
+
+def parse(argv):
+    return docopt.docopt(audfprint.USAGE, argv=argv)
+
+
+def test_long_options_defined_once():
+    longs = [option.long for option in docopt.parse_defaults(audfprint.USAGE)
+             if option.long]
+    assert sorted(longs) == sorted(set(longs))
+
+
+def test_sweep_ground_truth():
+    args = parse(['sweep', '--ground-truth', 'g.txt', '--density', '10,20',
+                  'a.wav'])
+    assert args['sweep']
+    assert args['--ground-truth'] == 'g.txt'
+    assert args['--density'] == '10,20'
+
+
+def test_stop_factor():
+    args = parse(['new', '-d', 'x.pklz', '--stop-factor', '4', 'a.wav'])
+    assert args['--stop-factor'] == '4'
+    args = parse(['sweep', '--ground-truth', 'g.txt', '--stop-factor', '0,4',
+                  'a.wav'])
+    assert args['--stop-factor'] == '0,4'
+
+
+def test_dbase():
+    for cmd in ['new', 'add', 'match', 'list', 'remove', 'merge', 'newmerge']:
+        args = parse([cmd, '--dbase', 'x.pklz', 'a.wav'])
+        assert args[cmd]
+        assert args['--dbase'] == 'x.pklz'
+
+
+def test_socket():
+    args = parse(['daemon', '--socket', '/tmp/afp.sock', '--dbase', 'x.pklz'])
+    assert args['daemon']
+    assert args['--socket'] == '/tmp/afp.sock'
+    args = parse(['match', '--socket', '/tmp/afp.sock', '--dbase', 'x.pklz',
+                  'q.wav'])
+    assert args['--socket'] == '/tmp/afp.sock'
+
+
+def test_daemon_command_long_options(tmp_path):
+    # As sent by "python -m utility.audfprint_daemon --socket s list ..."
+    import utility.audfprint_daemon as audfprint_daemon
+    import utility.hash_table as hash_table
+    dbase = str(tmp_path / 'x.pklz')
+    ht = hash_table.HashTable(hashbits=8, depth=4)
+    ht.store('a.wav', [[1, 2], [3, 4]])
+    ht.save(dbase)
+    path, argv = audfprint_daemon.split_socket_arg(
+        ['--socket', 's', 'list', '--dbase', dbase])
+    assert path == 's'
+    tables = audfprint_daemon.TableCache(hash_table.HashTable)
+    assert audfprint.daemon_command(tables, argv) == ['a.wav (2 hashes)']
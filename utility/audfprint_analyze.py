@@ -9,13 +9,14 @@ Class to do the analysis of wave files into hash constellations.
 
 from __future__ import division, print_function
 
+import concurrent.futures
+import hashlib
 import os
 import numpy as np
 
-import scipy.signal
-
 # For reading/writing hashes to file
 import struct
+import threading
 
 # For glob2hashtable, localtester
 import glob
@@ -24,6 +25,7 @@ import time
 import utility.audio_read as audio_read
 # For utility, glob2hashtable
 import utility.hash_table as hash_table
+import utility.profiling as profiling
 import utility.stft as stft
 
 # ############### Globals ############### #
@@ -31,6 +33,8 @@ import utility.stft as stft
 PRECOMPEXT = '.afpt'
 # A different precomputed fingerprint is just the peaks
 PRECOMPPKEXT = '.afpk'
+# Precomputed fingerprints for many tracks packed into one file
+PRECOMPPACKEXT = '.afpp'
 
 
 def locmax(vec, indices=False):
@@ -149,6 +153,14 @@ class Analyzer(object):
         self.soundfilecount = 0
         # Control behavior on file reading error
         self.fail_on_error = True
+        # Optional PeakCache of previously-analyzed soundfiles
+        self.peak_cache = None
+        # If not None, skip peak picking in frames this many dB below the
+        # loudest frame, when they last at least gate_min_dur seconds
+        self.gate_db = None
+        self.gate_min_dur = 1.0
+        # Threads for the STFT's FFTs (-1 for all cores, None for one)
+        self.fft_workers = -1
 
     def spreadpeaksinvector(self, vector, width=4.0):
         """ Create a blurred version of vector, where each of the local maxes
@@ -196,17 +208,29 @@ class Analyzer(object):
                                                        + npoints - pos])
         return vec
 
-    def _decaying_threshold_fwd_prune(self, sgram, a_dec):
+    def _decaying_threshold_fwd_prune(self, sgram, a_dec, sthresh=None):
         """ forward pass of findpeaks
-            initial threshold envelope based on peaks in first 10 frames
+            initial threshold envelope based on peaks in first 10 frames,
+            unless sthresh gives it (in which case it is updated in place
+            to the threshold after the last frame).
+            Returns parallel (cols, bins, vals) arrays of the peaks found,
+            in column order and, within each column, in descending order
+            of value.
         """
         (srows, scols) = np.shape(sgram)
-        sthresh = self.spreadpeaksinvector(
-            np.max(sgram[:, :np.minimum(10, scols)], axis=1), self.f_sd
-        )
+        if sthresh is None:
+            sthresh = self.spreadpeaksinvector(
+                np.max(sgram[:, :np.minimum(10, scols)], axis=1), self.f_sd
+            )
         # Store sthresh at each column, for debug
         # thr = np.zeros((srows, scols))
-        peaks = np.zeros((srows, scols))
+        # Only a few peaks per frame, so keep them as sparse lists of
+        # (col, bin, value) rather than as a mostly-zero matrix.
+        maxpeaks = scols * self.maxpksperframe
+        cols = np.zeros(maxpeaks, dtype=np.int32)
+        bins = np.zeros(maxpeaks, dtype=np.int32)
+        vals = np.zeros(maxpeaks)
+        npeaks = 0
         # optimization of mask update
         __sp_pts = len(sthresh)
         __sp_v = self.__sp_vals
@@ -223,34 +247,172 @@ class Analyzer(object):
                 # sthresh = spreadpeaks([(peakpos, s_col[peakpos])],
                 #                      base=sthresh, width=f_sd)
                 # Optimization - inline the core function within spreadpeaks
-                sthresh = np.maximum(sthresh,
-                                     val * __sp_v[(__sp_pts - peakpos):
-                                                  (2 * __sp_pts - peakpos)])
-                peaks[peakpos, col] = 1
+                np.maximum(sthresh,
+                           val * __sp_v[(__sp_pts - peakpos):
+                                        (2 * __sp_pts - peakpos)],
+                           out=sthresh)
+                cols[npeaks] = col
+                bins[npeaks] = peakpos
+                vals[npeaks] = val
+                npeaks += 1
             sthresh *= a_dec
-        return peaks
-
-    def _decaying_threshold_bwd_prune_peaks(self, sgram, peaks, a_dec):
-        """ backwards pass of findpeaks """
+        return cols[:npeaks], bins[:npeaks], vals[:npeaks]
+
+    def _decaying_threshold_bwd_prune_peaks(self, sgram, peaks, a_dec,
+                                            sthresh=None):
+        """ backwards pass of findpeaks
+            peaks is the (cols, bins, vals) from the forward pass;
+            returns the same arrays for just the peaks that survive.
+            The initial threshold is based on the last frame, unless
+            sthresh gives it (and is updated in place, as for the forward
+            pass).
+        """
+        cols, bins, vals = peaks
         scols = np.shape(sgram)[1]
+        keep = np.ones(len(cols), dtype=bool)
+        # Index range of the peaks in each column
+        colstarts = np.searchsorted(cols, np.arange(scols + 2))
         # Backwards filter to prune peaks
-        sthresh = self.spreadpeaksinvector(sgram[:, -1], self.f_sd)
-        for col in range(scols, 0, -1):
-            pkposs = np.nonzero(peaks[:, col - 1])[0]
-            peakvals = sgram[pkposs, col - 1]
-            for val, peakpos in sorted(zip(peakvals, pkposs), reverse=True):
+        if sthresh is None:
+            sthresh = self.spreadpeaksinvector(sgram[:, -1], self.f_sd)
+        # optimization of mask update (as in spreadpeaks)
+        __sp_pts = len(sthresh)
+        __sp_v = self.__sp_vals
+        for col in range(scols - 1, -1, -1):
+            # The forward pass left them in descending order of value
+            for ix in range(colstarts[col], colstarts[col + 1]):
+                val = vals[ix]
+                peakpos = bins[ix]
                 if val >= sthresh[peakpos]:
                     # Setup the threshold
-                    sthresh = self.spreadpeaks([(peakpos, val)], base=sthresh,
-                                               width=self.f_sd)
+                    np.maximum(sthresh,
+                               val * __sp_v[(__sp_pts - peakpos):
+                                            (2 * __sp_pts - peakpos)],
+                               out=sthresh)
                     # Delete any following peak (threshold should, but be sure)
-                    if col < scols:
-                        peaks[peakpos, col] = 0
+                    for nextix in range(colstarts[col + 1], colstarts[col + 2]):
+                        if bins[nextix] == peakpos:
+                            keep[nextix] = False
                 else:
                     # delete the peak
-                    peaks[peakpos, col - 1] = 0
-            sthresh = a_dec * sthresh
-        return peaks
+                    keep[ix] = False
+            sthresh *= a_dec
+        return cols[keep], bins[keep], vals[keep]
+
+    def _enhance_sgram(self, sgram):
+        """ Convert a magnitude spectrogram into the log-magnitude,
+            onset-enhanced version used for peak picking. """
+        sgrammax = np.max(sgram)
+        if sgrammax > 0.0:
+            sgram = np.log(np.maximum(sgram, np.max(sgram) / 1e6))
+            sgram = sgram - np.mean(sgram)
+        else:
+            # The sgram is identically zero, i.e., the input signal was identically
+            # zero.  Not good, but let's let it through for now.
+            print("find_peaks: Warning: input signal is identically zero.")
+        return self._hpf_sgram(sgram)
+
+    @staticmethod
+    def _hpf_sgram(sgram):
+        """ High-pass filter each row of a log spectrogram for onset emphasis """
+        # Imported here, so commands that don't analyze audio don't load it.
+        import scipy.signal
+        # [:-1,] discards top bin (nyquist) of sgram so bins fit in 8 bits
+        sgram = np.array([scipy.signal.lfilter([1, -1],
+                                               [1, -HPF_POLE ** (1 / OVERSAMP)], s_row)
+                          for s_row in sgram])[:-1, ]
+        return sgram
+
+    def _content_segments(self, d):
+        """ Find the runs of STFT frames worth analyzing when gating.
+            Frames more than gate_db below the loudest frame (or with no
+            energy at all) are quiet; runs of at least gate_min_dur seconds
+            of quiet frames are dropped.  Returns a list of (start, end)
+            frame ranges. """
+        energies = stft.frame_energies(d, self.n_fft, self.n_hop)
+        maxenergy = np.max(energies)
+        if maxenergy <= 0.0:
+            return []
+        loud = energies > maxenergy * 10.0 ** (-self.gate_db / 10.0)
+        # Boundaries of the runs of loud and quiet frames.
+        changes = np.nonzero(np.diff(loud.astype(np.int8)))[0] + 1
+        starts = np.r_[0, changes]
+        ends = np.r_[changes, len(loud)]
+        min_gap = max(1, int(round(self.gate_min_dur * self.target_sr
+                                   / self.n_hop)))
+        segments = []
+        for start, end in zip(starts, ends):
+            if not loud[start] and end - start >= min_gap:
+                # A long enough quiet run: gate it.
+                continue
+            if segments and segments[-1][1] == start:
+                # Short quiet runs stay part of the surrounding content.
+                segments[-1] = (segments[-1][0], int(end))
+            else:
+                segments.append((int(start), int(end)))
+        # Don't keep segments that are entirely quiet.
+        return [(start, end) for start, end in segments
+                if np.any(loud[start:end])]
+
+    def _gated_peaks(self, d, window):
+        """ find_peaks for signals with gated (silent) stretches.  The whole
+            spectrogram is normalized and high-pass filtered as usual, but
+            the peak-picking passes only visit the content segments; their
+            decaying thresholds just decay across each gap, so the content
+            gets the same peaks as without gating. """
+        segments = self._content_segments(d)
+        if not segments:
+            return np.zeros((0, 2), dtype=np.int32)
+        sgram = self._enhance_sgram(stft.stft(
+            d, n_fft=self.n_fft, hop_length=self.n_hop, window=window,
+            magnitude=True, workers=self.fft_workers))
+        a_dec = self._decay_constant()
+        scols = sgram.shape[1]
+        # Forward pass, from the threshold of the first frames.
+        sthresh = self.spreadpeaksinvector(
+            np.max(sgram[:, :np.minimum(10, scols)], axis=1), self.f_sd)
+        peaks = []
+        col = 0
+        for start, end in segments:
+            for _ in range(col, start):
+                sthresh *= a_dec
+            peaks.append(self._decaying_threshold_fwd_prune(
+                sgram[:, start:end], a_dec, sthresh))
+            col = end
+        # Backward pass, from the threshold of the last frame.
+        sthresh = self.spreadpeaksinvector(sgram[:, -1], self.f_sd)
+        pklists = []
+        col = scols
+        for (start, end), segpeaks in reversed(list(zip(segments, peaks))):
+            for _ in range(end, col):
+                sthresh *= a_dec
+            cols, bins, _ = self._decaying_threshold_bwd_prune_peaks(
+                sgram[:, start:end], segpeaks, a_dec, sthresh)
+            order = np.lexsort((bins, cols))
+            pklists.append(np.column_stack([cols[order] + start,
+                                            bins[order]]))
+            col = start
+        return np.concatenate(pklists[::-1])
+
+    def _decay_constant(self):
+        """ Per-frame decay of the masking envelope (threshold) """
+        return (1 - 0.01 * (self.density * np.sqrt(self.n_hop / 352.8) / 35)) ** (1 / OVERSAMP)
+
+    def _sgram2peaks(self, sgram):
+        """ Pick the landmark peaks out of an enhanced spectrogram as
+            returned by _enhance_sgram.  Returns an np.array of (col, bin)
+            rows. """
+        a_dec = self._decay_constant()
+        # Prune to keep only local maxima in spectrum that appear above an online,
+        # decaying threshold
+        peaks = self._decaying_threshold_fwd_prune(sgram, a_dec)
+        # Further prune these peaks working backwards in time, to remove small peaks
+        # that are closely followed by a large peak
+        cols, bins, _ = self._decaying_threshold_bwd_prune_peaks(sgram, peaks,
+                                                                 a_dec)
+        # (col, bin) rows of the peaks we ended up with, sorted by col then bin
+        order = np.lexsort((bins, cols))
+        return np.column_stack([cols[order], bins[order]])
 
     def find_peaks(self, d, sr):
         """ Find the local peaks in the spectrogram as basis for fingerprints.
@@ -264,49 +426,32 @@ class Analyzer(object):
             Sampling rate of d (not used)
 
         :returns:
-          pklist - list of (int, int)
+          pklist - np.array of (int, int) rows
             Ordered list of landmark peaks found in STFT.  First value of
             each pair is the time index (in STFT frames, i.e., units of
             n_hop/sr secs), second is the FFT bin (in units of sr/n_fft
             Hz).
         """
         if len(d) == 0:
-            return []
+            return np.zeros((0, 2), dtype=np.int32)
 
-        # masking envelope decay constant
-        a_dec = (1 - 0.01 * (self.density * np.sqrt(self.n_hop / 352.8) / 35)) ** (1 / OVERSAMP)
         # Take spectrogram
         mywin = np.hanning(self.n_fft + 2)[1:-1]
-        sgram = np.abs(stft.stft(d, n_fft=self.n_fft,
-                                 hop_length=self.n_hop,
-                                 window=mywin))
-        sgrammax = np.max(sgram)
-        if sgrammax > 0.0:
-            sgram = np.log(np.maximum(sgram, np.max(sgram) / 1e6))
-            sgram = sgram - np.mean(sgram)
-        else:
-            # The sgram is identically zero, i.e., the input signal was identically
-            # zero.  Not good, but let's let it through for now.
-            print("find_peaks: Warning: input signal is identically zero.")
-        # High-pass filter onset emphasis
-        # [:-1,] discards top bin (nyquist) of sgram so bins fit in 8 bits
-        sgram = np.array([scipy.signal.lfilter([1, -1],
-                                               [1, -HPF_POLE ** (1 / OVERSAMP)], s_row)
-                          for s_row in sgram])[:-1, ]
-        # Prune to keep only local maxima in spectrum that appear above an online,
-        # decaying threshold
-        peaks = self._decaying_threshold_fwd_prune(sgram, a_dec)
-        # Further prune these peaks working backwards in time, to remove small peaks
-        # that are closely followed by a large peak
-        peaks = self._decaying_threshold_bwd_prune_peaks(sgram, peaks, a_dec)
-        # build a list of peaks we ended up with
-        scols = np.shape(sgram)[1]
-        pklist = []
-        for col in range(scols):
-            for bin_ in np.nonzero(peaks[:, col])[0]:
-                pklist.append((col, bin_))
-        return pklist
+        if self.gate_db is not None:
+            with profiling.timer('analyze.peaks'):
+                peaks = self._gated_peaks(d, mywin)
+            profiling.count('peaks', len(peaks))
+            return peaks
+        with profiling.timer('analyze.stft'):
+            sgram = stft.stft(d, n_fft=self.n_fft, hop_length=self.n_hop,
+                              window=mywin, magnitude=True,
+                              workers=self.fft_workers)
+        with profiling.timer('analyze.peaks'):
+            peaks = self._sgram2peaks(self._enhance_sgram(sgram))
+        profiling.count('peaks', len(peaks))
+        return peaks
 
+    @profiling.timed('analyze.landmarks')
     def peaks2landmarks(self, pklist):
         """ Take a list of local peaks in spectrogram
             and form them into pairs as landmarks.
@@ -317,12 +462,14 @@ class Analyzer(object):
         # Form pairs of peaks into landmarks
         landmarks = []
         if len(pklist) > 0:
+            pklist = np.asarray(pklist)
             # Find column of the final peak in the list
-            scols = pklist[-1][0] + 1
+            scols = int(pklist[-1, 0]) + 1
             # Convert (col, bin) list into peaks_at[col] lists
-            peaks_at = [[] for _ in range(scols)]
-            for (col, bin_) in pklist:
-                peaks_at[col].append(bin_)
+            colstarts = np.searchsorted(pklist[:, 0], np.arange(scols + 1))
+            bins = pklist[:, 1].tolist()
+            peaks_at = [bins[colstarts[col]:colstarts[col + 1]]
+                        for col in range(scols)]
 
             # Build list of landmarks <starttime F1 endtime F2>
             for col in range(scols):
@@ -340,6 +487,7 @@ class Analyzer(object):
                                                           peak2, col2 - col))
                                         pairsthispeak += 1
 
+        profiling.count('landmarks', len(landmarks))
         return landmarks
 
     def wavfile2peaks(self, filename, shifts=None):
@@ -353,34 +501,80 @@ class Analyzer(object):
             peaks = peaks_load(filename)
             dur = np.max(peaks, axis=0)[0] * self.n_hop / self.target_sr
         else:
-            try:
-                # [d, sr] = librosa.load(filename, sr=self.target_sr)
-                d, sr = audio_read.audio_read(filename, sr=self.target_sr, channels=1)
-            except Exception as e:  # audioread.NoBackendError:
-                message = "wavfile2peaks: Error reading " + filename
-                if self.fail_on_error:
-                    print(e)
-                    raise IOError(message)
-                print(message, "skipping")
-                d = []
-                sr = self.target_sr
-            # Store duration in a global because it's hard to handle
-            dur = len(d) / sr
             if shifts is None or shifts < 2:
-                peaks = self.find_peaks(d, sr)
+                offsets = [0]
             else:
                 # Calculate hashes with optional part-frame shifts
-                peaklists = []
-                for shift in range(shifts):
-                    shiftsamps = int(shift / self.shifts * self.n_hop)
-                    peaklists.append(self.find_peaks(d[shiftsamps:], sr))
+                offsets = [int(shift / self.shifts * self.n_hop)
+                           for shift in range(shifts)]
+            peaklists, dur = self._peaks_at_offsets(filename, offsets)
+            if len(offsets) == 1:
+                peaks = peaklists[0]
+            else:
                 peaks = peaklists
 
-        # instrumentation to track total amount of sound processed
+        self._count_soundfile(dur)
+        return peaks
+
+    def _peaks_at_offsets(self, filename, offsets):
+        """ Find the peaks of a soundfile starting at each of several sample
+            offsets, taking them from peak_cache where possible.
+            Returns the list of peak lists and the duration of the file. """
+        peaklists = [None] * len(offsets)
+        nsamples = 0
+        sr = self.target_sr
+        if self.peak_cache is not None:
+            digest = file_digest(filename)
+            keys = [self.peak_cache.key(digest, self, offset)
+                    for offset in offsets]
+            for ix, key in enumerate(keys):
+                entry = self.peak_cache.get(key)
+                if entry is not None:
+                    peaklists[ix], nsamples, sr = entry
+        if any(peaks is None for peaks in peaklists):
+            # Cache misses (or no cache): decode and analyze.
+            d, sr = self._read_audio(filename)
+            nsamples = len(d)
+            for ix, offset in enumerate(offsets):
+                if peaklists[ix] is None:
+                    peaklists[ix] = self.find_peaks(d[offset:], sr)
+                    # Don't remember failed reads.
+                    if self.peak_cache is not None and nsamples:
+                        self.peak_cache.put(keys[ix], peaklists[ix],
+                                            nsamples, sr)
+        return peaklists, nsamples / sr
+
+    def _read_audio(self, filename):
+        """ Read a soundfile as mono at target_sr, honoring fail_on_error.
+            Returns (d, sr); d is empty if the file could not be read. """
+        try:
+            # [d, sr] = librosa.load(filename, sr=self.target_sr)
+            with profiling.timer('analyze.decode'):
+                d, sr = audio_read.audio_read(filename, sr=self.target_sr,
+                                              channels=1)
+        except Exception as e:  # audioread.NoBackendError:
+            message = "wavfile2peaks: Error reading " + filename
+            if self.fail_on_error:
+                print(e)
+                raise IOError(message)
+            print(message, "skipping")
+            d = []
+            sr = self.target_sr
+        return d, sr
+
+    def _count_precomputed(self, hashes):
+        """ Track the duration implied by a set of precomputed hashes """
+        if len(hashes):
+            dur = np.max(hashes, axis=0)[0] * self.n_hop / self.target_sr
+        else:
+            dur = 0.0
+        self._count_soundfile(dur)
+
+    def _count_soundfile(self, dur):
+        """ instrumentation to track total amount of sound processed """
         self.soundfiledur = dur
         self.soundfiletotaldur += dur
         self.soundfilecount += 1
-        return peaks
 
     def wavfile2hashes(self, filename):
         """ Read a soundfile and return its fingerprint hashes as a
@@ -388,43 +582,110 @@ class Analyzer(object):
             shifts > 1 causes hashes to be extracted from multiple shifts of
             waveform, to reduce frame effects.  """
         ext = os.path.splitext(filename)[1]
-        if ext == PRECOMPEXT:
-            # short-circuit - precomputed fingerprint file
-            hashes = hashes_load(filename)
-            dur = np.max(hashes, axis=0)[0] * self.n_hop / self.target_sr
-            # instrumentation to track total amount of sound processed
-            self.soundfiledur = dur
-            self.soundfiletotaldur += dur
-            self.soundfilecount += 1
+        packfilename, trackname = split_packname(filename)
+        if ext == PRECOMPEXT or packfilename is not None:
+            # short-circuit - precomputed fingerprint file or pack member
+            if packfilename is not None:
+                hashes = open_pack(packfilename)[trackname]
+            else:
+                hashes = hashes_load(filename)
+            self._count_precomputed(hashes)
         else:
             peaks = self.wavfile2peaks(filename, self.shifts)
-            if len(peaks) == 0:
-                return []
-            # Did we get returned a list of lists of peaks due to shift?
-            if isinstance(peaks[0], list):
-                peaklists = peaks
-                query_hashes = []
-                for peaklist in peaklists:
-                    query_hashes.append(landmarks2hashes(
-                        self.peaks2landmarks(peaklist)))
-                query_hashes = np.concatenate(query_hashes)
-            else:
-                query_hashes = landmarks2hashes(self.peaks2landmarks(peaks))
-
-            # Remove duplicates by merging each row into a single value.
-            hashes_hashes = (((query_hashes[:, 0].astype(np.uint64)) << 32)
-                             + query_hashes[:, 1].astype(np.uint64))
-            unique_hash_hash = np.sort(np.unique(hashes_hashes))
-            unique_hashes = np.hstack([
-                (unique_hash_hash >> 32)[:, np.newaxis],
-                (unique_hash_hash & ((1 << 32) - 1))[:, np.newaxis]
-            ]).astype(np.int32)
-            hashes = unique_hashes
-            # Or simply np.unique(query_hashes, axis=0) for numpy >= 1.13
+            hashes = self._peaks2hashes(peaks)
 
         # print("wavfile2hashes: read", len(hashes), "hashes from", filename)
         return hashes
 
+    def _peaks2hashes(self, peaks):
+        """ Convert a peak list, or a list of peak lists (one per shift),
+            into the sorted, de-duplicated array of (time, hash) rows. """
+        if len(peaks) == 0:
+            return []
+        # Did we get returned a list of lists of peaks due to shift?
+        if isinstance(peaks, list) and isinstance(peaks[0], (list, np.ndarray)):
+            peaklists = peaks
+            query_hashes = []
+            for peaklist in peaklists:
+                query_hashes.append(landmarks2hashes(
+                    self.peaks2landmarks(peaklist)))
+            query_hashes = np.concatenate(query_hashes)
+        else:
+            query_hashes = landmarks2hashes(self.peaks2landmarks(peaks))
+
+        # Remove duplicates by merging each row into a single value.
+        hashes_hashes = (((query_hashes[:, 0].astype(np.uint64)) << 32)
+                         + query_hashes[:, 1].astype(np.uint64))
+        unique_hash_hash = np.sort(np.unique(hashes_hashes))
+        unique_hashes = np.hstack([
+            (unique_hash_hash >> 32)[:, np.newaxis],
+            (unique_hash_hash & ((1 << 32) - 1))[:, np.newaxis]
+        ]).astype(np.int32)
+        # Or simply np.unique(query_hashes, axis=0) for numpy >= 1.13
+        return unique_hashes
+
+    def wavfiles2hashes(self, filenames, nthreads=1):
+        """ Fingerprint a batch of soundfiles, as wavfile2hashes would.
+            The STFT frames of every clip (and every shift) are stacked into
+            a single rfft call, which is much cheaper than one call per file
+            for short clips; peak picking then runs clip by clip.
+        :params:
+          filenames : list of str
+            soundfiles (or precomputed .afpt/.afpk files or pack members) to
+            analyze
+          nthreads : int
+            if > 1, decode the soundfiles concurrently in a thread pool
+        :returns:
+          hashlist : list of np.array
+            the (time, hash) rows for each file, in input order
+        """
+        filenames = list(filenames)
+        hashlist = [None] * len(filenames)
+        audiofiles = []
+        for ix, filename in enumerate(filenames):
+            if (os.path.splitext(filename)[1] in [PRECOMPEXT, PRECOMPPKEXT]
+                    or split_packname(filename)[0] is not None
+                    or self.peak_cache is not None
+                    or self.gate_db is not None):
+                # Precomputed hashes (or cached or gated peaks) don't go
+                # through the batched STFT.
+                hashlist[ix] = self.wavfile2hashes(filename)
+            else:
+                audiofiles.append(ix)
+        # Decode the soundfiles, possibly in parallel (ffmpeg does the work).
+        if nthreads > 1:
+            with concurrent.futures.ThreadPoolExecutor(nthreads) as executor:
+                audio = list(executor.map(self._read_audio,
+                                          [filenames[ix] for ix in audiofiles]))
+        else:
+            audio = [self._read_audio(filenames[ix]) for ix in audiofiles]
+        # Gather the signal for every non-empty (clip, shift) pair.
+        nshifts = max(1, self.shifts)
+        signals = []
+        for d, sr in audio:
+            if len(d):
+                for shift in range(nshifts):
+                    shiftsamps = int(shift / nshifts * self.n_hop)
+                    signals.append(d[shiftsamps:])
+        # One big FFT over all the frames.
+        mywin = np.hanning(self.n_fft + 2)[1:-1]
+        sgrams = stft.stft_batch(signals, n_fft=self.n_fft,
+                                 hop_length=self.n_hop, window=mywin,
+                                 workers=self.fft_workers)
+        sgramix = 0
+        for ix, (d, sr) in zip(audiofiles, audio):
+            if not len(d):
+                peaks = [[] for _ in range(nshifts)]
+            else:
+                peaks = [self._sgram2peaks(self._enhance_sgram(np.abs(sgram)))
+                         for sgram in sgrams[sgramix:sgramix + nshifts]]
+                sgramix += nshifts
+            if nshifts == 1:
+                peaks = peaks[0]
+            self._count_soundfile(len(d) / sr)
+            hashlist[ix] = self._peaks2hashes(peaks)
+        return hashlist
+
     # ########## functions to link to actual hash table index database ###### #
 
     def ingest(self, hashtable, filename):
@@ -433,10 +694,11 @@ class Analyzer(object):
           hashtable : HashTable object
             the hash table to add to
           filename : str
-            name of the soundfile to add
+            name of the soundfile to add, or of a pack file whose
+            tracks are all added
         :returns:
           dur : float
-            the duration of the track
+            the duration of the track (or all the tracks)
           nhashes : int
             the number of hashes it mapped into
         """
@@ -449,12 +711,28 @@ class Analyzer(object):
         #                                                     density=density,
         #                                                     n_fft=n_fft,
         #                                                     n_hop=n_hop)))
-        hashes = self.wavfile2hashes(filename)
-        hashtable.store(filename, hashes)
-        # return (len(d)/float(sr), len(hashes))
-        # return (np.max(hashes, axis=0)[0]*n_hop/float(sr), len(hashes))
-        # soundfiledur is set up in wavfile2hashes, use result here
-        return self.soundfiledur, len(hashes)
+        dur = 0.0
+        nhashes = 0
+        for trackname, hashes, trackdur in self.file_tracks(filename):
+            hashtable.store(trackname, hashes)
+            dur += trackdur
+            nhashes += len(hashes)
+        return dur, nhashes
+
+    def file_tracks(self, filename):
+        """ Generate the (name, hashes, duration) of each track that adding
+            filename to a database stores: just the file itself, unless it
+            is a pack, whose tracks are all stored under their own names """
+        if os.path.splitext(filename)[1] == PRECOMPPACKEXT:
+            pack = open_pack(filename)
+            for trackname in pack:
+                hashes = pack[trackname]
+                self._count_precomputed(hashes)
+                yield trackname, hashes, self.soundfiledur
+        else:
+            hashes = self.wavfile2hashes(filename)
+            # soundfiledur is set up in wavfile2hashes, use result here
+            yield filename, hashes, self.soundfiledur
 
 
 # ########## functions to read/write hashes to file for a single track #### #
@@ -464,54 +742,283 @@ HASH_FMT = '<2i'
 HASH_MAGIC = b'audfprinthashV00'  # 16 chars, FWIW
 PEAK_FMT = '<2i'
 PEAK_MAGIC = b'audfprintpeakV00'  # 16 chars, FWIW
+# numpy equivalent of the row formats, for bulk reads and writes
+ROW_DTYPE = np.dtype('<i4')
+
+
+def _rows_save(filename, magic, rows):
+    """ Write a magic string followed by (int, int) rows as 32 bit ints """
+    with open(filename, 'wb') as f:
+        f.write(magic)
+        np.asarray(rows, dtype=ROW_DTYPE).reshape(-1, 2).tofile(f)
+
+
+def _rows_load(filename, magic, kind):
+    """ Read back an (N, 2) int32 array of rows written by _rows_save """
+    with open(filename, 'rb') as f:
+        filemagic = f.read(len(magic))
+        if filemagic != magic:
+            raise IOError('%s is not a %s file (magic %s)'
+                          % (filename, kind, filemagic))
+        data = np.fromfile(f, dtype=ROW_DTYPE)
+    # Ignore any partial row at the end, as the struct reader did.
+    nrows = len(data) // 2
+    return data[:2 * nrows].reshape(nrows, 2).astype(np.int32)
 
 
 def hashes_save(hashfilename, hashes):
     """ Write out a list of (time, hash) pairs as 32 bit ints """
-    with open(hashfilename, 'wb') as f:
-        f.write(HASH_MAGIC)
-        for time_, hash_ in hashes:
-            f.write(struct.pack(HASH_FMT, time_, hash_))
+    _rows_save(hashfilename, HASH_MAGIC, hashes)
 
 
 def hashes_load(hashfilename):
     """ Read back a set of hashes written by hashes_save """
-    hashes = []
-    fmtsize = struct.calcsize(HASH_FMT)
-    with open(hashfilename, 'rb') as f:
-        magic = f.read(len(HASH_MAGIC))
-        if magic != HASH_MAGIC:
-            raise IOError('%s is not a hash file (magic %s)'
-                          % (hashfilename, magic))
-        data = f.read(fmtsize)
-        while data is not None and len(data) == fmtsize:
-            hashes.append(struct.unpack(HASH_FMT, data))
-            data = f.read(fmtsize)
-    return hashes
+    return _rows_load(hashfilename, HASH_MAGIC, 'hash')
 
 
 def peaks_save(peakfilename, peaks):
     """ Write out a list of (time, bin) pairs as 32 bit ints """
-    with open(peakfilename, 'wb') as f:
-        f.write(PEAK_MAGIC)
-        for time_, bin_ in peaks:
-            f.write(struct.pack(PEAK_FMT, time_, bin_))
+    _rows_save(peakfilename, PEAK_MAGIC, peaks)
 
 
 def peaks_load(peakfilename):
     """ Read back a set of (time, bin) pairs written by peaks_save """
-    peaks = []
-    fmtsize = struct.calcsize(PEAK_FMT)
-    with open(peakfilename, 'rb') as f:
-        magic = f.read(len(PEAK_MAGIC))
-        if magic != PEAK_MAGIC:
-            raise IOError('%s is not a peak file (magic %s)'
-                          % (peakfilename, magic))
-        data = f.read(fmtsize)
-        while data is not None and len(data) == fmtsize:
-            peaks.append(struct.unpack(PEAK_FMT, data))
-            data = f.read(fmtsize)
-    return peaks
+    return _rows_load(peakfilename, PEAK_MAGIC, 'peak')
+
+
+# ########## packed archive holding the hashes of many tracks ############ #
+
+# Layout: PACK_MAGIC, then PACK_HEADER_FMT giving (ntracks, index_offset),
+# then all the (time, hash) rows back to back starting at PACK_DATA_OFFSET,
+# then the index: ntracks (start_row, nrows) pairs as PACK_INDEX_FMT,
+# followed by the utf-8 track names, one per line.
+PACK_MAGIC = b'audfprintpackV00'  # 16 chars, FWIW
+PACK_HEADER_FMT = '<2q'
+PACK_INDEX_FMT = '<2q'
+PACK_DATA_OFFSET = len(PACK_MAGIC) + struct.calcsize(PACK_HEADER_FMT)
+# Separator between pack file name and track name, e.g. "cat.afpp#ad1.mp3"
+PACK_SEP = '#'
+
+
+class HashPackWriter(object):
+    """ Write the hashes for many tracks into a single pack file.
+
+    :usage:
+       >>> with HashPackWriter('catalog.afpp') as pack:
+       ...     pack.add('ad1.mp3', hashes)
+    """
+
+    def __init__(self, packfilename):
+        self.packfilename = packfilename
+        self.f = open(packfilename, 'wb')
+        self.f.write(PACK_MAGIC)
+        # Header is filled in by close()
+        self.f.write(struct.pack(PACK_HEADER_FMT, 0, 0))
+        self.names = []
+        self.extents = []
+        self.nrows = 0
+
+    def add(self, name, hashes):
+        """ Append the (time, hash) rows for one track """
+        if '\n' in name:
+            raise ValueError("pack track names cannot contain newlines")
+        rows = np.asarray(hashes, dtype=ROW_DTYPE).reshape(-1, 2)
+        rows.tofile(self.f)
+        self.names.append(name)
+        self.extents.append((self.nrows, len(rows)))
+        self.nrows += len(rows)
+
+    def close(self):
+        """ Write the index and header, and close the file """
+        if self.f is None:
+            return
+        index_offset = self.f.tell()
+        for start, nrows in self.extents:
+            self.f.write(struct.pack(PACK_INDEX_FMT, start, nrows))
+        self.f.write('\n'.join(self.names).encode('utf-8'))
+        self.f.seek(len(PACK_MAGIC))
+        self.f.write(struct.pack(PACK_HEADER_FMT, len(self.names),
+                                 index_offset))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class HashPack(object):
+    """ Read-only access to a pack file written by HashPackWriter.
+        The hash rows are memory-mapped, so opening even a very large
+        pack only reads its index. """
+
+    def __init__(self, packfilename):
+        self.packfilename = packfilename
+        indexsize = struct.calcsize(PACK_INDEX_FMT)
+        with open(packfilename, 'rb') as f:
+            magic = f.read(len(PACK_MAGIC))
+            if magic != PACK_MAGIC:
+                raise IOError('%s is not a hash pack file (magic %s)'
+                              % (packfilename, magic))
+            ntracks, index_offset = struct.unpack(
+                PACK_HEADER_FMT, f.read(struct.calcsize(PACK_HEADER_FMT)))
+            f.seek(index_offset)
+            self.extents = np.frombuffer(
+                f.read(ntracks * indexsize), dtype='<i8').reshape(ntracks, 2)
+            names = f.read().decode('utf-8')
+        self.names = names.split('\n') if ntracks else []
+        self.index = dict((name, ix) for ix, name in enumerate(self.names))
+        totalrows = (index_offset - PACK_DATA_OFFSET) // ROW_DTYPE.itemsize // 2
+        if totalrows > 0:
+            self.data = np.memmap(packfilename, dtype=ROW_DTYPE, mode='r',
+                                  offset=PACK_DATA_OFFSET,
+                                  shape=(totalrows, 2))
+        else:
+            self.data = np.zeros((0, 2), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        """ Return the (time, hash) rows of a track, by name or number.
+            They are a copy, so they stay valid after close(). """
+        if self.data is None:
+            raise IOError(self.packfilename + " has been closed")
+        if not isinstance(name, (int, np.integer)):
+            if name not in self.index:
+                raise KeyError("track " + name + " not found in "
+                               + self.packfilename)
+            name = self.index[name]
+        start, nrows = self.extents[name]
+        return np.array(self.data[start:start + nrows])
+
+    def close(self):
+        """ Release the memory map """
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Packs opened by wavfile2hashes, so repeated member reads share one mmap:
+# realpath -> (file stamp, HashPack).
+_open_packs = {}
+_open_packs_lock = threading.Lock()
+
+
+def _file_stamp(filename):
+    """ Identify the current version of a file """
+    stat = os.stat(filename)
+    return stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def open_pack(packfilename):
+    """ Return a (cached) HashPack for packfilename, reopened if the file
+        has been rewritten since it was cached """
+    key = os.path.realpath(packfilename)
+    stamp = _file_stamp(key)
+    with _open_packs_lock:
+        stamp_pack = _open_packs.get(key)
+        if stamp_pack is not None and stamp_pack[0] != stamp:
+            stamp_pack[1].close()
+            stamp_pack = None
+        if stamp_pack is None:
+            stamp_pack = (stamp, HashPack(packfilename))
+            _open_packs[key] = stamp_pack
+        return stamp_pack[1]
+
+
+def split_packname(filename):
+    """ Split "pack.afpp#track" into ("pack.afpp", "track").
+        Returns (None, None) if filename does not name a pack member. """
+    marker = PRECOMPPACKEXT + PACK_SEP
+    pos = filename.find(marker)
+    if pos < 0:
+        return None, None
+    split = pos + len(PRECOMPPACKEXT)
+    return filename[:split], filename[split + len(PACK_SEP):]
+
+
+# ########## cache of peaks, reusable across hash/landmark settings ####### #
+
+# Bump when a change to the peak picking makes earlier cache entries stale.
+PEAK_CACHE_VERSION = 1
+
+
+def file_digest(filename, blocksize=1 << 20):
+    """ Return the hex SHA-1 digest of a file's contents """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+    return sha.hexdigest()
+
+
+class PeakCache(object):
+    """ Directory of previously-found spectral peaks.
+
+    Peaks depend only on the audio and a handful of analysis parameters,
+    so entries are keyed by the file content digest plus those parameters
+    (and the sample offset of the shift).  Changing the fanout or hash
+    layout then only needs peaks2landmarks to be rerun.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    @staticmethod
+    def key(digest, analyzer, offset):
+        """ Key for the peaks of file <digest> starting at sample <offset> """
+        params = (PEAK_CACHE_VERSION, digest, analyzer.target_sr,
+                  analyzer.n_fft, analyzer.n_hop, float(analyzer.density),
+                  float(analyzer.f_sd), analyzer.maxpksperframe, offset)
+        if analyzer.gate_db is not None:
+            params += (float(analyzer.gate_db), float(analyzer.gate_min_dur))
+        return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.npz')
+
+    def get(self, key):
+        """ Return (peaks, nsamples, sr) for key, or None if not cached """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as entry:
+                return (entry['peaks'], int(entry['nsamples']),
+                        int(entry['sr']))
+        except (IOError, ValueError, KeyError):
+            # A damaged entry is just a miss; it will be rewritten.
+            return None
+
+    def put(self, key, peaks, nsamples, sr):
+        """ Store the peaks found in a file of nsamples at rate sr """
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another process may have created it already.
+                pass
+        peaks = np.asarray(peaks, dtype=np.int32).reshape(-1, 2)
+        # Write then rename, so concurrent readers never see a partial file.
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            np.savez(f, peaks=peaks, nsamples=nsamples, sr=sr)
+        os.replace(tmppath, path)
 
 
 # ####### function signature for Gordon feature extraction
@@ -0,0 +1,325 @@
+# coding=utf-8
+"""
+audfprint_bench.py
+
+Reproducible benchmark of the fingerprinter.  A deterministic corpus of
+synthetic audio (tone melodies, filtered noise, chirps and mixtures of
+them) is written to a scratch directory, indexed, saved and reloaded, and
+then queried with noisy excerpts.  The time spent in each stage is
+recorded, and the results can be written as JSON to compare runs (e.g.
+before and after a change, or on two kinds of server).
+"""
+from __future__ import division, print_function
+
+import collections
+import contextlib
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.io.wavfile
+import scipy.signal
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows.
+    resource = None
+
+import utility.audio_read as audio_read
+import utility.hash_table as hash_table
+import utility.stft as stft
+
+# Bump when a change makes results incomparable with earlier runs.
+BENCH_VERSION = 1
+
+# The kinds of synthetic reference item, used in turn.
+KINDS = ['tones', 'noise', 'chirps', 'mix']
+
+
+def _segments(dur, sr, rng, shortest=0.1, longest=0.5):
+    """ Split dur seconds at sr into random-length (start, end) samples """
+    bounds = [0]
+    while bounds[-1] < int(dur * sr):
+        bounds.append(bounds[-1] + int(rng.uniform(shortest, longest) * sr))
+    bounds[-1] = int(dur * sr)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _envelope(n, sr):
+    """ A 10 ms attack and exponential decay over n samples """
+    t = np.arange(n) / sr
+    return np.minimum(1.0, t / 0.01) * np.exp(-3.0 * t / max(t[-1], 1e-3))
+
+
+def synthetic_audio(kind, dur, sr, rng):
+    """ dur seconds of one kind of synthetic audio at sr, drawn from rng """
+    d = np.zeros(int(dur * sr))
+    if kind == 'tones':
+        # A melody of notes with a few harmonics.
+        for start, end in _segments(dur, sr, rng):
+            t = np.arange(end - start) / sr
+            f0 = 110.0 * 2 ** (rng.randint(0, 48) / 12.0)
+            note = sum(np.sin(2 * np.pi * f0 * harmonic * t) / harmonic
+                       for harmonic in range(1, rng.randint(2, 5)))
+            d[start:end] = note * _envelope(end - start, sr)
+    elif kind == 'noise':
+        # Bursts of band-pass noise.
+        for start, end in _segments(dur, sr, rng, 0.2, 1.0):
+            low = rng.uniform(0.02, 0.6)
+            b, a = scipy.signal.butter(2, [low, low * rng.uniform(1.1, 1.6)],
+                                       btype='band')
+            d[start:end] = (scipy.signal.lfilter(b, a,
+                                                 rng.randn(end - start))
+                            * _envelope(end - start, sr))
+    elif kind == 'chirps':
+        # Rising and falling sweeps.
+        for start, end in _segments(dur, sr, rng, 0.2, 0.8):
+            t = np.arange(end - start) / sr
+            d[start:end] = (scipy.signal.chirp(t, rng.uniform(100, 4000),
+                                               t[-1], rng.uniform(100, 4000),
+                                               method=['linear', 'logarithmic']
+                                               [rng.randint(0, 2)])
+                            * _envelope(end - start, sr))
+    else:
+        # A mixture of the other kinds.
+        for other in KINDS[:-1]:
+            d += rng.uniform(0.3, 1.0) * synthetic_audio(other, dur, sr, rng)
+    return d / max(1e-9, np.max(np.abs(d)))
+
+
+def _write_wav(filename, d, sr):
+    """ Write d (in -1..1) as a 16 bit wav file """
+    scipy.io.wavfile.write(filename, sr, (d * 32000).astype(np.int16))
+
+
+def make_corpus(dirname, nrefs, dur, nqueries, qdur, sr, seed=0, snr_db=10.0):
+    """ Write nrefs reference files of dur sec, and nqueries excerpts of
+        qdur sec taken from them with noise at snr_db.
+        Returns the list of reference files, and the list of
+        (query file, reference file) pairs. """
+    rng = np.random.RandomState(seed)
+    refs = []
+    audio = []
+    for ix in range(nrefs):
+        d = synthetic_audio(KINDS[ix % len(KINDS)], dur, sr, rng)
+        filename = os.path.join(dirname, 'ref%04d.wav' % ix)
+        _write_wav(filename, d, sr)
+        refs.append(filename)
+        audio.append(d)
+    queries = []
+    for ix in range(nqueries):
+        ref = rng.randint(0, nrefs)
+        start = rng.randint(0, max(1, len(audio[ref]) - int(qdur * sr)))
+        d = audio[ref][start:start + int(qdur * sr)]
+        noise = rng.randn(len(d)) * np.sqrt(np.mean(d ** 2)
+                                            / 10 ** (snr_db / 10))
+        filename = os.path.join(dirname, 'qry%04d.wav' % ix)
+        _write_wav(filename, 0.5 * (d + noise) / max(1e-9, np.max(
+            np.abs(d + noise))), sr)
+        queries.append((filename, refs[ref]))
+    return refs, queries
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process so far, in MB (or None) """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes.
+    return maxrss / (1 << 20) if sys.platform == 'darwin' else maxrss / 1024
+
+
+class Bench(object):
+    """ Time each stage of indexing and matching a synthetic corpus.
+
+    :usage:
+       >>> results = Bench(analyzer, matcher).run(nrefs=20, nqueries=20)
+       >>> print("\\n".join(format_bench(results)))
+    """
+
+    def __init__(self, analyzer, matcher, hashbits=20, depth=100,
+                 maxtime=16384):
+        self.analyzer = analyzer
+        self.matcher = matcher
+        self.hashbits = hashbits
+        self.depth = depth
+        self.maxtime = maxtime
+        # Seconds spent in each stage.
+        self.seconds = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        """ Add the time spent in the body to stage <name> """
+        tick = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] = (self.seconds.get(name, 0.0)
+                                  + time.time() - tick)
+
+    def _hashes(self, prefix, filename, shifts):
+        """ Analyze one file as wavfile2hashes does, timing each stage.
+            Returns the hashes and the duration of the file in sec. """
+        analyzer = self.analyzer
+        with self._stage(prefix + 'decode'):
+            d, sr = audio_read.audio_read(filename, sr=analyzer.target_sr,
+                                          channels=1)
+        offsets = [0] if shifts < 2 else [int(shift / shifts * analyzer.n_hop)
+                                          for shift in range(shifts)]
+        mywin = np.hanning(analyzer.n_fft + 2)[1:-1]
+        peaklists = []
+        for offset in offsets:
+            with self._stage(prefix + 'stft'):
+                sgram = stft.stft(d[offset:], n_fft=analyzer.n_fft,
+                                  hop_length=analyzer.n_hop, window=mywin,
+                                  magnitude=True,
+                                  workers=analyzer.fft_workers)
+            with self._stage(prefix + 'peaks'):
+                peaklists.append(analyzer._sgram2peaks(
+                    analyzer._enhance_sgram(sgram)))
+        with self._stage(prefix + 'landmarks'):
+            hashes = analyzer._peaks2hashes(peaklists[0] if len(offsets) == 1
+                                            else peaklists)
+        return hashes, len(d) / sr
+
+    def _stages(self, prefix, audio_dur):
+        """ Seconds and x realtime of each stage with prefix """
+        return collections.OrderedDict(
+            (name[len(prefix):], {'seconds': secs,
+                                  'xrt': secs / max(audio_dur, 1e-9)})
+            for name, secs in self.seconds.items()
+            if name.startswith(prefix))
+
+    def _total(self, prefix):
+        """ Total seconds of the stages with prefix """
+        return sum(secs for name, secs in self.seconds.items()
+                   if name.startswith(prefix))
+
+    def run(self, nrefs=20, nqueries=20, dur=60.0, qdur=10.0, query_shifts=4,
+            seed=0, report=None):
+        """ Build and query an index of a synthetic corpus.
+        :returns:
+          results : dict
+            the settings, the time in each stage (and its x realtime),
+            indexing hashes/sec, queries/sec, recall, and peak RSS
+        """
+        self.seconds = collections.OrderedDict()
+        analyzer = self.analyzer
+        matcher = self.matcher
+        dirname = tempfile.mkdtemp(prefix='audfprint_bench')
+        try:
+            tick = time.time()
+            refs, queries = make_corpus(dirname, nrefs, dur, nqueries, qdur,
+                                        analyzer.target_sr, seed)
+            if report:
+                report([time.ctime() + " bench: wrote %d references and %d"
+                        " queries in %.1f s" % (nrefs, nqueries,
+                                                time.time() - tick)])
+            # The table's choice of entries to drop from full buckets
+            # is random.
+            np.random.seed(seed)
+            ht = hash_table.HashTable(hashbits=self.hashbits,
+                                      depth=self.depth, maxtime=self.maxtime)
+            ref_dur = 0.0
+            nhashes = 0
+            for filename in refs:
+                hashes, filedur = self._hashes('index.', filename,
+                                               analyzer.shifts)
+                with self._stage('index.store'):
+                    ht.store(filename, hashes)
+                ref_dur += filedur
+                nhashes += len(hashes)
+            tablename = os.path.join(dirname, 'bench.pklz')
+            with self._stage('table.save'):
+                ht.save(tablename)
+            with self._stage('table.load'):
+                ht = hash_table.HashTable(tablename)
+            qry_dur = 0.0
+            nhits = 0
+            ncorrect = 0
+            for filename, reference in queries:
+                hashes, filedur = self._hashes('query.', filename,
+                                               query_shifts)
+                with self._stage('query.get_hits'):
+                    hits = ht.get_hits(hashes, matcher.skip_stop_hashes)
+                with self._stage('query.count'):
+                    results = matcher._match_hits(ht, hits)
+                qry_dur += filedur
+                nhits += len(hits)
+                if len(results) and ht.names[results[0][0]] == reference:
+                    ncorrect += 1
+            table_bytes = os.path.getsize(tablename)
+        finally:
+            shutil.rmtree(dirname, ignore_errors=True)
+        index_secs = self._total('index.')
+        query_secs = self._total('query.')
+        return collections.OrderedDict([
+            ('bench_version', BENCH_VERSION),
+            ('settings', collections.OrderedDict([
+                ('nrefs', nrefs), ('nqueries', nqueries), ('dur', dur),
+                ('qdur', qdur), ('seed', seed),
+                ('density', analyzer.density),
+                ('fanout', analyzer.maxpairsperpeak),
+                ('pks_per_frame', analyzer.maxpksperframe),
+                ('freq_sd', analyzer.f_sd),
+                ('samplerate', analyzer.target_sr),
+                ('shifts', analyzer.shifts),
+                ('query_shifts', query_shifts),
+                ('hashbits', self.hashbits), ('depth', self.depth),
+                ('maxtime', self.maxtime),
+                ('match_win', matcher.window),
+                ('min_count', matcher.threshcount),
+                ('search_depth', matcher.search_depth),
+                ('exact_count', bool(matcher.exact_count))])),
+            ('environment', collections.OrderedDict([
+                ('python', platform.python_version()),
+                ('numpy', np.__version__),
+                ('platform', platform.platform()),
+                ('machine', platform.machine()),
+                ('cpus', os.cpu_count() if hasattr(os, 'cpu_count')
+                 else None)])),
+            ('index', collections.OrderedDict([
+                ('audio_sec', ref_dur), ('hashes', nhashes),
+                ('stages', self._stages('index.', ref_dur)),
+                ('seconds', index_secs),
+                ('xrt', index_secs / max(ref_dur, 1e-9)),
+                ('hashes_per_sec', nhashes / max(index_secs, 1e-9))])),
+            ('table', collections.OrderedDict([
+                ('bytes', table_bytes),
+                ('stages', self._stages('table.', ref_dur))])),
+            ('query', collections.OrderedDict([
+                ('audio_sec', qry_dur), ('hits', nhits),
+                ('stages', self._stages('query.', qry_dur)),
+                ('seconds', query_secs),
+                ('xrt', query_secs / max(qry_dur, 1e-9)),
+                ('queries_per_sec', nqueries / max(query_secs, 1e-9)),
+                ('recall', ncorrect / max(1, nqueries))])),
+            ('peak_rss_mb', peak_rss_mb())])
+
+
+def format_bench(results):
+    """ Format bench results as lines of text """
+    lines = []
+    for phase in ['index', 'table', 'query']:
+        for stage, times in results[phase]['stages'].items():
+            lines.append("%-16s %9.3f s  %8.4f x RT" % (
+                phase + '.' + stage, times['seconds'], times['xrt']))
+    index = results['index']
+    query = results['query']
+    lines.append("index: %d hashes from %.1f s of audio in %.2f s"
+                 " (%.4f x RT, %.0f hashes/sec)"
+                 % (index['hashes'], index['audio_sec'], index['seconds'],
+                    index['xrt'], index['hashes_per_sec']))
+    lines.append("query: %d queries (%.1f s of audio) in %.2f s"
+                 " (%.4f x RT, %.1f queries/sec), recall %.3f"
+                 % (results['settings']['nqueries'], query['audio_sec'],
+                    query['seconds'], query['xrt'], query['queries_per_sec'],
+                    query['recall']))
+    if results['peak_rss_mb'] is not None:
+        lines.append("peak RSS: %.1f MB" % results['peak_rss_mb'])
+    return lines
@@ -0,0 +1,333 @@
+# coding=utf-8
+"""
+audfprint_daemon.py
+
+A resident audfprint process that keeps its hash tables loaded and
+serves add, match, list and remove commands over a Unix domain socket,
+so that each command costs only its own work rather than Python startup,
+imports and a table load.
+
+Each message is a 4-byte big-endian length followed by that many bytes of
+UTF-8 JSON.  A request is {"argv": [...], "cwd": "..."}, the arguments of
+an audfprint command line and the directory they are relative to; the
+reply is {"output": [lines...], "error": null or "message"}.  A
+connection may carry any number of requests, and connections are served
+concurrently: matches against a table run side by side, while an add or
+remove has the table to itself.  Changed tables are saved every
+SAVE_INTERVAL seconds and when the daemon stops, rather than after each
+command.
+
+This module only needs the standard library, so the client starts fast:
+
+    python -m utility.audfprint_daemon --socket /tmp/afp.sock \\
+        match -d fpdbase.pklz query.mp3
+"""
+from __future__ import division, print_function
+
+import contextlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+
+# Length prefix of each message.
+FRAME_HEADER = struct.Struct('>I')
+# Longest message we will accept.
+MAX_FRAME = 1 << 28
+# Seconds between saves of the tables changed by add or remove.
+SAVE_INTERVAL = 60.0
+
+
+def _recv_exactly(sock, nbytes):
+    """ Read nbytes from sock, or None if it is closed first """
+    chunks = []
+    while nbytes:
+        chunk = sock.recv(min(nbytes, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(sock, message):
+    """ Send one JSON-able message """
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    """ Receive one message, or None if the connection has closed """
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    nbytes, = FRAME_HEADER.unpack(header)
+    if nbytes > MAX_FRAME:
+        raise ValueError("message of %d bytes is too long" % nbytes)
+    data = _recv_exactly(sock, nbytes)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+class ReadWriteLock(object):
+    """ Any number of readers, or a single writer.  Waiting writers keep
+        new readers out, so a stream of matches can't starve an add. """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class TableCache(object):
+    """ The hash tables loaded by the daemon, by filename, each with its
+        ReadWriteLock.  load(filename) reads a table. """
+
+    def __init__(self, load):
+        self.load = load
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """ Return (table, lock) for filename, loading it the first time """
+        key = os.path.abspath(filename)
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = (self.load(filename), ReadWriteLock())
+            return self._tables[key]
+
+    def save_dirty(self):
+        """ Save each table that has changed since it was last saved;
+            return the names of those saved """
+        with self._lock:
+            tables = list(self._tables.items())
+        saved = []
+        for filename, (table, lock) in tables:
+            # Matches may go on while we save, but not changes.
+            with lock.read():
+                if table.dirty:
+                    table.save(filename)
+                    saved.append(filename)
+        return saved
+
+
+class AutoSave(threading.Thread):
+    """ Save the changed tables of a TableCache every interval seconds,
+        until stop() """
+
+    def __init__(self, tables, interval=SAVE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.tables = tables
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """ Stop saving, once any save under way is done """
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.tables.save_dirty()
+
+
+class ThreadOutput(object):
+    """ Stands in for sys.stdout, so that what a request prints goes back
+        to its client: text written by a thread inside capture(report) is
+        passed to report as a list of lines; other threads write to the
+        stream as usual. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def capture(self, report):
+        self._local.report = report
+        self._local.partial = ''
+        try:
+            yield
+        finally:
+            if self._local.partial:
+                report([self._local.partial])
+            self._local.report = None
+
+    def write(self, text):
+        report = getattr(self._local, 'report', None)
+        if report is None:
+            return self.stream.write(text)
+        lines = (self._local.partial + text).split('\n')
+        self._local.partial = lines.pop()
+        if lines:
+            report(lines)
+
+    def flush(self):
+        if getattr(self._local, 'report', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def captured_output(report):
+    """ Pass what this thread prints to report, if sys.stdout is a
+        ThreadOutput (as in the daemon) """
+    if isinstance(sys.stdout, ThreadOutput):
+        with sys.stdout.capture(report):
+            yield
+    else:
+        yield
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """ Serve the requests on one connection, in turn """
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (ValueError, socket.error):
+                break
+            if request is None:
+                break
+            try:
+                reply = {'output': self.server.run_command(
+                             request['argv'], request.get('cwd')),
+                         'error': None}
+            except SystemExit as e:
+                # docopt exits with the usage message on bad arguments.
+                reply = {'output': [], 'error': str(e)}
+            except Exception as e:
+                reply = {'output': [], 'error': "%s: %s"
+                                                % (type(e).__name__, e)}
+            try:
+                send_frame(self.request, reply)
+            except socket.error:
+                break
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Listen on the Unix socket at path, calling run_command(argv, cwd)
+        (which returns a list of output lines) for each request, each
+        connection in its own thread.
+
+    :usage:
+       >>> server = DaemonServer('/tmp/afp.sock', run_command)
+       >>> server.serve_forever()
+    """
+    daemon_threads = True
+
+    def __init__(self, path, run_command):
+        self.run_command = run_command
+        if os.path.exists(path):
+            # Only replace a socket that nothing is listening on.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise ValueError("a daemon is already listening on " + path)
+            finally:
+                probe.close()
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def request(path, argv, cwd=None):
+    """ Send one command line to the daemon at path.
+        Returns (output lines, error message or None). """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        send_frame(sock, {'argv': list(argv),
+                          'cwd': os.getcwd() if cwd is None else cwd})
+        reply = recv_frame(sock)
+    finally:
+        sock.close()
+    if reply is None:
+        return [], "daemon closed the connection"
+    return reply['output'], reply['error']
+
+
+def split_socket_arg(argv):
+    """ Remove --socket <path> (or --socket=<path>) from an argument list.
+        Returns (path or None, the other arguments). """
+    rest = []
+    path = None
+    args = iter(argv)
+    for arg in args:
+        if arg == '--socket':
+            path = next(args, None)
+        elif arg.startswith('--socket='):
+            path = arg[len('--socket='):]
+        else:
+            rest.append(arg)
+    return path, rest
+
+
+def client_main(argv):
+    """ Thin client: send an audfprint command line to a daemon, and print
+        its output.  Returns the exit status. """
+    path, args = split_socket_arg(argv[1:])
+    if not path:
+        print("usage:", os.path.basename(argv[0]),
+              "--socket <path> (add | match | list | remove) [options]"
+              " [<file>]...", file=sys.stderr)
+        return 2
+    output, error = request(path, args)
+    for line in output:
+        print(line)
+    if error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(client_main(sys.argv))
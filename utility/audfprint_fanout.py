@@ -0,0 +1,212 @@
+# coding=utf-8
+"""
+audfprint_fanout.py
+
+Query several hash tables (e.g. the partitions of a long recording, or
+one table per station) at once.  Each table's lookup and candidate
+counting runs on a bounded thread pool; the per-table results are merged
+into a single ranking, and the time taken by each table is recorded.
+"""
+from __future__ import division, print_function
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import numpy as np
+
+import utility.audfprint_analyze as audfprint_analyze
+
+# How often a waiting query checks whether it has been cancelled (sec).
+CANCEL_POLL = 0.05
+
+
+class TableFanout(object):
+    """ Match queries against a list of hash tables concurrently.
+
+    :usage:
+       >>> fanout = TableFanout(matcher, [ht1, ht2, ht3], max_workers=2)
+       >>> results = fanout.match_hashes(hashes)
+       >>> table, id_ = results[0, :2]   # best match over all tables
+    """
+
+    def __init__(self, matcher, tables, names=None, max_workers=4):
+        self.matcher = matcher
+        self.tables = list(tables)
+        if names is None:
+            names = ["table%d" % i for i in range(len(self.tables))]
+        self.names = list(names)
+        # At most this many tables are searched at the same time.
+        self.max_workers = max(1, min(max_workers, len(self.tables)))
+        # Seconds taken by each table for each query it completed.
+        self.latencies = [[] for _ in self.tables]
+        # Number of queries each table did not complete.
+        self.nskipped = [0 for _ in self.tables]
+        self._cancel = threading.Event()
+        self._executor = None
+
+    def _match_table(self, index, hashes, stop):
+        """ Worker: match hashes against one table, unless the query has
+            been stopped or cancelled """
+        if stop.is_set() or self._cancel.is_set():
+            return None, 0.0
+        tick = time.time()
+        results = self.matcher.match_hashes(self.tables[index], hashes)
+        return results, time.time() - tick
+
+    def cancel(self):
+        """ Abandon the current query (e.g. from another thread): tables
+            not yet started are skipped, and match_hashes returns with the
+            results of the ones completed so far.  If no query is running,
+            the next one is abandoned. """
+        self._cancel.set()
+
+    def match_hashes(self, hashes, timeout=None):
+        """ Match one query's hashes against every table.  Stops early if
+            cancel() is called, or after timeout seconds, in which case the
+            unfinished tables contribute nothing.
+        :returns:
+          results : np.array
+            rows of [table, id, filt_count, time_skew, raw_count,
+            orig_rank, min_time, max_time], i.e. the match_hashes rows
+            of every table with the table index prepended, ranked by
+            filtered count over all the tables.
+        """
+        return self._merge(self._match_tables(hashes, timeout))
+
+    def _match_tables(self, hashes, timeout=None, table_results=None):
+        """ The match_hashes results of each table (None for those not
+            completed), skipping those already given in table_results """
+        if table_results is None:
+            table_results = [None for _ in self.tables]
+        todo = [i for i, results in enumerate(table_results)
+                if results is None]
+        if not todo:
+            return table_results
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+        # Stops this query's tables that have not started yet.
+        stop = threading.Event()
+        futures = dict((self._executor.submit(self._match_table, i, hashes,
+                                              stop), i)
+                       for i in todo)
+        deadline = None if timeout is None else time.time() + timeout
+        pending = set(futures)
+        try:
+            while pending and not self._cancel.is_set():
+                wait = CANCEL_POLL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        break
+                done, pending = concurrent.futures.wait(
+                        pending, timeout=wait,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index = futures[future]
+                    results, elapsed = future.result()
+                    if results is not None:
+                        table_results[index] = results
+                        self.latencies[index].append(elapsed)
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+            if pending and self._cancel.is_set():
+                # This query has taken the cancel.
+                self._cancel.clear()
+        for index in todo:
+            if table_results[index] is None:
+                self.nskipped[index] += 1
+        return table_results
+
+    @staticmethod
+    def _merge(table_results):
+        """ Combine per-table results into one list ranked by filtered
+            count (ties keep table order). """
+        rows = [np.zeros((0, 8), np.int32)]
+        for index, results in enumerate(table_results):
+            if results is not None and len(results):
+                rows.append(np.c_[np.full(len(results), index, np.int32),
+                                  results])
+        allrows = np.concatenate(rows)
+        return allrows[np.argsort(-allrows[:, 2], kind='stable')]
+
+    def match_file(self, analyzer, filename, number=None):
+        """ Analyze an audio file once and match it against every table.
+            Return the top matches as rows of [table, id, filt_count, ...],
+            the file duration in sec, and the number of query hashes. """
+        cache = self.matcher.result_cache
+        cache_keys = [None for _ in self.tables]
+        if cache is not None and os.path.isfile(filename):
+            # Each table's results are cached as for a single table.
+            digest = audfprint_analyze.file_digest(filename)
+            cache_keys = [cache.key(digest, analyzer, self.matcher, ht)
+                          for ht in self.tables]
+        cached = [None if key is None else cache.get(key)
+                  for key in cache_keys]
+        table_results = [None if entry is None else entry[0]
+                         for entry in cached]
+        if all(entry is not None for entry in cached):
+            durd, nhash = cached[0][1:]
+            analyzer.soundfiletotaldur += durd
+            analyzer.soundfilecount += 1
+        else:
+            q_hashes, durd = self.matcher._query_hashes(analyzer, filename,
+                                                        number)
+            nhash = len(q_hashes)
+            table_results = self._match_tables(q_hashes,
+                                               table_results=table_results)
+            for key, entry, results in zip(cache_keys, cached,
+                                           table_results):
+                if key is not None and entry is None and results is not None:
+                    cache.put(key, results, durd, nhash)
+        rslts = self._merge(table_results)
+        if self.matcher.sort_by_time:
+            rslts = rslts[(-rslts[:, 3]).argsort(kind='stable'), :]
+        return rslts[:self.matcher.max_returns, :], durd, nhash
+
+    def file_match_to_msgs(self, analyzer, qry, number=None):
+        """ Match a single input file against every table, return list of
+            message strings as Matcher.file_match_to_msgs """
+        rslts, dur, nhash = self.match_file(analyzer, qry, number)
+        if not len(rslts):
+            return self.matcher.results_to_msgs(analyzer, self.tables[0], qry,
+                                                rslts[:, 1:], dur, nhash)
+        msgs = []
+        for row in rslts:
+            msgs.extend(self.matcher.results_to_msgs(
+                    analyzer, self.tables[row[0]], qry, row[np.newaxis, 1:],
+                    dur, nhash))
+        return msgs
+
+    def stats_msgs(self):
+        """ Report the per-table query latencies """
+        msgs = []
+        for name, latencies, nskipped in zip(self.names, self.latencies,
+                                             self.nskipped):
+            if latencies:
+                msg = ("%s: %d queries, mean %.1f ms, max %.1f ms"
+                       % (name, len(latencies), 1000 * np.mean(latencies),
+                          1000 * np.max(latencies)))
+            else:
+                msg = "%s: 0 queries" % name
+            if nskipped:
+                msg += ", %d skipped" % nskipped
+            msgs.append(msg)
+        return msgs
+
+    def close(self):
+        """ Shut down the worker threads """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cancel()
+        self.close()
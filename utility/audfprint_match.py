@@ -7,40 +7,31 @@ Fingerprint matching code for audfprint
 2014-05-26 Dan Ellis dpwe@ee.columbia.edu
 """
 from __future__ import division, print_function
+import hashlib
 import os
 import time
 
-import psutil
 import numpy as np
-import scipy.signal
-
-# Don't sweat failure to import graphics support.
-try:
-    import matplotlib.pyplot as plt
-    import librosa.display
-except:
-    pass
 
 import utility.audfprint_analyze
 import utility.audio_read
+import utility.profiling as profiling
 import utility.stft
 
 
 def process_info():
-    rss = usrtime = 0
+    """ Return the resident memory (bytes) and user CPU time (sec) of this
+        process """
+    # Only used for logging, and slow to import.
+    import psutil
     p = psutil.Process(os.getpid())
-    if os.name == 'nt':
-        rss = p.memory_info()[0]
-        usrtime = p.cpu_times()[0]
-    else:
-        rss = p.get_memory_info()[0]
-        usrtime = p.get_cpu_times()[0]
-    return rss, usrtime
+    return p.memory_info()[0], p.cpu_times()[0]
 
 
 def log(message):
     """ log info with stats """
-    print('%s physmem=%s utime=%s %s' % (time.ctime(), process_info()))
+    rss, usrtime = process_info()
+    print('%s physmem=%s utime=%s %s' % (time.ctime(), rss, usrtime, message))
 
 
 def encpowerof2(val):
@@ -90,6 +81,274 @@ def find_modes(data, threshold=5, window=0):
     return localmaxes + datamin, fullvector[localmaxes]
 
 
+def _pack_id_time(ids, times, span):
+    """ Pack (id, time) pairs into single int64 keys that sort by id then
+        time.  times must lie in [0, span). """
+    return ids.astype(np.int64) * span + times
+
+
+def _sort_order(keys):
+    """ Indices that sort by several nonnegative integer keys, most
+        significant first (like np.lexsort with the keys reversed).  Packs
+        them into one int64 for a single argsort when they fit. """
+    packed = np.zeros(len(keys[0]), dtype=np.int64)
+    nbits = 0
+    for key in keys:
+        bits = encpowerof2(int(np.amax(key)) + 1) if len(key) else 0
+        nbits += bits
+        packed = (packed << bits) + key
+    if nbits < 63:
+        return np.argsort(packed, kind='stable')
+    return np.lexsort(keys[::-1])
+
+
+def _id_ranks(allids, ids):
+    """ The position of each of allids within the list ids, or -1 for the
+        ones that are not in it. """
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids) or not len(allids):
+        return np.full(len(allids), -1, dtype=np.int64)
+    maxid = max(np.amax(allids), np.amax(ids))
+    if maxid < 4 * (len(allids) + len(ids)):
+        idrank = np.full(maxid + 1, -1, dtype=np.int64)
+        idrank[ids] = np.arange(len(ids))
+        return idrank[allids]
+    # Too sparse for a lookup table.
+    order = np.argsort(ids)
+    pos = np.minimum(np.searchsorted(ids[order], allids), len(ids) - 1)
+    return np.where(ids[order][pos] == allids, order[pos], -1)
+
+
+def hit_votes(hits):
+    """ Collapse hits (rows of [id, dtime, hash, otime]) into votes: the
+        distinct (id, dtime) pairs, sorted by id then dtime, with the
+        number of hits for each.  Returns (ids, dtimes, counts). """
+    if not len(hits):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    alltimes = hits[:, 1].astype(np.int64)
+    mintime = np.amin(alltimes)
+    span = np.amax(alltimes) - mintime + 1
+    keys, counts = np.unique(_pack_id_time(hits[:, 0], alltimes - mintime,
+                                           span), return_counts=True)
+    return keys // span, keys % span + mintime, counts
+
+
+def _local_max_votes(vote_ids, vote_times, vote_counts):
+    """ Flag the votes that are local maxima of their id's dtime histogram,
+        exactly as locmax() would on the dense histogram: at least as
+        large as the count one step earlier, larger than one step later.
+        Votes must be sorted by id then dtime. """
+    nvotes = len(vote_counts)
+    prev_counts = np.zeros(nvotes, dtype=vote_counts.dtype)
+    next_counts = np.zeros(nvotes, dtype=vote_counts.dtype)
+    if nvotes > 1:
+        adjacent = np.logical_and(vote_ids[1:] == vote_ids[:-1],
+                                  vote_times[1:] == vote_times[:-1] + 1)
+        prev_counts[1:][adjacent] = vote_counts[:-1][adjacent]
+        next_counts[:-1][adjacent] = vote_counts[1:][adjacent]
+    return np.logical_and(vote_counts >= prev_counts, vote_counts > next_counts)
+
+
+def _greedy_modes(cand_ids, cand_times, cand_counts, window):
+    """ Choose modes among candidate (id, time, count) local maxima as
+        repeatedly taking the largest remaining count (earliest time on
+        ties) and discarding the other candidates of the same id within
+        +/- window of it.  Candidates must be sorted by id then time.
+        All the ids are processed together: each round accepts every
+        candidate that beats all its surviving neighbors within the
+        window, which is exactly the set the sequential greedy accepts.
+        Returns a boolean mask of the accepted candidates. """
+    ncands = len(cand_ids)
+    accepted = np.zeros(ncands, dtype=bool)
+    alive = np.ones(ncands, dtype=bool)
+    # How far apart (in list position) can two neighbors in a window be?
+    # Local maxima are at least 2 apart in time.
+    maxoffset = min(ncands - 1, window // 2 + 1)
+    # Pairs (i, i + offset) that are within the window of each other.
+    pairs = []
+    for offset in range(1, maxoffset + 1):
+        close = np.nonzero(np.logical_and(
+            cand_ids[offset:] == cand_ids[:-offset],
+            cand_times[offset:] - cand_times[:-offset] <= window))[0]
+        if not len(close):
+            break
+        later = close + offset
+        # The later one wins only with a strictly larger count.
+        later_wins = cand_counts[later] > cand_counts[close]
+        pairs.append((close, later, later_wins))
+    while np.any(alive):
+        beaten = np.zeros(ncands, dtype=bool)
+        for earlier, later, later_wins in pairs:
+            both = np.logical_and(alive[earlier], alive[later])
+            beaten[earlier[np.logical_and(both, later_wins)]] = True
+            beaten[later[np.logical_and(both, ~later_wins)]] = True
+        best = np.logical_and(alive, ~beaten)
+        accepted |= best
+        alive &= ~best
+        # Discard whatever is within the window of a newly-accepted mode.
+        for earlier, later, _ in pairs:
+            alive[earlier[best[later]]] = False
+            alive[later[best[earlier]]] = False
+    return accepted
+
+
+# Most table entries to look up at once in Matcher.match_hashes_batch.
+BATCH_HITS = 1 << 16
+
+
+class SortedHits(object):
+    """ The hits for a list of candidate ids, sorted once by (candidate
+        rank, dtime, query time), so that the hits of any id within a
+        range of time skews form a contiguous slice found by binary search.
+    """
+
+    def __init__(self, hits, ids):
+        """ hits has rows of [id, dtime, hash, otime]; ids are the
+            candidates, in rank order. """
+        ids = np.asarray(ids, dtype=np.int64)
+        allids = hits[:, 0].astype(np.int64)
+        # Packing of (otime, hash) for telling apart distinct matches,
+        # as in Matcher._unique_match_hashes.
+        timebits = max(1, encpowerof2(np.amax(hits[:, 3])))
+        ranks = _id_ranks(allids, ids)
+        keep = np.nonzero(ranks >= 0)[0]
+        ranks = ranks[keep]
+        dtimes = hits[keep, 1].astype(np.int64)
+        otimes = hits[keep, 3].astype(np.int64)
+        hashes = hits[keep, 2].astype(np.int64)
+        self.ids = ids
+        self.mintime = np.amin(dtimes) if len(dtimes) else 0
+        dtimes -= self.mintime
+        self.span = np.amax(dtimes) + 1 if len(dtimes) else 1
+        order = _sort_order([ranks, dtimes, otimes])
+        self.ranks = ranks[order]
+        self.dtimes = dtimes[order]
+        self.otimes = otimes[order]
+        self.matchkeys = self.otimes + (hashes[order] << timebits)
+        self.keys = _pack_id_time(self.ranks, self.dtimes, self.span)
+
+    def votes(self):
+        """ The distinct (rank, dtime) pairs, in order, with their hit
+            counts.  dtimes are relative to self.mintime. """
+        starts = np.r_[0, np.nonzero(self.keys[1:] != self.keys[:-1])[0] + 1]
+        starts = starts[starts < len(self.keys)]
+        counts = np.diff(np.r_[starts, len(self.keys)])
+        return self.ranks[starts], self.dtimes[starts], counts
+
+    def window_bounds(self, ranks, modes, window):
+        """ Slice bounds (lo, hi) of the hits of each rank with dtimes
+            within +/- window of the corresponding mode (relative dtime). """
+        lo = np.searchsorted(self.keys, _pack_id_time(
+            ranks, np.maximum(0, modes - window), self.span), 'left')
+        hi = np.searchsorted(self.keys, _pack_id_time(
+            ranks, np.minimum(self.span - 1, modes + window), self.span),
+            'right')
+        return lo, hi
+
+    @staticmethod
+    def window_rows(lo, hi):
+        """ Concatenate the slices lo[i]:hi[i] into (which, rows): the
+            index of the slice and the hit index of every element. """
+        lengths = hi - lo
+        which = np.repeat(np.arange(len(lo)), lengths)
+        firsts = np.cumsum(lengths) - lengths
+        rows = np.arange(np.sum(lengths)) + np.repeat(lo - firsts, lengths)
+        return which, rows
+
+    def count_unique_matches(self, lo, hi):
+        """ Number of distinct (otime, hash) pairs within each slice """
+        which, rows = self.window_rows(lo, hi)
+        matchkeys = self.matchkeys[rows]
+        order = _sort_order([which, matchkeys])
+        which = which[order]
+        matchkeys = matchkeys[order]
+        new = np.ones(len(which), dtype=bool)
+        new[1:] = np.logical_or(which[1:] != which[:-1],
+                                matchkeys[1:] != matchkeys[:-1])
+        return np.bincount(which[new], minlength=len(lo))
+
+    def time_ranges(self, lo, hi, quantile):
+        """ The query time support of each slice: the otimes at the
+            quantile and 1 - quantile points of its sorted otimes. """
+        which, rows = self.window_rows(lo, hi)
+        otimes = self.otimes[rows][_sort_order([which, self.otimes[rows]])]
+        lengths = hi - lo
+        firsts = np.cumsum(lengths) - lengths
+        minix = np.floor(lengths * quantile).astype(np.int64)
+        maxix = np.floor(lengths * (1.0 - quantile)).astype(np.int64) - 1
+        # Negative indices count back from the end, as in list indexing.
+        maxix[maxix < 0] += lengths[maxix < 0]
+        return otimes[firsts + minix], otimes[firsts + maxix]
+
+
+RESULT_CACHE_VERSION = 1
+
+
+class ResultCache(object):
+    """ Directory of previous match results.
+
+    Entries are keyed by the query file's content digest, the analysis and
+    matching parameters, and the hash table's identity and generation (which
+    every store, remove or merge advances), so a changed index simply stops
+    finding its old entries.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    @staticmethod
+    def key(digest, analyzer, matcher, ht):
+        """ Key for matching file <digest> against the current ht """
+        params = (RESULT_CACHE_VERSION, digest, analyzer.target_sr,
+                  analyzer.n_fft, analyzer.n_hop, float(analyzer.density),
+                  float(analyzer.f_sd), analyzer.maxpksperframe,
+                  analyzer.maxpairsperpeak, analyzer.targetdf, analyzer.mindt,
+                  analyzer.targetdt, analyzer.shifts,
+                  matcher.window, matcher.threshcount, matcher.search_depth,
+                  bool(matcher.exact_count), bool(matcher.find_time_range),
+                  float(matcher.time_quantile), matcher.max_alignments_per_id,
+                  getattr(ht, 'uuid', None), getattr(ht, 'generation', 0))
+        if analyzer.gate_db is not None:
+            params += (float(analyzer.gate_db), float(analyzer.gate_min_dur))
+        if matcher.skip_stop_hashes and ht.stop_hashes is not None:
+            params += (float(ht.stop_factor),)
+        return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.npz')
+
+    def get(self, key):
+        """ Return (rslts, dur, nhash) for key, or None if not cached """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as entry:
+                return (entry['rslts'], float(entry['dur']),
+                        int(entry['nhash']))
+        except (IOError, ValueError, KeyError):
+            # A damaged entry is just a miss; it will be rewritten.
+            return None
+
+    def put(self, key, rslts, dur, nhash):
+        """ Store the (unfiltered) match_hashes results for a query """
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another process may have created it already.
+                pass
+        # Write then rename, so concurrent readers never see a partial file.
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            np.savez(f, rslts=np.asarray(rslts, np.int32), dur=dur,
+                     nhash=nhash)
+        os.replace(tmppath, path)
+
+
 class Matcher(object):
     """Provide matching for audfprint fingerprint queries to hash table"""
 
@@ -120,16 +379,35 @@ class Matcher(object):
         # If there are a lot of matches within a single track at different
         # alignments, stop looking after a while.
         self.max_alignments_per_id = 100
+        # How many query files to look up in the hash table together?
+        self.match_batch = 1
+        # Ignore the hash table's stop hashes (if it has any)?
+        self.skip_stop_hashes = True
+        # Most hits to hold in memory at once; longer queries are
+        # matched in chunks.
+        self.max_hits = 1 << 22
+        # Scan long queries for every occurrence of the reference items?
+        self.scan = False
+        # Length and spacing of the scan windows, in seconds.
+        self.scan_window = 60.0
+        self.scan_hop = 30.0
+        # ResultCache of earlier matches, or None.
+        self.result_cache = None
 
     def _best_count_ids(self, hits, ht):
         """ Return the indexes for the ids with the best counts.
             hits is a matrix as returned by hash_table.get_hits()
             with rows of consisting of [id dtime hash otime] """
         allids = hits[:, 0]
-        ids = np.unique(allids)
         # rawcounts = np.sum(np.equal.outer(ids, allids), axis=1)
         # much faster, and doesn't explode memory
-        rawcounts = np.bincount(allids)[ids]
+        return self._best_ids_from_counts(np.bincount(allids), ht)
+
+    @profiling.timed('match.candidates')
+    def _best_ids_from_counts(self, allcounts, ht):
+        """ _best_count_ids given the number of hits for every id """
+        ids = np.nonzero(allcounts)[0]
+        rawcounts = allcounts[ids]
         # Divide the raw counts by the total number of hashes stored
         # for the ref track, to downweight large numbers of chance
         # matches against longer reference tracks.
@@ -144,6 +422,7 @@ class Matcher(object):
                               self.search_depth)
         # Return the ids to check
         bestcountsixs = bestcountsixs[:maxdepth]
+        profiling.count('candidates', len(bestcountsixs))
         return ids[bestcountsixs], rawcounts[bestcountsixs]
 
     def _unique_match_hashes(self, id, hits, mode):
@@ -170,29 +449,6 @@ class Matcher(object):
                             matchhasheshash >> timebits]
         return matchhashes
 
-    def _calculate_time_ranges(self, hits, id, mode):
-        """Given the id and mode, return the actual time support.
-           hits is an np.array of id, skew_time, hash, orig_time
-           which must be sorted in orig_time order."""
-        minoffset = mode - self.window
-        maxoffset = mode + self.window
-        # match_times = sorted(hits[row, 3]
-        #                     for row in np.nonzero(hits[:, 0]==id)[0]
-        #                     if mode - self.window <= hits[row, 1]
-        #                     and hits[row, 1] <= mode + self.window)
-        match_times = hits[np.logical_and.reduce([
-            hits[:, 1] >= minoffset,
-            hits[:, 1] <= maxoffset,
-            hits[:, 0] == id
-        ]), 3]
-        min_time = match_times[int(len(match_times) * self.time_quantile)]
-        max_time = match_times[int(len(match_times) * (1.0 - self.time_quantile)) - 1]
-        # log("_calc_time_ranges: len(hits)={:d} id={:d} mode={:d} matches={:d} min={:d} max={:d}".format(
-        #    len(hits), id, mode, np.sum(np.logical_and(hits[:, 1] >= minoffset,
-        #                                               hits[:, 1] <= maxoffset)),
-        #    min_time, max_time))
-        return min_time, max_time
-
     def _exact_match_counts(self, hits, ids, rawcounts, hashesfor=None):
         """Find the number of "filtered" (time-consistent) matching hashes
             for each of the promising ids in <ids>.  Return an
@@ -204,39 +460,45 @@ class Matcher(object):
             there are several distinct time_skews giving good
             matches.
         """
-        # Sort hits into time_in_original order - needed for _calc_time_range
-        sorted_hits = hits[hits[:, 3].argsort()]
-        # Slower, old process for exact match counts
-        allids = sorted_hits[:, 0]
-        alltimes = sorted_hits[:, 1]
-        allhashes = sorted_hits[:, 2]
-        # allotimes = sorted_hits[:, 3]
-        # Allocate enough space initially for 4 modes per hit
-        maxnresults = len(ids) * 4
-        results = np.zeros((maxnresults, 7), np.int32)
-        nresults = 0
-        min_time = 0
-        max_time = 0
-        for urank, (id, rawcount) in enumerate(zip(ids, rawcounts)):
-            modes, counts = find_modes(alltimes[np.nonzero(allids == id)[0]],
-                                       window=self.window,
-                                       threshold=self.threshcount)
-            for mode in modes:
-                matchhashes = self._unique_match_hashes(id, sorted_hits, mode)
-                # Now we get the exact count
-                filtcount = len(matchhashes)
-                if filtcount >= self.threshcount:
-                    if nresults == maxnresults:
-                        # Extend array
-                        maxnresults *= 2
-                        results.resize((maxnresults, results.shape[1]))
-                    if self.find_time_range:
-                        min_time, max_time = self._calculate_time_ranges(
-                                sorted_hits, id, mode)
-                    results[nresults, :] = [id, filtcount, mode, rawcount,
-                                            urank, min_time, max_time]
-                    nresults += 1
-        return results[:nresults, :]
+        if not hits.size or not len(ids):
+            return np.zeros((0, 7), np.int32)
+        # One sort of the candidates' hits by (id, dtime, otime).
+        segments = SortedHits(hits, ids)
+        ranks, times, counts = segments.votes()
+        mode_ranks, modes = self._exact_modes(ranks, times, counts)
+        return self._exact_counts_at_modes(segments, rawcounts, mode_ranks,
+                                           modes + segments.mintime)
+
+    def _exact_modes(self, ranks, times, counts):
+        """ Every local maximum of each id's dtime histogram (given as
+            votes) with at least threshcount hits is a mode (as find_modes).
+            Returns the (rank, time) of each one. """
+        modeix = np.nonzero(np.logical_and(
+            _local_max_votes(ranks, times, counts),
+            counts >= self.threshcount))[0]
+        return ranks[modeix], times[modeix]
+
+    def _exact_counts_at_modes(self, segments, rawcounts, mode_ranks, modes):
+        """ The _exact_match_counts results for the given modes (candidate
+            rank, absolute time skew) from the hits in segments, which must
+            include every hit within the window of each mode. """
+        modes = modes - segments.mintime
+        # The exact count is the number of distinct (otime, hash) matches
+        # within the window around the mode.
+        lo, hi = segments.window_bounds(mode_ranks, modes, self.window)
+        filtcounts = segments.count_unique_matches(lo, hi)
+        keep = filtcounts >= self.threshcount
+        mode_ranks = mode_ranks[keep]
+        results = np.zeros((len(mode_ranks), 7), np.int32)
+        results[:, 0] = segments.ids[mode_ranks]
+        results[:, 1] = filtcounts[keep]
+        results[:, 2] = modes[keep] + segments.mintime
+        results[:, 3] = np.asarray(rawcounts)[mode_ranks]
+        results[:, 4] = mode_ranks
+        if self.find_time_range:
+            results[:, 5], results[:, 6] = segments.time_ranges(
+                lo[keep], hi[keep], self.time_quantile)
+        return results
 
     def _approx_match_counts(self, hits, ids, rawcounts):
         """ Quick and slightly inaccurate routine to count time-aligned hits.
@@ -261,55 +523,86 @@ class Matcher(object):
         # *but* some matches may be pruned because we don't bother to
         # apply the window (allowable drift in time alignment) unless
         # there are more than threshcount matches at the single best time skew.
-        # Note: now we allow multiple matches per ID, this may need to grow
-        # so it can grow inside the loop.
-        results = np.zeros((len(ids), 7), np.int32)
-        if not hits.size:
+        if not hits.size or not len(ids):
             # No hits found, return empty results
-            return results
-        # Sort hits into time_in_original order - needed for _calc_time_range
-        sorted_hits = hits[hits[:, 3].argsort()]
-        allids = sorted_hits[:, 0].astype(int)
-        alltimes = sorted_hits[:, 1].astype(int)
-        # Make sure every value in alltimes is >=0 for bincount
-        mintime = np.amin(alltimes)
-        alltimes -= mintime
-        nresults = 0
-        min_time = 0
-        max_time = 0
-        for urank, (id, rawcount) in enumerate(zip(ids, rawcounts)):
-            # Make sure id is an int64 before shifting it up.
-            id = int(id)
-            # Select the subrange of bincounts corresponding to this id
-            bincounts = np.bincount(alltimes[allids == id])
-            still_looking = True
-            # Only consider legit local maxima in bincounts.
-            filtered_bincounts = keep_local_maxes(bincounts)
-            found_this_id = 0
-            while still_looking:
-                mode = np.argmax(filtered_bincounts)
-                if filtered_bincounts[mode] <= self.threshcount:
-                    # Too few - skip to the next id
-                    still_looking = False
-                    continue
-                count = np.sum(bincounts[max(0, mode - self.window):
-                                         (mode + self.window + 1)])
-                if self.find_time_range:
-                    min_time, max_time = self._calculate_time_ranges(
-                            sorted_hits, id, mode + mintime)
-                results[nresults, :] = [id, count, mode + mintime, rawcount,
-                                        urank, min_time, max_time]
-                nresults += 1
-                if nresults >= results.shape[0]:
-                    results = np.vstack([results, np.zeros(results.shape,
-                                                           np.int32)])
-                # Clear this hit to find next largest.
-                filtered_bincounts[max(0, mode - self.window):
-                                   (mode + self.window + 1)] = 0
-                found_this_id += 1
-                if found_this_id > self.max_alignments_per_id:
-                    still_looking = False
-        return results[:nresults, :]
+            return np.zeros((0, 7), np.int32)
+        if not self.find_time_range:
+            # Only the candidates' hits can matter.
+            vote_ids, vote_times, vote_counts = hit_votes(
+                hits[_id_ranks(hits[:, 0], ids) >= 0])
+            return self._approx_counts_from_votes(vote_ids, vote_times,
+                                                  vote_counts, ids, rawcounts)
+        # The time ranges need the hits sorted by id and dtime anyway, so
+        # take the votes from there too.
+        segments = SortedHits(hits, ids)
+        ranks, times, counts = segments.votes()
+        results = self._approx_counts_from_votes(
+            segments.ids[ranks], times + segments.mintime, counts,
+            ids, rawcounts)
+        lo, hi = segments.window_bounds(results[:, 4],
+                                        results[:, 2] - segments.mintime,
+                                        self.window)
+        results[:, 5], results[:, 6] = segments.time_ranges(
+            lo, hi, self.time_quantile)
+        return results
+
+    def _approx_counts_from_votes(self, vote_ids, vote_times, vote_counts,
+                                  ids, rawcounts):
+        """ The core of _approx_match_counts, working from the per-(id,
+            dtime) hit counts as returned by hit_votes.  Every candidate id
+            is handled at once: the local maxima of all the dtime
+            histograms are found together, modes are chosen among them
+            greedily, and the windowed counts come from cumulative sums.
+            Returns rows as _approx_match_counts, with zero time ranges.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids) or not len(vote_ids):
+            return np.zeros((0, 7), np.int32)
+        # Only keep the votes for the ids we are checking, noting their rank
+        ranks = _id_ranks(vote_ids, ids)
+        keep = ranks >= 0
+        ranks = ranks[keep]
+        times = vote_times[keep]
+        counts = vote_counts[keep]
+        # Make every time >=0, and pack (rank, time) into sort keys.
+        mintime = np.amin(times)
+        times = times - mintime
+        span = np.amax(times) + 1
+        # Order by rank, i.e., the order of the ids we were given.
+        order = np.argsort(_pack_id_time(ranks, times, span))
+        ranks = ranks[order]
+        times = times[order]
+        counts = counts[order]
+        keys = _pack_id_time(ranks, times, span)
+        cumcounts = np.r_[0, np.cumsum(counts)]
+        # Only consider legit local maxima, with more than threshcount hits.
+        cands = np.nonzero(np.logical_and(
+            _local_max_votes(ranks, times, counts),
+            counts > self.threshcount))[0]
+        cands = cands[_greedy_modes(ranks[cands], times[cands], counts[cands],
+                                    self.window)]
+        # Within each id, keep them in the order they were chosen (largest
+        # first), and stop after max_alignments_per_id + 1 of them.
+        cands = cands[np.lexsort((times[cands], -counts[cands], ranks[cands]))]
+        cand_ranks = ranks[cands]
+        firsts = np.searchsorted(cand_ranks, cand_ranks)
+        cands = cands[np.arange(len(cands)) - firsts
+                      <= self.max_alignments_per_id]
+        cand_ranks = ranks[cands]
+        modes = times[cands]
+        # Total count within +/- window of each mode.
+        lo = np.searchsorted(keys, _pack_id_time(
+            cand_ranks, np.maximum(0, modes - self.window), span), 'left')
+        hi = np.searchsorted(keys, _pack_id_time(
+            cand_ranks, np.minimum(span - 1, modes + self.window), span),
+            'right')
+        results = np.zeros((len(cands), 7), np.int32)
+        results[:, 0] = ids[cand_ranks]
+        results[:, 1] = cumcounts[hi] - cumcounts[lo]
+        results[:, 2] = modes + mintime
+        results[:, 3] = np.asarray(rawcounts)[cand_ranks]
+        results[:, 4] = cand_ranks
+        return results
 
     def match_hashes(self, ht, hashes, hashesfor=None):
         """ Match audio against fingerprint hash table.
@@ -318,21 +611,177 @@ class Matcher(object):
             If hashesfor specified, return the actual matching hashes for that
             hit (0=top hit).
         """
+        if hashesfor is None and len(hashes) * ht.depth > self.max_hits:
+            # Too many potential hits to hold at once.
+            return self._sort_results(self._match_hashes_chunked(ht, hashes))
         # find the implicated id, time pairs from hash table
         # log("nhashes=%d" % np.shape(hashes)[0])
-        hits = ht.get_hits(hashes)
+        hits = ht.get_hits(hashes, self.skip_stop_hashes)
+        return self._match_hits(ht, hits, hashesfor)
 
+    def _hit_chunks(self, ht, hashes):
+        """ Yield the hits for successive chunks of the query hashes, each
+            with at most max_hits rows. """
+        chunk = max(1, self.max_hits // ht.depth)
+        for start in range(0, len(hashes), chunk):
+            yield ht.get_hits(hashes[start:start + chunk],
+                              self.skip_stop_hashes)
+
+    def _match_hashes_chunked(self, ht, hashes):
+        """ match_hashes in bounded memory: the table is queried with a
+            chunk of the hashes at a time, and each chunk's hits are
+            folded into running totals and dropped.  The first pass counts
+            the hits for every id, to choose the candidates; the second
+            accumulates the candidates' per-(id, dtime) votes, which give
+            the approximate counts or the exact-count modes; a third pass,
+            if needed for exact counts or time ranges, keeps only the hits
+            within the window of a mode.  Returns the same (unsorted)
+            results as the single-pass counting.
+        """
+        hashes = np.asarray(hashes).reshape((-1, 2))
+        allcounts = np.zeros(len(ht.names), dtype=np.int64)
+        for hits in self._hit_chunks(ht, hashes):
+            allcounts += np.bincount(hits[:, 0], minlength=len(allcounts))
+        ids, rawcounts = self._best_ids_from_counts(allcounts, ht)
+        if not len(ids):
+            return np.zeros((0, 7), np.int32)
+        # Votes, packed as rank * span + (dtime - mintime).
+        mintime = -int(np.amax(hashes[:, 0]))
+        span = (1 << ht.maxtimebits) - int(np.amin(hashes[:, 0])) - mintime
+        keys = np.zeros(0, dtype=np.int64)
+        counts = np.zeros(0, dtype=np.int64)
+        for hits in self._hit_chunks(ht, hashes):
+            ranks = _id_ranks(hits[:, 0], ids)
+            keep = ranks >= 0
+            chunkkeys, chunkcounts = np.unique(_pack_id_time(
+                ranks[keep], hits[keep, 1].astype(np.int64) - mintime, span),
+                return_counts=True)
+            keys, inverse = np.unique(np.r_[keys, chunkkeys],
+                                      return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=np.r_[
+                counts, chunkcounts], minlength=len(keys)).astype(np.int64)
+        ranks = keys // span
+        times = keys % span + mintime
+        if self.exact_count:
+            mode_ranks, modes = self._exact_modes(ranks, times, counts)
+        else:
+            results = self._approx_counts_from_votes(ids[ranks], times,
+                                                     counts, ids, rawcounts)
+            if not self.find_time_range:
+                return results
+            mode_ranks, modes = results[:, 4], results[:, 2]
+        if not len(mode_ranks):
+            return np.zeros((0, 7), np.int32)
+        # Keep just the hits that are within the window of some mode.
+        modekeys = _pack_id_time(mode_ranks, modes - mintime, span)
+        order = np.argsort(modekeys)
+        modekeys = modekeys[order]
+        nearhits = []
+        for hits in self._hit_chunks(ht, hashes):
+            ranks = _id_ranks(hits[:, 0], ids)
+            hitkeys = _pack_id_time(np.maximum(ranks, 0),
+                                    hits[:, 1].astype(np.int64) - mintime,
+                                    span)
+            # The nearest modes at or after, and before, each hit.
+            after = np.searchsorted(modekeys, hitkeys)
+            near = np.zeros(len(hits), dtype=bool)
+            for nearest in [np.minimum(after, len(modekeys) - 1),
+                            np.maximum(after - 1, 0)]:
+                near |= (np.abs(modekeys[nearest] - hitkeys) <= self.window) \
+                    & (modekeys[nearest] // span == ranks)
+            nearhits.append(hits[near])
+        segments = SortedHits(np.concatenate(nearhits), ids)
+        if self.exact_count:
+            return self._exact_counts_at_modes(segments, rawcounts,
+                                               mode_ranks, modes)
+        lo, hi = segments.window_bounds(results[:, 4],
+                                        results[:, 2] - segments.mintime,
+                                        self.window)
+        results[:, 5], results[:, 6] = segments.time_ranges(
+            lo, hi, self.time_quantile)
+        return results
+
+    def match_hashes_batch(self, ht, hashes_list):
+        """ Match several queries against the same hash table, with a single
+            lookup of all their hashes (so buckets shared between queries
+            are read only once).  Returns a list with the match_hashes
+            results for each query.
+        """
+        # Take the queries in groups of bounded total size, to keep the
+        # working arrays reasonably small.
+        results = []
+        group = []
+        grouphashes = 0
+        for hashes in hashes_list:
+            if group and (grouphashes + len(hashes)) * ht.depth > BATCH_HITS:
+                results.extend(self._match_hashes_group(ht, group))
+                group = []
+                grouphashes = 0
+            group.append(hashes)
+            grouphashes += len(hashes)
+        if group:
+            results.extend(self._match_hashes_group(ht, group))
+        return results
+
+    def _match_hashes_group(self, ht, hashes_list):
+        """ match_hashes_batch for one group of queries """
+        nqueries = len(hashes_list)
+        if nqueries == 1:
+            return [self.match_hashes(ht, hashes_list[0])]
+        hits, query_ids = ht.get_hits_batch(hashes_list,
+                                            self.skip_stop_hashes)
+        # Hits come back in query order.
+        bounds = np.searchsorted(query_ids, np.arange(nqueries + 1))
+        # Choose the candidate ids separately for each query...
+        candidates = [self._best_count_ids(hits[bounds[i]:bounds[i + 1]], ht)
+                      for i in range(nqueries)]
+        # ... but count them all in one go, treating each (query, id) pair
+        # as a distinct id.
+        idspan = int(np.amax(hits[:, 0])) + 1 if len(hits) else 1
+        bestids = np.concatenate([np.zeros(0, np.int64)] +
+                                 [ids for ids, _ in candidates])
+        rawcounts = np.concatenate([np.zeros(0, np.int64)] +
+                                   [counts for _, counts in candidates])
+        firstranks = np.cumsum([0] + [len(ids) for ids, _ in candidates])
+        queryids = (np.repeat(np.arange(nqueries), np.diff(firstranks))
+                    * idspan + bestids)
+        # Only the candidates' hits can matter.
+        hitids = query_ids * idspan + hits[:, 0]
+        keep = _id_ranks(hitids, queryids) >= 0
+        queryhits = np.c_[hitids[keep], hits[keep, 1:]]
+        results = self._count_matches(queryhits, queryids, rawcounts)
+        # Results are in rank order, hence grouped by query.
+        ranks = results[:, 4]
+        results[:, 0] = bestids[ranks]
+        result_queries = np.searchsorted(firstranks, ranks, 'right') - 1
+        results[:, 4] = ranks - firstranks[result_queries]
+        bounds = np.searchsorted(result_queries, np.arange(nqueries + 1))
+        return [self._sort_results(results[bounds[i]:bounds[i + 1]])
+                for i in range(nqueries)]
+
+    @profiling.timed('match.count')
+    def _count_matches(self, hits, ids, rawcounts, hashesfor=None):
+        """ Count the time-aligned hits for each candidate id, by the
+            configured method. """
+        if not self.exact_count:
+            return self._approx_match_counts(hits, ids, rawcounts)
+        return self._exact_match_counts(hits, ids, rawcounts, hashesfor)
+
+    @staticmethod
+    def _sort_results(results):
+        """ Sort results by filtered count, descending """
+        return results[(-results[:, 1]).argsort(),]
+
+    def _match_hits(self, ht, hits, hashesfor=None):
+        """ Score the hits of one query, as returned by ht.get_hits(), and
+            return the results as match_hashes. """
         bestids, rawcounts = self._best_count_ids(hits, ht)
 
         # log("len(rawcounts)=%d max(rawcounts)=%d" %
         #    (len(rawcounts), max(rawcounts)))
-        if not self.exact_count:
-            results = self._approx_match_counts(hits, bestids, rawcounts)
-        else:
-            results = self._exact_match_counts(hits, bestids, rawcounts,
-                                               hashesfor)
+        results = self._count_matches(hits, bestids, rawcounts, hashesfor)
         # Sort results by filtered count, descending
-        results = results[(-results[:, 1]).argsort(),]
+        results = self._sort_results(results)
         # Where was our best hit in the unfiltered count ranking?
         # (4th column is rank in original list; look at top hit)
         # if np.shape(results)[0] > 0:
@@ -351,12 +800,9 @@ class Matcher(object):
             hashesforhashes = self._unique_match_hashes(id, hits, mode)
             return results, hashesforhashes
 
-    def match_file(self, analyzer, ht, filename, number=None):
-        """ Read in an audio file, calculate its landmarks, query against
-            hash table.  Return top N matches as (id, filterdmatchcount,
-            timeoffs, rawmatchcount), also length of input file in sec,
-            and count of raw query hashes extracted
-        """
+    def _query_hashes(self, analyzer, filename, number=None):
+        """ Calculate the query hashes for a file, and its duration in sec
+            (faked as the largest hash time) """
         q_hashes = analyzer.wavfile2hashes(filename)
         # Fake durations as largest hash time
         if len(q_hashes) == 0:
@@ -371,17 +817,174 @@ class Matcher(object):
             print(time.ctime(), "Analyzed", numberstring, filename, "of",
                   ('%.3f' % durd), "s "
                                    "to", len(q_hashes), "hashes")
-        # Run query
-        rslts = self.match_hashes(ht, q_hashes)
-        # Post filtering
+        return q_hashes, durd
+
+    def _result_cache_key(self, analyzer, ht, filename):
+        """ The result cache key for matching filename, or None if there
+            is no cache (or no such file) """
+        if self.result_cache is None or not os.path.isfile(filename):
+            return None
+        return self.result_cache.key(
+            utility.audfprint_analyze.file_digest(filename), analyzer, self, ht)
+
+    def _cached_result(self, analyzer, cache_key):
+        """ Look up a match in the result cache, counting a hit in the
+            analyzer's totals as if the file had been analyzed """
+        cached = self.result_cache.get(cache_key)
+        if cached is not None:
+            analyzer.soundfiletotaldur += cached[1]
+            analyzer.soundfilecount += 1
+        return cached
+
+    def _filter_results(self, rslts):
+        """ Post filtering of match_hashes results for reporting """
         if self.sort_by_time:
             rslts = rslts[(-rslts[:, 2]).argsort(), :]
-        return rslts[:self.max_returns, :], durd, len(q_hashes)
+        return rslts[:self.max_returns, :]
+
+    def match_file(self, analyzer, ht, filename, number=None):
+        """ Read in an audio file, calculate its landmarks, query against
+            hash table.  Return top N matches as (id, filterdmatchcount,
+            timeoffs, rawmatchcount), also length of input file in sec,
+            and count of raw query hashes extracted
+        """
+        cache_key = self._result_cache_key(analyzer, ht, filename)
+        if cache_key is not None:
+            cached = self._cached_result(analyzer, cache_key)
+            if cached is not None:
+                rslts, durd, nhash = cached
+                return self._filter_results(rslts), durd, nhash
+        q_hashes, durd = self._query_hashes(analyzer, filename, number)
+        # Run query
+        rslts = self.match_hashes(ht, q_hashes)
+        if cache_key is not None:
+            self.result_cache.put(cache_key, rslts, durd, len(q_hashes))
+        return self._filter_results(rslts), durd, len(q_hashes)
+
+    def match_files(self, analyzer, ht, filenames, first_number=None):
+        """ As match_file for a list of files, but querying the hash table
+            for all of them at once.  Returns a list of (rslts, dur, nhash)
+            tuples, one per file. """
+        cache_keys = [self._result_cache_key(analyzer, ht, filename)
+                      for filename in filenames]
+        matches = [None if key is None else self._cached_result(analyzer, key)
+                   for key in cache_keys]
+        # Only the files without cached results need to be analyzed.
+        todo = [i for i, match in enumerate(matches) if match is None]
+        queries = [self._query_hashes(
+            analyzer, filenames[i],
+            None if first_number is None else first_number + i)
+            for i in todo]
+        rslts_list = self.match_hashes_batch(ht, [q_hashes
+                                                  for q_hashes, _ in queries])
+        for i, rslts, (q_hashes, durd) in zip(todo, rslts_list, queries):
+            matches[i] = (rslts, durd, len(q_hashes))
+            if cache_keys[i] is not None:
+                self.result_cache.put(cache_keys[i], *matches[i])
+        return [(self._filter_results(rslts), durd, nhash)
+                for rslts, durd, nhash in matches]
+
+    def scan_hashes(self, ht, hashes, window, hop):
+        """ Find every occurrence of the hash table's reference items
+            within one long query (e.g. all the airings of a set of ads in
+            a day of broadcast), by matching overlapping windows of the
+            query, <window> frames long every <hop> frames, in a single
+            batch.  Sightings of the same item at (nearly) the same time
+            skew in successive windows are merged.  Returns an array of
+            rows [id, count, time_skew, start_time, end_time], one per
+            occurrence, in order of start time (in query frames); count
+            is the best filtered count of any one window.
+        """
+        hashes = np.asarray(hashes).reshape((-1, 2))
+        hashes = hashes[np.argsort(hashes[:, 0], kind='stable')]
+        if not len(hashes):
+            return np.zeros((0, 5), np.int32)
+        starts = np.arange(hashes[0, 0], max(hashes[0, 0] + 1,
+                                             hashes[-1, 0] - window + hop + 1),
+                           hop)
+        los = np.searchsorted(hashes[:, 0], starts, 'left')
+        his = np.searchsorted(hashes[:, 0], starts + window, 'left')
+        # Every window needs its time support, which locates the occurrence.
+        find_time_range = self.find_time_range
+        self.find_time_range = True
+        try:
+            window_results = self.match_hashes_batch(
+                ht, [hashes[lo:hi] for lo, hi in zip(los, his)])
+        finally:
+            self.find_time_range = find_time_range
+        sightings = np.concatenate([np.zeros((0, 7), np.int32)]
+                                   + window_results)
+        if not len(sightings):
+            return np.zeros((0, 5), np.int32)
+        # Chain together the sightings of each id whose time skews are
+        # within the match window of each other.
+        sightings = sightings[np.lexsort((sightings[:, 2], sightings[:, 0]))]
+        newocc = np.ones(len(sightings), dtype=bool)
+        newocc[1:] = np.logical_or(
+            sightings[1:, 0] != sightings[:-1, 0],
+            sightings[1:, 2] - sightings[:-1, 2] > self.window)
+        occurrence = np.cumsum(newocc) - 1
+        firsts = np.nonzero(newocc)[0]
+        # Each occurrence takes the skew of its best sighting, and the
+        # union of their time supports.
+        best = np.lexsort((-sightings[:, 1], occurrence))
+        best = best[np.searchsorted(occurrence[best], np.arange(len(firsts)))]
+        results = np.zeros((len(firsts), 5), np.int32)
+        results[:, 0] = sightings[firsts, 0]
+        results[:, 1] = sightings[best, 1]
+        results[:, 2] = sightings[best, 2]
+        results[:, 3] = np.minimum.reduceat(sightings[:, 5], firsts)
+        results[:, 4] = np.maximum.reduceat(sightings[:, 6], firsts)
+        return results[np.argsort(results[:, 3], kind='stable')]
+
+    def scan_file(self, analyzer, ht, filename, number=None):
+        """ Calculate the hashes of a (long) audio file, and find every
+            occurrence of the hash table's items within it, as
+            scan_hashes.  Also returns the file duration and hash count. """
+        q_hashes, durd = self._query_hashes(analyzer, filename, number)
+        frames_per_sec = analyzer.target_sr / analyzer.n_hop
+        rslts = self.scan_hashes(
+            ht, q_hashes, window=int(round(self.scan_window * frames_per_sec)),
+            hop=max(1, int(round(self.scan_hop * frames_per_sec))))
+        return rslts, durd, len(q_hashes)
+
+    def file_scan_to_msgs(self, analyzer, ht, qry, number=None):
+        """ Scan a single long input file, return list of message strings,
+            one per occurrence found """
+        rslts, dur, nhash = self.scan_file(analyzer, ht, qry, number)
+        t_hop = analyzer.n_hop / analyzer.target_sr
+        msgrslt = []
+        if len(rslts) == 0 and self.verbose:
+            msgrslt.append("NOMATCH " + qry + (' %.1f ' % dur) + "sec "
+                           + str(nhash) + " raw hashes")
+        for tophitid, nhashaligned, aligntime, min_time, max_time in rslts:
+            if self.verbose:
+                msgrslt.append(("Found {:s} from {:8.1f} s to {:8.1f} s in {:s}"
+                                " at {:6.1f} s with {:5d} common hashes").format(
+                    ht.names[tophitid], min_time * t_hop, max_time * t_hop,
+                    qry, (min_time + aligntime) * t_hop, nhashaligned))
+            else:
+                msgrslt.append("{:s}\t{:s}\t{:.1f}\t{:.1f}\t{:d}".format(
+                    qry, ht.names[tophitid], min_time * t_hop,
+                    max_time * t_hop, nhashaligned))
+        return msgrslt
 
     def file_match_to_msgs(self, analyzer, ht, qry, number=None):
         """ Perform a match on a single input file, return list
             of message strings """
         rslts, dur, nhash = self.match_file(analyzer, ht, qry, number)
+        return self.results_to_msgs(analyzer, ht, qry, rslts, dur, nhash)
+
+    def files_match_to_msgs(self, analyzer, ht, qrys, first_number=None):
+        """ Match a list of input files in one batch, return a list of
+            message string lists, one per file """
+        return [self.results_to_msgs(analyzer, ht, qry, rslts, dur, nhash)
+                for qry, (rslts, dur, nhash) in zip(
+                    qrys, self.match_files(analyzer, ht, qrys, first_number))]
+
+    def results_to_msgs(self, analyzer, ht, qry, rslts, dur, nhash):
+        """ Format the results of matching one input file as a list of
+            message strings """
         t_hop = analyzer.n_hop / analyzer.target_sr
         if self.verbose:
             qrymsg = qry + (' %.1f ' % dur) + "sec " + str(nhash) + " raw hashes"
@@ -422,6 +1025,10 @@ class Matcher(object):
     def illustrate_match(self, analyzer, ht, filename):
         """ Show the query fingerprints and the matching ones
             plotted over a spectrogram """
+        # Graphics support is only needed here, and slow to import.
+        import matplotlib.pyplot as plt
+        import librosa.display
+        import scipy.signal
         # Make the spectrogram
         # d, sr = librosa.load(filename, sr=analyzer.target_sr)
         d, sr = audio_read.audio_read(filename, sr=analyzer.target_sr, channels=1)
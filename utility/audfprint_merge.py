@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+audfprint_merge.py
+
+Merge many hash tables at once (e.g. a day's partition tables into one
+index).  Worker processes each load and merge a pair of the tables, then
+pairs of those results are merged, and so on, so the wall time grows with
+the number of rounds, log2(N), rather than with the N tables.  The result
+holds the items of all the tables in their original order, as if they had
+been merged one after another.
+
+Each round's results are passed on through temporary files (gzipped at a
+fast level, as the tables are mostly empty), which are removed once they
+have been merged.  The final merge writes the output table itself.
+"""
+from __future__ import division, print_function
+
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import utility.audfprint_schedule as audfprint_schedule
+import utility.hash_table as hash_table
+
+# How many tables each job merges.
+FANIN = 2
+# Suffix of the temporary tables between rounds.
+TEMP_EXT = '.pklz'
+# gzip level of the temporary tables: fast, for files read back just once.
+TEMP_COMPRESSLEVEL = 1
+
+
+def merge_params(ht, ht2):
+    """ Check that ht2 was made at the same samplerate as ht (adopting
+        its samplerate if ht has none yet, as for "newmerge") """
+    if "samplerate" in ht.params:
+        assert ht.params["samplerate"] == ht2.params["samplerate"]
+    else:
+        ht.params["samplerate"] = ht2.params["samplerate"]
+
+
+def read_table(filename, tmpdir):
+    """ Load one of the input tables, or one of our temporary ones """
+    if os.path.dirname(filename) != tmpdir:
+        return hash_table.HashTable(filename)
+    # np.zeros doesn't touch the pages of the placeholder table.
+    ht = hash_table.HashTable(hashbits=1, depth=1)
+    with gzip.open(filename, 'rb') as f:
+        ht.load_pkl(filename, file_object=f)
+    return ht
+
+
+def merge_tables_job(filenames, tmpdir, hashbits, depth, maxtime, base=None,
+                     outname=None, stop_factor=None):
+    """ Job for WorkQueue: merge the tables, in order, into a table of the
+        given size (or into base, if it is the first), and save it to
+        outname (with stop_factor, if given) or else to a temporary file.
+        Returns (the file's name, 0 sec of audio). """
+    if filenames[0] == base or os.path.dirname(filenames[0]) == tmpdir:
+        # Already the right size.
+        ht = read_table(filenames[0], tmpdir)
+        filenames = filenames[1:]
+    else:
+        ht = hash_table.HashTable(hashbits=hashbits, depth=depth,
+                                  maxtime=maxtime)
+    for filename in filenames:
+        ht2 = read_table(filename, tmpdir)
+        merge_params(ht, ht2)
+        ht.merge(ht2)
+        del ht2
+    if outname:
+        if stop_factor is not None:
+            ht.stop_factor = stop_factor
+        ht.save(outname)
+        return outname, 0.0
+    fd, outname = tempfile.mkstemp(suffix=TEMP_EXT, dir=tmpdir)
+    with os.fdopen(fd, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb',
+                           compresslevel=TEMP_COMPRESSLEVEL) as g:
+            pickle.dump(ht, g, pickle.HIGHEST_PROTOCOL)
+    return outname, 0.0
+
+
+def _total_size(filenames):
+    """ Bytes in a job's files, to hand out the biggest jobs first """
+    return sum(os.path.getsize(filename) for filename in filenames)
+
+
+class TreeMerge(object):
+    """ Merge a list of hash table files on a pool of ncores processes,
+        into a table file of the given size (that of the one they would
+        be merged into, since merges into a smaller table drop hashes),
+        with the given stop_factor (if not None).
+
+    :usage:
+       >>> TreeMerge(hashbits=20, depth=100, maxtime=16384, ncores=4,
+       ...           report=report).run(filenames, 'merged.pklz')
+    """
+
+    def __init__(self, hashbits=20, depth=100, maxtime=16384, ncores=1,
+                 fanin=FANIN, tmpdir=None, report=None, stop_factor=None):
+        self.hashbits = hashbits
+        self.depth = depth
+        self.maxtime = maxtime
+        self.ncores = ncores
+        self.fanin = max(2, fanin)
+        # Where to put the temporary tables (default: the system's).
+        self.tmpdir = tmpdir
+        # Called with a list of progress messages, if not None.
+        self.report = report
+        self.stop_factor = stop_factor
+
+    def _round(self, filenames, tmpdir, base=None, outname=None):
+        """ Merge each run of fanin files into one (or all of them into
+            outname); return the new list """
+        if outname:
+            groups = [filenames]
+            jobs = [0]
+        else:
+            groups = [filenames[start:start + self.fanin]
+                      for start in range(0, len(filenames), self.fanin)]
+            jobs = [ix for ix, group in enumerate(groups) if len(group) > 1]
+        merged = [group[0] for group in groups]
+        queue = audfprint_schedule.WorkQueue(
+                merge_tables_job,
+                (tmpdir, self.hashbits, self.depth, self.maxtime, base,
+                 outname, self.stop_factor),
+                min(self.ncores, len(jobs)),
+                size=_total_size)
+        for ix, outfile, error in queue.run([groups[ix] for ix in jobs]):
+            if error is not None:
+                raise IOError(", ".join(groups[jobs[ix]]) + ": " + error)
+            merged[jobs[ix]] = outfile
+        # The previous round's temporary tables are no longer needed.
+        for filename in filenames:
+            if os.path.dirname(filename) == tmpdir and filename not in merged:
+                os.remove(filename)
+        return merged
+
+    def run(self, filenames, outname, base=None):
+        """ Merge the tables in filenames (after base, the existing table
+            at outname, if given) and save the result to outname.
+            Returns outname, or None if there was nothing to merge. """
+        filenames = list(filenames)
+        if not filenames:
+            return None
+        if base:
+            filenames.insert(0, base)
+        tmpdir = os.path.abspath(tempfile.mkdtemp(prefix='audfprint_merge',
+                                                  dir=self.tmpdir))
+        try:
+            nround = 0
+            last = False
+            while not last:
+                tick = time.time()
+                ntables = len(filenames)
+                # The last round writes the output.
+                last = ntables <= self.fanin
+                filenames = self._round(filenames, tmpdir, base,
+                                        outname if last else None)
+                nround += 1
+                if self.report:
+                    self.report([time.ctime() + " merge round %d: %d tables"
+                                 " to %d in %.1f s"
+                                 % (nround, ntables, len(filenames),
+                                    time.time() - tick)])
+            return outname
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
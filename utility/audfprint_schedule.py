@@ -0,0 +1,155 @@
+# coding=utf-8
+"""
+audfprint_schedule.py
+
+Run a job on each of a list of files (analyzing them to add or precompute)
+on a pool of worker processes.  Files are handed out one at a time from a
+queue, biggest first (file size being a cheap stand-in for the length of
+the audio), so that a worker given the long recordings does not keep the
+others waiting at the end.  Files that fail are tried again, and
+the throughput of each worker is tracked.
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+import time
+
+# How many more times to try a file whose job failed.
+RETRIES = 2
+
+
+def file_size(filename):
+    """ Bytes in a file, or 0 if it can't be found (e.g. a pack member) """
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def longest_first(filenames, size=file_size):
+    """ Return the indexes of filenames in order of decreasing size
+        (files of the same size keep their order) """
+    sizes = [size(filename) for filename in filenames]
+    return sorted(range(len(filenames)), key=lambda ix: -sizes[ix])
+
+
+def in_order(results):
+    """ Put the (index, ...) tuples of a WorkQueue.run back in index order,
+        holding on to each one until all the earlier ones have arrived """
+    waiting = {}
+    next_ix = 0
+    for result in results:
+        waiting[result[0]] = result
+        while next_ix in waiting:
+            yield waiting.pop(next_ix)
+            next_ix += 1
+
+
+# The job function and its extra arguments, set up by _init_worker.
+_job = None
+
+
+def _init_worker(func, args):
+    """ Pool initializer: receive the job (e.g. its analyzer) once """
+    global _job
+    _job = (func, args)
+
+
+def _run_job(task):
+    """ Run the job on one file in a worker.  Returns (index, worker name,
+        elapsed sec, result, audio duration, error message or None). """
+    ix, filename = task
+    func, args = _job
+    tick = time.time()
+    try:
+        result, dur = func(filename, *args)
+        error = None
+    except Exception as e:
+        result, dur = None, 0.0
+        error = "%s: %s" % (type(e).__name__, e)
+    return (ix, multiprocessing.current_process().name, time.time() - tick,
+            result, dur, error)
+
+
+class WorkQueue(object):
+    """ Run func(filename, *args), which returns (result, audio duration),
+        for each of a list of files on a pool of ncores processes.
+
+    :usage:
+       >>> queue = WorkQueue(file_hashes, (analyzer,), ncores=4)
+       >>> for ix, (hashes, dur), error in queue.run(filenames):
+       ...     pass
+       >>> report(queue.stats_msgs())
+    """
+
+    def __init__(self, func, args=(), ncores=1, retries=RETRIES,
+                 report=None, size=file_size):
+        self.func = func
+        self.args = tuple(args)
+        self.ncores = ncores
+        self.retries = retries
+        # Called with a list of progress messages, if not None.
+        self.report = report
+        # How to estimate the work in each file, for longest-first order.
+        self.size = size
+        # Per worker: [files done, audio sec, busy sec]
+        self.stats = {}
+
+    def _progress(self, worker, ix, filename, elapsed, dur):
+        """ Count a finished file in its worker's totals, and report it """
+        stats = self.stats.setdefault(worker, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += dur
+        stats[2] += elapsed
+        if self.report:
+            self.report([time.ctime() + " " + worker + " #" + str(ix) + ": "
+                         + filename + " (%.1f s in %.1f s = %.3f x RT)"
+                         % (dur, elapsed, elapsed / max(dur, 1e-9))])
+
+    def run(self, filenames):
+        """ Generate (index, result, error) for each file, in the order the
+            jobs finish.  Failed files are retried once the others have
+            been started; error is None unless a file failed every time
+            (when result is None). """
+        filenames = list(filenames)
+        todo = longest_first(filenames, self.size)
+        pool = multiprocessing.Pool(self.ncores, initializer=_init_worker,
+                                    initargs=(self.func, self.args))
+        try:
+            tries = 0
+            while todo:
+                failed = []
+                for ix, worker, elapsed, result, dur, error in (
+                        pool.imap_unordered(_run_job, [(ix, filenames[ix])
+                                                       for ix in todo])):
+                    if error is None:
+                        self._progress(worker, ix, filenames[ix], elapsed, dur)
+                        yield ix, result, None
+                    elif tries < self.retries:
+                        if self.report:
+                            self.report([time.ctime() + " " + worker
+                                         + " failed on " + filenames[ix]
+                                         + " (" + error + "), will retry"])
+                        failed.append(ix)
+                    else:
+                        yield ix, None, error
+                todo = failed
+                tries += 1
+        except BaseException:
+            # Includes the consumer abandoning us; don't finish the rest.
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def stats_msgs(self):
+        """ Report the throughput of each worker """
+        msgs = []
+        for worker in sorted(self.stats):
+            nfiles, dur, busy = self.stats[worker]
+            msgs.append("%s: %d files, %.1f s of audio in %.1f s = %.3f x RT"
+                        % (worker, nfiles, dur, busy, busy / max(dur, 1e-9)))
+        return msgs
@@ -0,0 +1,273 @@
+# coding=utf-8
+"""
+audfprint_sweep.py
+
+Parameter sweep for tuning the fingerprinter.  Each reference and query
+file is decoded and turned into an (enhanced) spectrogram only once; every
+combination of peak-picking settings then reuses those spectrograms, and
+every fanout reuses the peaks of its peak-picking settings.
+
+The spectrograms are computed a file at a time by the worker processes
+and kept in .npy files in a temporary directory, which the workers map
+into memory as they need them, rather than all held in RAM.
+"""
+from __future__ import division, print_function
+
+import copy
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import utility.hash_table as hash_table
+import utility.stft as stft
+
+
+def sweep_values(text, convert=float):
+    """ Parse a comma-separated option value like "20,50,100" into a list """
+    return [convert(val) for val in str(text).split(',') if val.strip()]
+
+
+def read_ground_truth(filename):
+    """ Read a list of "query<TAB>reference" lines (the format written by
+        dpwe_matcher.py) into a list of (query, reference) pairs. """
+    pairs = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and fields[0]:
+                pairs.append((fields[0], fields[1]))
+    return pairs
+
+
+def _enhanced_sgrams(analyzer, filename, offsets):
+    """ Decode a file once and return its enhanced spectrogram at each of
+        the sample offsets, plus its duration in seconds. """
+    d, sr = analyzer._read_audio(filename)
+    if not len(d):
+        return [None for _ in offsets], 0.0
+    mywin = np.hanning(analyzer.n_fft + 2)[1:-1]
+    sgrams = stft.stft_batch([d[offset:] for offset in offsets],
+                             n_fft=analyzer.n_fft, hop_length=analyzer.n_hop,
+                             window=mywin, workers=analyzer.fft_workers)
+    return ([analyzer._enhance_sgram(np.abs(sgram)) for sgram in sgrams],
+            len(d) / sr)
+
+
+def _sgrams2peaks(analyzer, sgrams):
+    """ Peaks for each shift's spectrogram, in the form wavfile2peaks uses """
+    peaks = [analyzer._sgram2peaks(sgram) if sgram is not None else []
+             for sgram in sgrams]
+    return peaks[0] if len(peaks) == 1 else peaks
+
+
+# State shared with the sweep worker processes, set up by _init_worker.
+_sweep_state = None
+
+
+def _init_worker(state):
+    """ Pool initializer: receive the sweep's settings once per worker """
+    global _sweep_state
+    _sweep_state = state
+
+
+def _sgram_names(kind, ix):
+    """ The files holding each shift's spectrogram of reference ('ref') or
+        query ('qry') number ix """
+    state = _sweep_state
+    return [os.path.join(state['sgramdir'], '%s%d_%d.npy' % (kind, ix, shift))
+            for shift in range(len(state[kind + '_offsets']))]
+
+
+def _save_sgrams(job):
+    """ Compute the spectrograms of one (kind, ix) file, and save them to
+        their _sgram_names.  Returns the file's duration in seconds. """
+    kind, ix = job
+    state = _sweep_state
+    if kind == 'ref':
+        filename = state['reffiles'][ix]
+    else:
+        filename = state['queries'][ix][0]
+    sgrams, dur = _enhanced_sgrams(state['analyzer'], filename,
+                                   state[kind + '_offsets'])
+    for name, sgram in zip(_sgram_names(kind, ix), sgrams):
+        if sgram is not None:
+            np.save(name, sgram)
+    return dur
+
+
+def _load_sgrams(kind, ix):
+    """ Map the saved spectrograms of a file (None for empty audio) """
+    return [np.load(name, mmap_mode='r') if os.path.exists(name) else None
+            for name in _sgram_names(kind, ix)]
+
+
+def _run_peak_setting(setting):
+    """ Evaluate every fanout for one (density, pks_per_frame, freq_sd)
+        setting.  Returns a list of result dicts, one per fanout. """
+    density, maxpksperframe, f_sd = setting
+    state = _sweep_state
+    analyzer = copy.copy(state['analyzer'])
+    analyzer.density = density
+    analyzer.maxpksperframe = maxpksperframe
+    analyzer.f_sd = f_sd
+    matcher = state['matcher']
+    # Peak picking is shared by all the fanouts.
+    tick = time.time()
+    ref_peaks = [_sgrams2peaks(analyzer, _load_sgrams('ref', ix))
+                 for ix in range(len(state['reffiles']))]
+    ref_peak_time = time.time() - tick
+    tick = time.time()
+    qry_peaks = [_sgrams2peaks(analyzer, _load_sgrams('qry', ix))
+                 for ix in range(len(state['queries']))]
+    qry_peak_time = time.time() - tick
+    rows = []
+    for fanout in state['fanouts']:
+        analyzer.maxpairsperpeak = fanout
+        # Build the index.
+        tick = time.time()
+        ht = hash_table.HashTable(hashbits=state['hashbits'],
+                                  depth=state['depth'],
+                                  maxtime=state['maxtime'])
+        for name, peaks in zip(state['reffiles'], ref_peaks):
+            ht.store(name, analyzer._peaks2hashes(peaks))
+        build_time = ref_peak_time + time.time() - tick
+        nhashes = int(ht.totalhashes())
+        dropped = nhashes - int(np.sum(np.minimum(ht.depth, ht.counts)))
+        qry_hashes = [analyzer._peaks2hashes(peaks) for peaks in qry_peaks]
+        for stop_factor in state['stop_factors']:
+            ht.set_stop_hashes(stop_factor)
+            # Run the queries.
+            tick = time.time()
+            ncorrect = 0
+            for (query, reference), hashes in zip(state['queries'],
+                                                  qry_hashes):
+                results = matcher.match_hashes(ht, hashes)
+                if len(results) and (
+                        os.path.normpath(ht.names[results[0][0]])
+                        == os.path.normpath(reference)):
+                    ncorrect += 1
+            match_time = qry_peak_time + time.time() - tick
+            nqueries = len(state['queries'])
+            nhits = sum(len(ht.get_hits(hashes, skip_stop=True))
+                        for hashes in qry_hashes)
+            rows.append({'density': density,
+                         'fanout': fanout,
+                         'pks_per_frame': maxpksperframe,
+                         'freq_sd': f_sd,
+                         'stop_factor': stop_factor,
+                         'index_hashes': nhashes,
+                         'dropped_pct': 100.0 * dropped / max(1, nhashes),
+                         'stop_pct': 100.0 * ht.stop_hash_stats()[1],
+                         'build_time': build_time,
+                         'match_time': match_time,
+                         'queries_per_sec': nqueries / max(match_time, 1e-9),
+                         'hits_per_query': nhits / max(1, nqueries),
+                         'recall': ncorrect / max(1, nqueries)})
+    return rows
+
+
+class Sweeper(object):
+    """ Build and query one index per combination of fingerprint settings,
+        decoding the audio only once. """
+
+    def __init__(self, analyzer, matcher, hashbits=20, depth=100,
+                 maxtime=16384, query_shifts=4, ncores=1):
+        # Base analyzer: its target_sr, n_fft and n_hop are fixed across the
+        # sweep (they determine the spectrograms we share).
+        self.analyzer = analyzer
+        self.matcher = matcher
+        self.hashbits = hashbits
+        self.depth = depth
+        self.maxtime = maxtime
+        self.query_shifts = query_shifts
+        self.ncores = ncores
+
+    def _offsets(self, shifts):
+        """ Sample offsets of each shift, as in Analyzer.wavfile2peaks """
+        if shifts < 2:
+            return [0]
+        return [int(shift / shifts * self.analyzer.n_hop)
+                for shift in range(shifts)]
+
+    def run(self, reffiles, queries, densities, fanouts, pks_per_frames,
+            freq_sds, stop_factors=(0,), report=None):
+        """ Sweep all the combinations of the value lists.
+        :params:
+          reffiles : list of str
+            the soundfiles to index
+          queries : list of (str, str)
+            (query soundfile, expected reference file) pairs
+          densities, fanouts, pks_per_frames, freq_sds : lists
+            the values to try for each setting
+          stop_factors : list
+            the stop-hash factors to try on each index (0 for none)
+        :returns:
+          rows : list of dict
+            one entry per combination, giving the index size, build and
+            match speed, hits per query, and recall of the top match
+        """
+        reffiles = list(reffiles)
+        queries = list(queries)
+        if report:
+            report([time.ctime() + " sweep: analyzing " + str(len(reffiles))
+                    + " references and " + str(len(queries)) + " queries"])
+        sgramdir = tempfile.mkdtemp(prefix='audfprint_sweep')
+        state = {'analyzer': self.analyzer, 'matcher': self.matcher,
+                 'hashbits': self.hashbits, 'depth': self.depth,
+                 'maxtime': self.maxtime, 'fanouts': list(fanouts),
+                 'stop_factors': list(stop_factors),
+                 'reffiles': reffiles, 'queries': queries,
+                 'ref_offsets': self._offsets(1),
+                 'qry_offsets': self._offsets(self.query_shifts),
+                 'sgramdir': sgramdir}
+        files = ([('ref', ix) for ix in range(len(reffiles))]
+                 + [('qry', ix) for ix in range(len(queries))])
+        settings = list(itertools.product(densities, pks_per_frames,
+                                          freq_sds))
+        try:
+            if self.ncores > 1:
+                pool = multiprocessing.Pool(self.ncores,
+                                            initializer=_init_worker,
+                                            initargs=(state,))
+                try:
+                    durs = pool.map(_save_sgrams, files, chunksize=1)
+                    rowlists = pool.map(_run_peak_setting, settings,
+                                        chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                _init_worker(state)
+                durs = [_save_sgrams(job) for job in files]
+                rowlists = [_run_peak_setting(setting) for setting in settings]
+        finally:
+            shutil.rmtree(sgramdir, ignore_errors=True)
+        ref_dur = sum(durs[:len(reffiles)])
+        rows = [row for rows in rowlists for row in rows]
+        for row in rows:
+            row['build_xrt'] = row['build_time'] / max(ref_dur, 1e-9)
+        return rows
+
+
+SWEEP_HEADER = ("density fanout pks/frm freq_sd stop_k  idx_hashes"
+                " dropped%   stop%  build_s  build_xRT  match_s  qry/sec"
+                "  hits/qry  recall")
+
+
+def format_sweep_rows(rows):
+    """ Format sweep results as the lines of a text table """
+    lines = [SWEEP_HEADER]
+    for row in rows:
+        lines.append(("%7.1f %6d %7d %7.1f %6.1f %11d %8.2f %7.2f %8.2f"
+                      " %10.4f %8.2f %8.2f %9.0f %7.3f") % (
+            row['density'], row['fanout'], row['pks_per_frame'],
+            row['freq_sd'], row['stop_factor'], row['index_hashes'],
+            row['dropped_pct'], row['stop_pct'], row['build_time'],
+            row['build_xrt'], row['match_time'], row['queries_per_sec'],
+            row['hits_per_query'], row['recall']))
+    return lines
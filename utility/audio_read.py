@@ -26,9 +26,6 @@ import threading
 import time
 
 import numpy as np
-# For wavread fallback.
-import scipy.io.wavfile as wav
-
 
 try:
     import queue
@@ -46,19 +43,25 @@ HAVE_FFMPEG = True
 
 def wavread(filename):
   """Read in audio data from a wav file.  Return d, sr."""
+  # Only needed for this fallback, and slow to import.
+  import scipy.io.wavfile
   # Read in wav file.
-  samplerate, wave_data = wav.read(filename)
+  samplerate, wave_data = scipy.io.wavfile.read(filename)
   # Normalize short ints to floats in range [-1..1).
   data = np.asfarray(wave_data) / 32768.0
   return data, samplerate
 
 
-def audio_read(filename, sr=None, channels=None):
-    """Read a soundfile, return (d, sr)."""
+def audio_read(filename, sr=None, channels=None, dtype=np.float32):
+    """Read a soundfile, return (d, sr).  With dtype=np.int16, d holds the
+    samples as read, skipping the conversion to floats."""
     if HAVE_FFMPEG:
-        return audio_read_ffmpeg(filename, sr, channels)
+        return audio_read_ffmpeg(filename, sr, channels, dtype)
     else:
         data, samplerate = wavread(filename)
+        if np.dtype(dtype).kind != 'f':
+            data = np.round(data * 32768.0)
+        data = data.astype(dtype)
         if channels == 1 and len(data.shape) == 2 and data.shape[-1] != 1:
             # Convert stereo to mono.
             data = np.mean(data, axis=-1)
@@ -68,49 +71,36 @@ def audio_read(filename, sr=None, channels=None):
         return data, samplerate
 
 
-def audio_read_ffmpeg(filename, sr=None, channels=None):
-    """Read a soundfile, return (d, sr)."""
+def _parse_duration(s):
+    """Duration in seconds from ffmpeg's (lowercased) info output, or 0."""
+    match = re.search(
+            r'duration: (\d+):(\d+):(\d+).(\d)', s
+    )
+    if not match:
+        return 0.0
+    durparts = list(map(int, match.groups()))
+    return (
+            durparts[0] * 60 * 60 +
+            durparts[1] * 60 +
+            durparts[2] +
+            float(durparts[3]) / 10
+    )
+
+
+def audio_read_ffmpeg(filename, sr=None, channels=None, dtype=np.float32):
+    """Read a soundfile, return (d, sr).  With an integer dtype, d holds
+    the 16 bit samples themselves rather than values in [-1..1)."""
     # Hacked version of librosa.load and audioread/ff.
-    offset = 0.0
-    duration = None
-    dtype = np.float32
-    y = []
     with FFmpegAudioFile(os.path.realpath(filename),
                          sample_rate=sr, channels=channels) as input_file:
         sr = input_file.sample_rate
         channels = input_file.channels
-        s_start = int(np.floor(sr * offset) * channels)
-        if duration is None:
-            s_end = np.inf
-        else:
-            s_end = s_start + int(np.ceil(sr * duration) * channels)
-        num_read = 0
-        for frame in input_file:
-            frame = buf_to_float(frame, dtype=dtype)
-            num_read_prev = num_read
-            num_read += len(frame)
-            if num_read < s_start:
-                # offset is after the current frame, keep reading.
-                continue
-            if s_end < num_read_prev:
-                # we're off the end.  stop reading
-                break
-            if s_end < num_read:
-                # the end is in this frame.  crop.
-                frame = frame[:s_end - num_read_prev]
-            if num_read_prev <= s_start < num_read:
-                # beginning is in this frame
-                frame = frame[(s_start - num_read_prev):]
-            # tack on the current frame
-            y.append(frame)
-
-        if not len(y):
-            # Zero-length read
-            y = np.zeros(0, dtype=dtype)
-        else:
-            y = np.concatenate(y)
-            if channels > 1:
-                y = y.reshape((-1, 2)).T
+        y = input_file.read_samples()
+    if np.dtype(dtype).kind == 'f':
+        # Convert all the samples at once.
+        y = buf_to_float(y, dtype=dtype)
+    if channels > 1:
+        y = y.reshape((-1, channels)).T
 
     # Final cleanup for dtype and contiguity
     y = np.ascontiguousarray(y, dtype=dtype)
@@ -187,6 +177,50 @@ class QueueReaderThread(threading.Thread):
                 break
 
 
+class StallWatchdog(threading.Thread):
+    """A thread that kills a process if progress() has not been called for
+    timeout seconds.
+    """
+
+    def __init__(self, proc, timeout=10.0):
+        super(StallWatchdog, self).__init__()
+        self.proc = proc
+        self.timeout = timeout
+        self.daemon = True
+        self.stalled = False
+        self._progressed = False
+        self._done = threading.Event()
+
+    def progress(self):
+        """Note that the process is still producing output."""
+        self._progressed = True
+
+    def stop(self):
+        """Stop watching (e.g. once the process has finished)."""
+        self._done.set()
+
+    def run(self):
+        """Kill the process, and set stalled, if a whole timeout passes
+        without progress(), unless stop() comes first."""
+        while not self._done.wait(self.timeout):
+            if not self._progressed:
+                self.stalled = True
+                try:
+                    self.proc.kill()
+                except OSError:
+                    # Already gone.
+                    pass
+                break
+            self._progressed = False
+
+
+# Bytes read from ffmpeg at a time by read_samples().
+READ_BLOCK = 1 << 20
+# Extra seconds allowed for when preallocating from the header's duration,
+# which is only given to a tenth of a second.
+DURATION_SLACK = 0.5
+
+
 class FFmpegAudioFile(object):
     """An audio file decoded by the ffmpeg command-line utility."""
 
@@ -206,10 +240,11 @@ class FFmpegAudioFile(object):
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
 
-        # Start another thread to consume the standard output of the
-        # process, which contains raw audio data.
-        self.stdout_reader = QueueReaderThread(self.proc.stdout, block_size)
-        self.stdout_reader.start()
+        # The standard output, which contains raw audio data, is read
+        # either directly by read_samples(), or by another thread started
+        # when iterating over blocks of it.
+        self.block_size = block_size
+        self.stdout_reader = None
 
         # Read relevant information from stderr.
         try:
@@ -227,6 +262,10 @@ class FFmpegAudioFile(object):
         """Read blocks of raw PCM data from the file."""
         # Read from stdout in a separate thread and consume data from
         # the queue.
+        if self.stdout_reader is None:
+            self.stdout_reader = QueueReaderThread(self.proc.stdout,
+                                                   self.block_size)
+            self.stdout_reader.start()
         start_time = time.time()
         while True:
             # Wait for data to be available or a timeout.
@@ -253,6 +292,46 @@ class FFmpegAudioFile(object):
                         # Keep waiting.
                         continue
 
+    def read_samples(self, timeout=10.0):
+        """Read all of the (remaining) PCM data straight into one array of
+        16 bit samples (interleaved, if several channels), preallocated
+        from the duration in the header.
+        """
+        if self.stdout_reader is not None:
+            raise ValueError("already being read in blocks")
+        nsamples = int(np.ceil((self.duration + DURATION_SLACK)
+                               * self.sample_rate)) * self.channels
+        samples = np.empty(max(nsamples, READ_BLOCK // 2), '<i2')
+        buf = samples.view(np.uint8)
+        nbytes = 0
+        watchdog = StallWatchdog(self.proc, timeout)
+        watchdog.start()
+        try:
+            while True:
+                if nbytes == len(buf):
+                    # The header's duration was short; double up.
+                    samples = np.r_[samples, np.empty_like(samples)]
+                    buf = samples.view(np.uint8)
+                count = self.proc.stdout.readinto(
+                        buf[nbytes:nbytes + READ_BLOCK])
+                if not count:
+                    # End of file.
+                    break
+                nbytes += count
+                watchdog.progress()
+        finally:
+            watchdog.stop()
+        if watchdog.stalled:
+            # FFmpeg was hanging.
+            raise ValueError('ffmpeg output: {}'.format(
+                    b''.join(self.stderr_reader.queue.queue).decode(
+                            'utf8', 'ignore')))
+        nsamples = nbytes // 2
+        if 2 * nsamples < len(samples):
+            # Don't hold on to a buffer that was much too big.
+            return samples[:nsamples].copy()
+        return samples[:nsamples]
+
     def _get_info(self):
         """Reads the tool's output from its stderr stream, extracts the
         relevant information, and parses it.
@@ -311,22 +390,8 @@ class FFmpegAudioFile(object):
         if self.channels is None:
             self.channels = self.channels_orig
 
-        # Duration.
-        match = re.search(
-                r'duration: (\d+):(\d+):(\d+).(\d)', s
-        )
-        if match:
-            durparts = list(map(int, match.groups()))
-            duration = (
-                    durparts[0] * 60 * 60 +
-                    durparts[1] * 60 +
-                    durparts[2] +
-                    float(durparts[3]) / 10
-            )
-            self.duration = duration
-        else:
-            # No duration found.
-            self.duration = 0
+        # Duration (0 if not found).
+        self.duration = _parse_duration(s)
 
     def close(self):
         """Close the ffmpeg process used to perform the decoding."""
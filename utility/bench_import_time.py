@@ -0,0 +1,102 @@
+# coding=utf-8
+"""
+bench_import_time.py
+
+Guard the command-line startup time: times a cold "import audfprint" in a
+fresh interpreter (less the interpreter's own startup), and checks that
+the modules only some commands need (scipy, psutil, graphics, the
+multiprocessing helpers) are not loaded up front.  Exits with status 1 if
+the import is over budget or a deferred module was loaded, listing the
+slowest imports to show where the time went.
+
+Usage: python -m utility.bench_import_time [budget_ms [repeats]]
+"""
+from __future__ import division, print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Longest acceptable cold import of audfprint (ms).
+IMPORT_BUDGET_MS = 500
+# Modules that should only be imported by the commands that use them.
+DEFERRED_MODULES = ['scipy', 'psutil', 'matplotlib', 'librosa', 'joblib',
+                    'multiprocessing', 'utility.audfprint_sweep',
+                    'utility.audfprint_bench', 'utility.audfprint_schedule']
+# Where audfprint.py lives.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(code, options=()):
+    """ Run code in a fresh interpreter; return (elapsed sec, stdout,
+        stderr) """
+    tick = time.time()
+    proc = subprocess.Popen([sys.executable] + list(options) + ['-c', code],
+                            cwd=ROOT, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    elapsed = time.time() - tick
+    if proc.returncode:
+        raise RuntimeError(err.decode('utf-8', 'replace'))
+    return elapsed, out.decode('utf-8'), err.decode('utf-8')
+
+
+def import_time(repeats=5):
+    """ Best-of-repeats time (sec) to import audfprint, beyond the time to
+        start the interpreter at all """
+    startup = min(run_python('pass')[0] for _ in range(repeats))
+    total = min(run_python('import audfprint')[0] for _ in range(repeats))
+    return max(0.0, total - startup)
+
+
+def loaded_deferred():
+    """ The DEFERRED_MODULES (or their submodules) loaded by importing
+        audfprint """
+    _, out, _ = run_python(
+        'import json, sys, audfprint; print(json.dumps(sorted(sys.modules)))')
+    loaded = json.loads(out)
+    return [name for name in DEFERRED_MODULES
+            if any(module == name or module.startswith(name + '.')
+                   for module in loaded)]
+
+
+def slowest_imports(count=10):
+    """ The modules that take longest (cumulative usec) to import
+        with audfprint, as reported by -X importtime (Python 3.7+) """
+    try:
+        _, _, err = run_python('import audfprint', ['-X', 'importtime'])
+    except RuntimeError:
+        return []
+    rows = []
+    for line in err.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and len(fields) == 3:
+            try:
+                rows.append((int(fields[1]), fields[2].rstrip()))
+            except ValueError:
+                # The header line.
+                pass
+    return sorted(rows, reverse=True)[:count]
+
+
+def bench(budget_ms=IMPORT_BUDGET_MS, repeats=5):
+    """ Report the import time and any deferred modules loaded; True if
+        within budget and none were """
+    elapsed_ms = 1000 * import_time(repeats)
+    deferred = loaded_deferred()
+    print("import audfprint: %.0f ms (budget %d ms)" % (elapsed_ms, budget_ms))
+    if deferred:
+        print("loaded at import:", ", ".join(deferred))
+    passed = elapsed_ms <= budget_ms and not deferred
+    if not passed:
+        print("slowest imports (cumulative):")
+        for usec, name in slowest_imports():
+            print("  %8.1f ms %s" % (usec / 1000, name))
+    return passed
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(0 if bench(*args) else 1)
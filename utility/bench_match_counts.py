@@ -0,0 +1,140 @@
+# coding=utf-8
+"""
+bench_match_counts.py
+
+Benchmark for Matcher._approx_match_counts and _exact_match_counts: times
+the vectorized versions against the original per-id loops on synthetic hit
+lists, and checks that both give identical rows.
+
+Usage: python -m utility.bench_match_counts [ncands [nhits [repeats]]]
+"""
+from __future__ import division, print_function
+
+import sys
+import time
+
+import numpy as np
+
+import utility.audfprint_match as audfprint_match
+
+
+def approx_match_counts_loop(matcher, hits, ids, rawcounts):
+    """ The original one-id-at-a-time _approx_match_counts (without the
+        time ranges), kept as the reference for the benchmark. """
+    results = np.zeros((len(ids), 7), np.int32)
+    if not hits.size:
+        return results
+    allids = hits[:, 0].astype(int)
+    alltimes = hits[:, 1].astype(int)
+    mintime = np.amin(alltimes)
+    alltimes -= mintime
+    nresults = 0
+    for urank, (id, rawcount) in enumerate(zip(ids, rawcounts)):
+        id = int(id)
+        bincounts = np.bincount(alltimes[allids == id])
+        filtered_bincounts = audfprint_match.keep_local_maxes(bincounts)
+        found_this_id = 0
+        while True:
+            mode = np.argmax(filtered_bincounts)
+            if filtered_bincounts[mode] <= matcher.threshcount:
+                break
+            count = np.sum(bincounts[max(0, mode - matcher.window):
+                                     (mode + matcher.window + 1)])
+            results[nresults, :] = [id, count, mode + mintime, rawcount,
+                                    urank, 0, 0]
+            nresults += 1
+            if nresults >= results.shape[0]:
+                results = np.vstack([results, np.zeros(results.shape,
+                                                       np.int32)])
+            filtered_bincounts[max(0, mode - matcher.window):
+                               (mode + matcher.window + 1)] = 0
+            found_this_id += 1
+            if found_this_id > matcher.max_alignments_per_id:
+                break
+    return results[:nresults, :]
+
+
+def exact_match_counts_loop(matcher, hits, ids, rawcounts):
+    """ The original per-id, per-mode _exact_match_counts (without the
+        time ranges), kept as the reference for the benchmark. """
+    sorted_hits = hits[hits[:, 3].argsort()]
+    allids = sorted_hits[:, 0]
+    alltimes = sorted_hits[:, 1]
+    rows = []
+    for urank, (id, rawcount) in enumerate(zip(ids, rawcounts)):
+        modes, counts = audfprint_match.find_modes(
+            alltimes[np.nonzero(allids == id)[0]],
+            window=matcher.window, threshold=matcher.threshcount)
+        for mode in modes:
+            filtcount = len(matcher._unique_match_hashes(id, sorted_hits,
+                                                         mode))
+            if filtcount >= matcher.threshcount:
+                rows.append([id, filtcount, mode, rawcount, urank, 0, 0])
+    return np.array(rows, np.int32).reshape((-1, 7))
+
+
+def synthetic_hits(ncands=100, nhits=200000, maxtime=8000, seed=0):
+    """ Hits spread over ncands reference ids: mostly random time skews, plus
+        a few clusters of aligned hits (with some jitter) per id. """
+    rng = np.random.RandomState(seed)
+    ids = rng.randint(0, ncands, nhits)
+    dtimes = rng.randint(-maxtime, maxtime, nhits)
+    aligned = rng.rand(nhits) < 0.3
+    centers = rng.randint(-maxtime, maxtime, (ncands, 3))
+    dtimes[aligned] = (centers[ids[aligned], rng.randint(0, 3, aligned.sum())]
+                       + rng.randint(-2, 3, aligned.sum()))
+    hashes = rng.randint(0, 1 << 20, nhits)
+    otimes = rng.randint(0, maxtime, nhits)
+    return np.c_[ids, dtimes, hashes, otimes].astype(np.int32)
+
+
+def candidates(matcher, hits):
+    """ The candidate ids and raw counts, ranked by raw count as
+        _best_count_ids would for reference tracks of equal length """
+    ids = np.unique(hits[:, 0])
+    rawcounts = np.bincount(hits[:, 0])[ids]
+    order = np.argsort(rawcounts, kind='stable')[::-1]
+    order = order[:min(np.count_nonzero(rawcounts > matcher.threshcount),
+                       matcher.search_depth)]
+    return ids[order], rawcounts[order]
+
+
+def bench(ncands=100, nhits=200000, repeats=3):
+    """ Time both versions on one synthetic hit list; True if they agree """
+    matcher = audfprint_match.Matcher()
+    matcher.search_depth = ncands
+    matcher.max_alignments_per_id = 3
+    hits = synthetic_hits(ncands, nhits)
+    ids, rawcounts = candidates(matcher, hits)
+    print("%d hits over %d candidate ids" % (nhits, len(ids)))
+    all_identical = True
+    for mode, reference, method in [
+            ('approx', approx_match_counts_loop, matcher._approx_match_counts),
+            ('exact', exact_match_counts_loop, matcher._exact_match_counts)]:
+        timings = {}
+        outputs = {}
+        for name, func in [('loop', lambda: reference(
+                                matcher, hits, ids, rawcounts)),
+                           ('vectorized', lambda: method(
+                                hits, ids, rawcounts))]:
+            best = None
+            for _ in range(repeats):
+                tick = time.time()
+                outputs[name] = func()
+                elapsed = time.time() - tick
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+        identical = np.array_equal(outputs['loop'], outputs['vectorized'])
+        all_identical = all_identical and identical
+        print("%s: %d result rows" % (mode, len(outputs['loop'])))
+        for name in ['loop', 'vectorized']:
+            print("  %-11s %8.4f s" % (name, timings[name]))
+        print("  speedup     %8.1f x" % (timings['loop']
+                                          / max(timings['vectorized'], 1e-9)))
+        print("  identical  ", identical)
+    return all_identical
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(0 if bench(*args) else 1)
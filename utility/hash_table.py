@@ -10,13 +10,16 @@ used for the audfprint fingerprinter.
 from __future__ import division, print_function
 
 import gzip
+import hashlib
 import math
 import os
-import random
 import sys
+import tempfile
+import uuid
 
 import numpy as np
-import scipy.io
+
+import utility.profiling as profiling
 
 if sys.version_info[0] >= 3:
     # Python 3 specific definitions
@@ -35,6 +38,8 @@ HT_VERSION = 20170724
 HT_COMPAT_VERSION = 20170724
 # Earliest version that can be updated with load_old
 HT_OLD_COMPAT_VERSION = 20140920
+# Buckets merged at a time, bounding the temporary arrays of merge().
+MERGE_CHUNK = 1 << 14
 
 
 def _bitsfor(maxval):
@@ -75,6 +80,15 @@ class HashTable(object):
             self.hashesperid = np.zeros(0, np.uint32)
             # Empty params
             self.params = {}
+            # Buckets offered more than stop_factor * depth entries hold
+            # "stop hashes", skipped on lookup (recomputed on save).
+            self.stop_factor = None
+            self.stop_hashes = None
+            # Identity of this table, and count of changes made to it, so
+            # cached match results can tell when they are out of date.
+            self.uuid = uuid.uuid4().hex
+            self.generation = 0
+            self._uuid_from_file = False
             # Record the current version
             self.ht_version = HT_VERSION
             # Mark as unsaved
@@ -86,56 +100,91 @@ class HashTable(object):
         self.counts[:] = 0
         self.names = []
         self.hashesperid.resize(0)
+        self.stop_hashes = None
+        self._changed()
+
+    def _changed(self):
+        """ Note a change to the contents: a new generation, unsaved.
+            A table read from a file takes a new uuid when first changed,
+            as other processes may load and change the same file. """
+        if getattr(self, '_uuid_from_file', False):
+            self.uuid = uuid.uuid4().hex
+            self._uuid_from_file = False
+        self.generation += 1
         self.dirty = True
 
+    def set_stop_hashes(self, stop_factor):
+        """ Mark as stop hashes the ones whose buckets have been offered
+            more than stop_factor * depth entries (None or 0 clears them).
+            Such very common hashes produce many hits but almost no
+            evidence for any one item. """
+        self.stop_factor = stop_factor
+        if not stop_factor:
+            self.stop_hashes = None
+        else:
+            self.stop_hashes = np.nonzero(self.counts
+                                          > stop_factor * self.depth)[0]
+
+    def stop_hash_stats(self):
+        """ Return the number of stop hashes, and the proportion of the
+            stored entries (hence of chance hits) that they hold """
+        if self.stop_hashes is None:
+            return 0, 0.0
+        stored = np.minimum(self.depth, self.counts)
+        return (len(self.stop_hashes),
+                np.sum(stored[self.stop_hashes]) / max(1, np.sum(stored)))
+
+    def _stop_report(self):
+        """ Describe the stop hashes for the save/load messages """
+        if self.stop_hashes is None:
+            return ""
+        nstop, stopfrac = self.stop_hash_stats()
+        return ", %d stop hashes holding %.2f%% of entries" % (
+            nstop, 100.0 * stopfrac)
+
+    @profiling.timed('table.store')
     def store(self, name, timehashpairs):
         """ Store a list of hashes in the hash table
             associated with a particular name (or integer ID) and time.
         """
         id_ = self.name_to_id(name, add_if_missing=True)
-        # Now insert the hashes
-        hashmask = (1 << self.hashbits) - 1
-        # mxtime = self.maxtime
-        maxtime = 1 << self.maxtimebits
-        timemask = maxtime - 1
-        # Try sorting the pairs by hash value, for better locality in storing
-        # sortedpairs = sorted(timehashpairs, key=lambda x:x[1])
-        sortedpairs = timehashpairs
-        # Tried making it an np array to permit vectorization, but slower...
-        # sortedpairs = np.array(sorted(timehashpairs, key=lambda x:x[1]),
-        #                       dtype=int)
-        # Keep only the bottom part of the time value
-        # sortedpairs[:,0] = sortedpairs[:,0] % self.maxtime
-        # Keep only the bottom part of the hash value
-        # sortedpairs[:,1] = sortedpairs[:,1] & hashmask
-        # The id value is based on (id_ + 1) to avoid an all-zero value.
-        idval = (id_ + 1) << self.maxtimebits
-        for time_, hash_ in sortedpairs:
-            # Keep only the bottom part of the hash value
-            hash_ &= hashmask
-            # How many already stored for this hash?
-            count = self.counts[hash_]
-            # Keep only the bottom part of the time value
-            # time_ %= mxtime
-            time_ &= timemask
-            # Mixin with ID
-            val = (idval + time_)  # .astype(np.uint32)
-            if count < self.depth:
-                # insert new val in next empty slot
-                # slot = self.counts[hash_]
-                self.table[hash_, count] = val
-            else:
-                # Choose a point at random
-                slot = random.randint(0, count)
-                # Only store if random slot wasn't beyond end
-                if slot < self.depth:
-                    self.table[hash_, slot] = val
-            # Update record of number of vals in this bucket
-            self.counts[hash_] = count + 1
+        pairs = np.asarray(timehashpairs, dtype=np.int64).reshape((-1, 2))
+        if len(pairs):
+            # Keep only the bottom part of the hash and time values
+            hashes = pairs[:, 1] & ((1 << self.hashbits) - 1)
+            # The id value is based on (id_ + 1) to avoid an all-zero value.
+            vals = (((id_ + 1) << self.maxtimebits)
+                    + (pairs[:, 0] & ((1 << self.maxtimebits) - 1))
+                    ).astype(np.uint32)
+            # How many entries each bucket will have been offered before
+            # each pair, as if the pairs were stored one at a time.
+            order = np.argsort(hashes, kind='stable')
+            sorted_hashes = hashes[order]
+            firsts = np.r_[0, np.nonzero(np.diff(sorted_hashes))[0] + 1]
+            lengths = np.diff(np.r_[firsts, len(order)])
+            before = np.empty(len(order), np.int64)
+            before[order] = (np.arange(len(order))
+                             - np.repeat(firsts, lengths))
+            before += self.counts[hashes]
+            # Pairs beyond a full bucket replace a random slot, or nothing
+            # if the slot chosen (out of count + 1) is beyond the end.
+            slots = before.copy()
+            full = np.nonzero(before >= self.depth)[0]
+            slots[full] = np.random.randint(0, before[full] + 1)
+            stored = np.nonzero(slots < self.depth)[0]
+            # Where one slot is written several times, the last one wins.
+            cells = hashes[stored] * self.depth + slots[stored]
+            _, lastix = np.unique(cells[::-1], return_index=True)
+            stored = stored[len(stored) - 1 - lastix]
+            self.table[hashes[stored], slots[stored]] = vals[stored]
+            # Update record of number of vals in each bucket
+            self.counts[sorted_hashes[firsts]] += lengths.astype(
+                self.counts.dtype)
         # Record how many hashes we (attempted to) save for this id
         self.hashesperid[id_] += len(timehashpairs)
+        profiling.count('stored_hashes', len(timehashpairs))
         # Mark as unsaved
-        self.dirty = True
+        self._changed()
 
     def get_entry(self, hash_):
         """ Return np.array of [id, time] entries
@@ -147,33 +196,66 @@ class HashTable(object):
         ids = (vals >> self.maxtimebits) - 1
         return np.c_[ids, vals & maxtimemask].astype(np.int32)
 
-    def get_hits(self, hashes):
+    @profiling.timed('table.get_hits')
+    def _lookup(self, hashes, skip_stop=False):
+        """ Look up every [time, hash] row of hashes at once.  Each distinct
+            bucket is read from the table and decoded only once, however
+            many query rows share it.  Returns (hits, rows): the hits as for
+            get_hits, in the same order, and the index of the query row
+            that produced each one. """
+        hashes = np.asarray(hashes).reshape((-1, 2))
+        maxtimemask = (1 << self.maxtimebits) - 1
+        hashmask = (1 << self.hashbits) - 1
+        times = hashes[:, 0].astype(np.int64)
+        buckets, inverse = np.unique(hashes[:, 1].astype(np.int64) & hashmask,
+                                     return_inverse=True)
+        inverse = inverse.ravel()
+        nids = np.minimum(self.depth, self.counts[buckets]).astype(np.int64)
+        if skip_stop and self.stop_hashes is not None:
+            nids[np.isin(buckets, self.stop_hashes)] = 0
+        # The valid entries of every distinct bucket, end to end.
+        firsts = np.cumsum(nids) - nids
+        slots = (np.arange(np.sum(nids))
+                 - np.repeat(firsts, nids))
+        tabvals = self.table[np.repeat(buckets, nids), slots]
+        # Make external IDs start from 0.
+        bucket_ids = (tabvals >> self.maxtimebits).astype(np.int64) - 1
+        bucket_times = (tabvals & maxtimemask).astype(np.int64)
+        # Expand back out to one run of entries per query row.
+        lengths = nids[inverse]
+        rows = np.repeat(np.arange(len(hashes)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        entries = (np.arange(np.sum(lengths))
+                   + np.repeat(firsts[inverse] - starts, lengths))
+        hits = np.zeros((len(entries), 4), np.int32)
+        hits[:, 0] = bucket_ids[entries]
+        hits[:, 1] = bucket_times[entries] - times[rows]
+        hits[:, 2] = buckets[inverse[rows]]
+        hits[:, 3] = times[rows]
+        profiling.count('query_hashes', len(hashes))
+        profiling.count('hits', len(hits))
+        return hits, rows
+
+    def get_hits(self, hashes, skip_stop=False):
         """ Return np.array of [id, delta_time, hash, time] rows
             associated with each element in hashes array of [time, hash] rows.
-            This version has get_entry() inlined, it's about 30% faster.
+            If skip_stop, the stop hashes give no hits.
         """
-        # Allocate to largest possible number of hits
-        nhashes = np.shape(hashes)[0]
-        hits = np.zeros((nhashes * self.depth, 4), np.int32)
-        nhits = 0
-        maxtimemask = (1 << self.maxtimebits) - 1
-        hashmask = (1 << self.hashbits) - 1
-        # Fill in
-        for ix in range(nhashes):
-            time_ = hashes[ix][0]
-            hash_ = hashmask & hashes[ix][1]
-            nids = min(self.depth, self.counts[hash_])
-            tabvals = self.table[hash_, :nids]
-            hitrows = nhits + np.arange(nids)
-            # Make external IDs start from 0.
-            hits[hitrows, 0] = (tabvals >> self.maxtimebits) - 1
-            hits[hitrows, 1] = (tabvals & maxtimemask) - time_
-            hits[hitrows, 2] = hash_
-            hits[hitrows, 3] = time_
-            nhits += nids
-        # Discard the excess rows
-        hits.resize((nhits, 4))
-        return hits
+        return self._lookup(hashes, skip_stop)[0]
+
+    def get_hits_batch(self, hashes_list, skip_stop=False):
+        """ Look up the hashes of several queries in a single pass.
+            Returns (hits, query_ids): the get_hits rows for all of the
+            queries, in query order, and the index into hashes_list of the
+            query that each row belongs to. """
+        query_ids = np.repeat(np.arange(len(hashes_list)),
+                              [len(hashes) for hashes in hashes_list])
+        if not len(query_ids):
+            return np.zeros((0, 4), np.int32), query_ids
+        hits, rows = self._lookup(np.concatenate(
+            [np.asarray(hashes).reshape((-1, 2)) for hashes in hashes_list]),
+            skip_stop)
+        return hits, query_ids[rows]
 
     def save(self, name, params=None, file_object=None):
         """ Save hash table to file <name>,
@@ -187,6 +269,8 @@ class HashTable(object):
             f = file_object
         else:
             f = gzip.open(name, 'wb')
+        # Bring the stop hashes up to date with the final counts
+        self.set_stop_hashes(self.stop_factor)
         pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
         self.dirty = False
         nhashes = sum(self.counts)
@@ -194,7 +278,8 @@ class HashTable(object):
         dropped = nhashes - sum(np.minimum(self.depth, self.counts))
         print("Saved fprints for", sum(n is not None for n in self.names),
               "files (", nhashes, "hashes) to", name,
-              "(%.2f%% dropped)" % (100.0 * dropped / max(1, nhashes)))
+              "(%.2f%% dropped%s)" % (100.0 * dropped / max(1, nhashes),
+                                      self._stop_report()))
 
     def load(self, name):
         """ Read either pklz or mat-format hash table file """
@@ -208,7 +293,8 @@ class HashTable(object):
         dropped = nhashes - sum(np.minimum(self.depth, self.counts))
         print("Read fprints for", sum(n is not None for n in self.names),
               "files (", nhashes, "hashes) from", name,
-              "(%.2f%% dropped)" % (100.0 * dropped / max(1, nhashes)))
+              "(%.2f%% dropped%s)" % (100.0 * dropped / max(1, nhashes),
+                                      self._stop_report()))
 
     def load_pkl(self, name, file_object=None):
         """ Read hash table values from pickle file <name>. """
@@ -242,6 +328,13 @@ class HashTable(object):
         self.counts = temp.counts
         self.names = temp.names
         self.hashesperid = np.array(temp.hashesperid).astype(np.uint32)
+        self.stop_factor = getattr(temp, 'stop_factor', None)
+        self.stop_hashes = getattr(temp, 'stop_hashes', None)
+        # Tables saved before these were kept get an identity from
+        # their contents.
+        self.uuid = getattr(temp, 'uuid', None) or self._content_id()
+        self.generation = getattr(temp, 'generation', 0)
+        self._uuid_from_file = True
         self.dirty = False
         self.params = params
 
@@ -261,6 +354,8 @@ class HashTable(object):
               'targetsr' : float
                 target sampling rate from Matlab file (must be 11025)
         """
+        # Only needed here, and slow to import.
+        import scipy.io
         mht = scipy.io.loadmat(name)
         params = {}
         params['mat_version'] = mht['HT_params'][0][0][-1][0][0]
@@ -281,9 +376,20 @@ class HashTable(object):
         # Matlab uses 1-origin for the IDs in the hashes, but the Python code
         # also skips using id_ 0, so that names[0] corresponds to id_ 1.
         # Otherwise unmodified database
+        self.stop_factor = None
+        self.stop_hashes = None
+        self.uuid = self._content_id()
+        self.generation = 0
+        self._uuid_from_file = True
         self.dirty = False
         self.params = params
 
+    def _content_id(self):
+        """ An identity for a table that was saved without one """
+        sha = hashlib.sha1(np.ascontiguousarray(self.counts).tobytes())
+        sha.update(repr(self.names).encode('utf-8'))
+        return sha.hexdigest()
+
     def totalhashes(self):
         """ Return the total count of hashes stored in the table """
         return np.sum(self.counts)
@@ -299,28 +405,49 @@ class HashTable(object):
         self.hashesperid = np.append(self.hashesperid, ht.hashesperid)
         # Shift all the IDs in the second table down by ncurrent
         idoffset = (1 << self.maxtimebits) * ncurrent
-        for hash_ in np.nonzero(ht.counts)[0]:
-            allvals = np.r_[self.table[hash_, :self.counts[hash_]],
-                            ht.table[hash_, :ht.counts[hash_]] + idoffset]
-            # ht.counts[hash_] may be more than the actual number of
-            # hashes we obtained, if ht.counts[hash_] > ht.depth.
-            # Subselect based on actual size.
-            if len(allvals) > self.depth:
-                # Our hash bin is filled: randomly subselect the
-                # hashes, and update count to accurately track the
-                # total number of hashes we've seen for this bin.
-                somevals = np.random.permutation(allvals)[:self.depth]
-                self.table[hash_,] = somevals
-                self.counts[hash_] += ht.counts[hash_]
-            else:
-                # Our bin isn't full.  Store all the hashes, and
-                # accurately track how many values it contains.  This
-                # may mean some of the hashes counted for full buckets
-                # in ht are "forgotten" if ht.depth < self.depth.
-                self.table[hash_, :len(allvals)] = allvals
-                self.counts[hash_] = len(allvals)
+        hashes = np.nonzero(ht.counts)[0]
+        for start in range(0, len(hashes), MERGE_CHUNK):
+            self._merge_buckets(ht, hashes[start:start + MERGE_CHUNK],
+                                idoffset)
+        self._changed()
 
-        self.dirty = True
+    def _merge_buckets(self, ht, hashes, idoffset):
+        """ Merge ht's entries in buckets <hashes> into ours """
+        # The counts may be more than the number of hashes actually held,
+        # if count > depth.  Subselect based on actual size.
+        nours = np.minimum(self.counts[hashes], self.depth)
+        ntheirs = np.minimum(ht.counts[hashes], ht.depth)
+        fits = nours + ntheirs <= self.depth
+        # Where our bin isn't full, store all their hashes after ours, and
+        # accurately track how many values it contains.  This may mean
+        # some of the hashes counted for full buckets in ht are
+        # "forgotten" if ht.depth < self.depth.  A bin that is now just
+        # full keeps the total count, so merges give the same counts in
+        # any order.
+        fit = hashes[fits]
+        nnew = ntheirs[fits]
+        slots = np.arange(np.sum(nnew)) - np.repeat(np.cumsum(nnew) - nnew,
+                                                    nnew)
+        rows = np.repeat(fit, nnew)
+        self.table[rows, np.repeat(nours[fits], nnew) + slots] = (
+            ht.table[rows, slots] + idoffset)
+        nstored = nours[fits] + nnew
+        self.counts[fit] = np.where(nstored < self.depth, nstored,
+                                    self.counts[fit] + ht.counts[fit])
+        # Where our bin is filled, randomly subselect from both sets of
+        # hashes, and update count to accurately track the total number of
+        # hashes we've seen for this bin.
+        full = hashes[~fits]
+        if len(full):
+            both = np.c_[self.table[full], ht.table[full] + idoffset]
+            cols = np.arange(both.shape[1])
+            valid = np.where(cols < self.depth,
+                             cols < nours[~fits][:, np.newaxis],
+                             cols - self.depth < ntheirs[~fits][:, np.newaxis])
+            keys = np.where(valid, np.random.random_sample(both.shape), 2.0)
+            keep = np.argsort(keys, axis=1)[:, :self.depth]
+            self.table[full] = both[np.arange(len(full))[:, np.newaxis], keep]
+            self.counts[full] += ht.counts[full]
 
     def name_to_id(self, name, add_if_missing=False):
         """ Lookup name in the names list, or optionally add. """
@@ -360,7 +487,7 @@ class HashTable(object):
             hashes_removed += np.sum(id_in_table[hash_])
         self.names[id_] = None
         self.hashesperid[id_] = 0
-        self.dirty = True
+        self._changed()
         print("Removed", name, "(", hashes_removed, "hashes).")
 
     def retrieve(self, name):
@@ -389,3 +516,122 @@ class HashTable(object):
         for name, count in zip(self.names, self.hashesperid):
             if name:
                 print_fn(name + " (" + str(count) + " hashes)")
+
+
+def _shared_memory():
+    """ Return multiprocessing.shared_memory (Python 3.8+), or None """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return None
+    return shared_memory
+
+
+class SharedTable(object):
+    """
+    A read-only copy of a HashTable's big arrays placed in OS shared memory
+    (or, without multiprocessing.shared_memory, a memory-mapped temporary
+    file), so that worker processes can all use the one copy.  Pickles as a
+    small handle; unpickled in a worker, hash_table() attaches to the
+    shared arrays.
+
+    :usage:
+       >>> with SharedTable(ht) as shared:
+       ...     pool = multiprocessing.Pool(4, initializer=init,
+       ...                                 initargs=(shared,))
+       >>> # in the worker: ht = shared.hash_table()
+    """
+    # The HashTable attributes that are shared rather than copied.
+    ARRAYS = ['table', 'counts']
+    # The small ones that are pickled to each worker.
+    ATTRIBUTES = ['hashbits', 'depth', 'maxtimebits', 'names', 'hashesperid',
+                  'params', 'ht_version', 'stop_factor', 'stop_hashes',
+                  'uuid', 'generation']
+
+    def __init__(self, ht):
+        self.attributes = dict((attr, getattr(ht, attr, None))
+                               for attr in self.ATTRIBUTES)
+        # (name or path, shape, dtype) for each array
+        self.blocks = {}
+        self._owner = True
+        self._handles = []
+        shared_memory = _shared_memory()
+        for attr in self.ARRAYS:
+            array = getattr(ht, attr)
+            if shared_memory is not None:
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(1, array.nbytes))
+                np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+                self._handles.append(shm)
+                location = shm.name
+            else:
+                fd, location = tempfile.mkstemp(suffix='.' + attr)
+                os.close(fd)
+                mapped = np.memmap(location, dtype=array.dtype, mode='w+',
+                                   shape=array.shape)
+                mapped[...] = array
+                mapped.flush()
+                del mapped
+            self.blocks[attr] = (location, array.shape, array.dtype.str)
+        self._table = None
+
+    def __getstate__(self):
+        return {'attributes': self.attributes, 'blocks': self.blocks}
+
+    def __setstate__(self, state):
+        self.attributes = state['attributes']
+        self.blocks = state['blocks']
+        self._owner = False
+        self._handles = []
+        self._table = None
+
+    def _attach(self, attr):
+        """ Map one of the shared arrays, read-only """
+        location, shape, dtype = self.blocks[attr]
+        shared_memory = _shared_memory()
+        if shared_memory is not None:
+            shm = shared_memory.SharedMemory(name=location)
+            # Keep the mapping open as long as we are.
+            self._handles.append(shm)
+            array = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+        else:
+            array = np.memmap(location, dtype=np.dtype(dtype), mode='r',
+                              shape=shape)
+        array.flags.writeable = False
+        return array
+
+    def hash_table(self):
+        """ A HashTable using the shared arrays (only for lookups) """
+        if self._table is None:
+            # np.zeros doesn't touch the pages it would allocate, so this
+            # placeholder table costs nothing before it is replaced.
+            ht = HashTable(hashbits=self.attributes['hashbits'],
+                           depth=self.attributes['depth'],
+                           maxtime=1 << self.attributes['maxtimebits'])
+            for attr, value in self.attributes.items():
+                setattr(ht, attr, value)
+            for attr in self.ARRAYS:
+                setattr(ht, attr, self._attach(attr))
+            ht.dirty = False
+            self._table = ht
+        return self._table
+
+    def close(self):
+        """ Release the shared arrays (and, in the creating process,
+            free them) """
+        self._table = None
+        for shm in self._handles:
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._handles = []
+        if self._owner and _shared_memory() is None:
+            for location, _, _ in self.blocks.values():
+                if os.path.exists(location):
+                    os.remove(location)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
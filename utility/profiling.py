@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+profiling.py
+
+Lightweight instrumentation for audfprint.  The analyzer, hash table and
+matcher time their stages with timer() (or the timed() decorator) and
+tally what they produce with count(); these do nothing unless a Profile
+has been started, so they cost next to nothing in normal runs.
+
+    >>> profiling.start()
+    >>> analyzer.ingest(ht, filename)
+    >>> profiling.stop().as_dict()
+    {'stages': {'analyze.decode': {'seconds': 0.01, 'calls': 1}, ...},
+     'counts': {'peaks': 1210, 'landmarks': 3630, ...}}
+"""
+from __future__ import division, print_function
+
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+# The Profile being recorded, or None.
+_active = None
+
+
+class Profile(object):
+    """ Accumulated time and calls of each stage, and counts of items """
+
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+        self.calls = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        # Stages may run in several threads (e.g. a TableFanout).
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def add_count(self, name, n):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def as_dict(self):
+        """ The stage times and counts, ready for json.dump """
+        return collections.OrderedDict([
+            ('stages', collections.OrderedDict(
+                (name, collections.OrderedDict([
+                    ('seconds', seconds), ('calls', self.calls[name])]))
+                for name, seconds in self.seconds.items())),
+            ('counts', collections.OrderedDict(self.counts))])
+
+
+def start():
+    """ Start recording a new Profile, and return it """
+    global _active
+    _active = Profile()
+    return _active
+
+
+def stop():
+    """ Stop recording, and return the Profile recorded (or None) """
+    global _active
+    profile = _active
+    _active = None
+    return profile
+
+
+@contextlib.contextmanager
+def timer(name):
+    """ Add the time spent in the body to stage <name> of the Profile """
+    profile = _active
+    if profile is None:
+        yield
+        return
+    tick = time.time()
+    try:
+        yield
+    finally:
+        profile.add_time(name, time.time() - tick)
+
+
+def timed(name):
+    """ Decorator: time each call of the function as stage <name> """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """ Add n to the count <name> of the Profile """
+    profile = _active
+    if profile is not None:
+        profile.add_count(name, n)
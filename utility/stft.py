@@ -8,6 +8,14 @@ from __future__ import division
 
 import numpy as np
 
+# scipy.fft, for its multi-threaded real FFT: None until first needed
+# (importing scipy is slow), then False if it is not available.
+_scipy_fft = None
+
+# Number of frames transformed at a time by stft().  Bounds the size of the
+# temporary windowed-frame and spectrum blocks independent of signal length.
+CHUNK_FRAMES = 4096
+
 
 def frame(data, window_length, hop_length):
   """Convert array into a sequence of successive possibly overlapping frames.
@@ -59,9 +67,104 @@ def periodic_hann(window_length):
                              np.arange(window_length)))
 
 
-def stft(signal, n_fft, hop_length=None, window=None):
+def _make_window(n_fft, window):
+  """Return the window vector for a window argument of stft()."""
+  if window is None:
+    window = n_fft
+  if isinstance(window, (int, float)):
+    # window holds the window length, need to make the actual window.
+    window = periodic_hann(int(window))
+  return window
+
+
+def num_stft_frames(num_samples, n_fft, hop_length, window_length=None):
+  """Number of frames stft() returns for a signal of num_samples."""
+  if window_length is None:
+    window_length = n_fft
+  return 1 + ((num_samples + 2 * (n_fft // 2) - window_length) // hop_length)
+
+
+def _padded_segment(signal, pad, start, stop):
+  """Samples start:stop of the signal as reflect-padded by pad on each side.
+
+  Only the requested span is built, so the whole signal is never copied;
+  spans entirely inside the signal are returned as views.
+  """
+  num_samples = len(signal)
+  if start >= pad and stop <= pad + num_samples:
+    return signal[start - pad:stop - pad]
+  if num_samples <= pad:
+    # Pathologically short signal, needs repeated reflections.
+    return np.pad(signal, pad, mode='reflect')[start:stop]
+  # Default librosa STFT behavior: reflect about the end samples.
+  index = np.arange(start, stop) - pad
+  index = np.abs(index)
+  index = np.where(index >= num_samples, 2 * (num_samples - 1) - index, index)
+  return signal[index]
+
+
+def windowed_frames(signal, n_fft, hop_length=None, window=None,
+                    start_frame=0, end_frame=None):
+  """Cut a signal into the windowed frames that stft() transforms.
+
+  Args:
+    signal: 1D np.array of the input time-domain signal.
+    n_fft: Size of the FFT to apply.
+    hop_length: Advance (in samples) between each frame passed to FFT. Defaults
+      to half the window length.
+    window: Length of each block of samples to pass to FFT, or vector of window
+      values.  Defaults to n_fft.
+    start_frame, end_frame: Only return frames start_frame up to (but not
+      including) end_frame.  Defaults to all the frames.
+
+  Returns:
+    2D np.array with one windowed frame of samples per row.
+  """
+  window = _make_window(n_fft, window)
+  window_length = len(window)
+  if not hop_length:
+    hop_length = window_length // 2
+  num_frames = num_stft_frames(len(signal), n_fft, hop_length, window_length)
+  start_frame, end_frame, _ = slice(start_frame, end_frame).indices(num_frames)
+  end_frame = max(start_frame, end_frame)
+  segment = _padded_segment(signal, n_fft // 2, start_frame * hop_length,
+                            (end_frame - 1) * hop_length + window_length)
+  frames = frame(segment, window_length, hop_length)[:end_frame - start_frame]
+  # Apply frame window to each frame. We use a periodic Hann (cosine of period
+  # window_length) instead of the symmetric Hann of np.hanning (period
+  # window_length-1).
+  return frames * window
+
+
+def _threaded_fft():
+  """Return the scipy.fft module, or None if it is not available."""
+  global _scipy_fft
+  if _scipy_fft is None:
+    try:
+      import scipy.fft
+      _scipy_fft = scipy.fft
+    except ImportError:
+      _scipy_fft = False
+  return _scipy_fft or None
+
+
+def rfft(frames, n_fft, workers=None):
+  """Real FFT of each row of frames, on several threads if workers > 1
+  (or -1 for all cores) and scipy.fft is available."""
+  if workers is not None and _threaded_fft():
+    return _scipy_fft.rfft(frames, n_fft, workers=workers)
+  return np.fft.rfft(frames, n_fft)
+
+
+def stft(signal, n_fft, hop_length=None, window=None, start_frame=0,
+         end_frame=None, magnitude=False, workers=None,
+         chunk_frames=CHUNK_FRAMES):
   """Calculate the short-time Fourier transform.
 
+  Frames are windowed and transformed chunk_frames at a time into a
+  preallocated output, so the temporary memory needed does not grow with
+  the length of the signal.
+
   Args:
     signal: 1D np.array of the input time-domain signal.
     n_fft: Size of the FFT to apply.
@@ -69,26 +172,89 @@ def stft(signal, n_fft, hop_length=None, window=None):
       to half the window length.
     window: Length of each block of samples to pass to FFT, or vector of window
       values.  Defaults to n_fft.
+    start_frame, end_frame: Only transform this range of frames.  Defaults to
+      all the frames.
+    magnitude: If True, return the (real) magnitudes instead of the complex
+      values.
+    workers: Number of threads for the FFT (-1 for all cores), if the
+      scipy.fft backend is available.  Defaults to a single thread.
+    chunk_frames: Number of frames to transform at a time.
 
   Returns:
     2D np.array where each column contains the complex values of the
     fft_length/2+1 unique values of the FFT for the corresponding frame of
     input samples ("spectrogram transposition").
   """
-  if window is None:
-    window = n_fft
-  if isinstance(window, (int, float)):
-    # window holds the window length, need to make the actual window.
-    window = periodic_hann(int(window))
+  window = _make_window(n_fft, window)
   window_length = len(window)
   if not hop_length:
     hop_length = window_length // 2
-  # Default librosa STFT behavior.
-  pad_mode = 'reflect'
-  signal = np.pad(signal, (n_fft // 2), mode=pad_mode)
-  frames = frame(signal, window_length, hop_length)
-  # Apply frame window to each frame. We use a periodic Hann (cosine of period
-  # window_length) instead of the symmetric Hann of np.hanning (period
-  # window_length-1).
-  windowed_frames = frames * window
-  return np.fft.rfft(windowed_frames, n_fft).transpose()
+  num_frames = num_stft_frames(len(signal), n_fft, hop_length, window_length)
+  start_frame, end_frame, _ = slice(start_frame, end_frame).indices(num_frames)
+  end_frame = max(start_frame, end_frame)
+  dtype = np.float64 if magnitude else np.complex128
+  # Filled one row per frame, returned transposed as before.
+  output = np.empty((end_frame - start_frame, n_fft // 2 + 1), dtype=dtype)
+  for chunk_start in range(start_frame, end_frame, chunk_frames):
+    chunk_end = min(end_frame, chunk_start + chunk_frames)
+    spectrum = rfft(windowed_frames(signal, n_fft, hop_length, window,
+                                    chunk_start, chunk_end),
+                    n_fft, workers)
+    rows = slice(chunk_start - start_frame, chunk_end - start_frame)
+    if magnitude:
+      np.abs(spectrum, out=output[rows])
+    else:
+      output[rows] = spectrum
+  return output.transpose()
+
+
+def frame_energies(signal, n_fft, hop_length, chunk_frames=CHUNK_FRAMES):
+  """Calculate the (unwindowed) energy in each of the frames stft() uses.
+
+  This is a cheap pass with no FFT, so it can be used to decide which frames
+  are worth transforming.
+
+  Args:
+    signal: 1D np.array of the input time-domain signal.
+    n_fft: Size of each frame, as passed to stft().
+    hop_length: Advance (in samples) between each frame.
+    chunk_frames: Number of frames to process at a time.
+
+  Returns:
+    1D np.array with the sum of squared samples in each frame.
+  """
+  num_frames = num_stft_frames(len(signal), n_fft, hop_length)
+  energies = np.empty(max(0, num_frames))
+  for chunk_start in range(0, num_frames, chunk_frames):
+    chunk_end = min(num_frames, chunk_start + chunk_frames)
+    segment = _padded_segment(signal, n_fft // 2, chunk_start * hop_length,
+                              (chunk_end - 1) * hop_length + n_fft)
+    frames = frame(np.asarray(segment, dtype=float), n_fft, hop_length)
+    energies[chunk_start:chunk_end] = np.einsum('ij,ij->i', frames, frames)
+  return energies
+
+
+def stft_batch(signals, n_fft, hop_length=None, window=None, workers=None):
+  """Calculate the short-time Fourier transforms of several signals at once.
+
+  The frames of all the signals are stacked and passed to a single rfft call,
+  which avoids the per-call overhead of numpy when the signals are short.
+
+  Args:
+    signals: list of 1D np.arrays of time-domain signals.
+    n_fft: Size of the FFT to apply.
+    hop_length: Advance (in samples) between each frame passed to FFT.
+    window: Length of each block of samples to pass to FFT, or vector of window
+      values.  Defaults to n_fft.
+    workers: Number of threads for the FFT, as for stft().
+
+  Returns:
+    List of 2D np.arrays, one per input signal, each as returned by stft().
+  """
+  if not len(signals):
+    return []
+  framelist = [windowed_frames(signal, n_fft, hop_length, window)
+               for signal in signals]
+  spectra = rfft(np.concatenate(framelist), n_fft, workers)
+  bounds = np.cumsum([len(frames) for frames in framelist])[:-1]
+  return [spectrum.transpose() for spectrum in np.split(spectra, bounds)]